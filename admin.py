@@ -2,7 +2,7 @@ from django import forms
 from django.contrib import admin
 from django.utils.translation import ugettext_lazy as _
 
-from .models import Programme, UserProgramme, Stage, MasterCourse, ScheduledCourse, ProgrammeMasterCourse
+from .models import Programme, UserProgramme, Stage, MasterCourse, ScheduledCourse, ProgrammeMasterCourse, QueuedOperation
 
 
 class ProgrammeMasterForm(forms.ModelForm):
@@ -11,31 +11,25 @@ class ProgrammeMasterForm(forms.ModelForm):
     """
     display_order = forms.ChoiceField(label=_('display order'), required=False)
 
+    # set by ProgrammeMasterInline.get_formset, so a formset's forms share them rather than each querying for them
+    master_course_count = None
+    master_course_choices = None
+
     def __init__(self, *args, **kwargs):
         super(ProgrammeMasterForm, self).__init__(*args, **kwargs)
-        display_orders = range(1, MasterCourse.objects.count() + 1)
+        master_course_count = self.master_course_count
+        if master_course_count is None:
+            master_course_count = MasterCourse.objects.count()
+        display_orders = range(1, master_course_count + 1)
         self.fields['display_order'].choices = [('', '')] + [(str(x), str(x)) for x in display_orders]
+        if self.master_course_choices is not None:
+            self.fields['master_course'].choices = self.master_course_choices
 
     def clean(self):
         cleaned_data = super(ProgrammeMasterForm, self).clean()
 
         # ensure 'display_order' is set to zero if empty
         cleaned_data['display_order'] = cleaned_data['display_order'] or 0
-
-        # validate that programme and master don't already exist where stage is not selected
-        # note this is not enforced on the database with the unique together constraint
-        stage = cleaned_data.get('stage')
-        if not stage:
-            programme = cleaned_data.get('programme')
-            master_course = cleaned_data.get('master_course')
-            pk = self.instance.pk or 0
-            if ProgrammeMasterCourse.objects.filter(
-                    programme=programme,
-                    master_course=master_course,
-                    stage=None
-            ).exclude(pk=pk).exists():
-                error = _('Programme master with this Programme and Master course already exists')
-                raise forms.ValidationError(error)
         return cleaned_data
 
     class Meta:
@@ -60,7 +54,18 @@ class ProgrammeMasterInline(admin.TabularInline):
     form = ProgrammeMasterForm
     verbose_name = _('Master course')
     verbose_name_plural = _('Master courses')
-    ordering = ['stage__stage_order', 'display_order', 'master_course__display_name', ]
+    ordering = ['display_order', 'master_course__display_name', ]
+
+    def get_queryset(self, request):
+        return super(ProgrammeMasterInline, self).get_queryset(request).with_related()
+
+    def get_formset(self, request, obj=None, **kwargs):
+        formset = super(ProgrammeMasterInline, self).get_formset(request, obj, **kwargs)
+
+        # evaluate these once for the formset, rather than once per form
+        formset.form.master_course_count = MasterCourse.objects.count()
+        formset.form.master_course_choices = list(formset.form.base_fields['master_course'].choices)
+        return formset
 
 
 class StageInline(admin.TabularInline):
@@ -79,7 +84,10 @@ class ScheduledCourseInline(admin.TabularInline):
     model = ScheduledCourse
     readonly_fields = ['display_name', 'vle_course_id', 'open_date', 'start_date', 'end_date', 'close_date', ]
 
-    def has_add_permission(self, request):
+    def get_queryset(self, request):
+        return super(ScheduledCourseInline, self).get_queryset(request).with_related()
+
+    def has_add_permission(self, request, obj=None):
         return False
 
     def has_delete_permission(self, request, obj=None):
@@ -96,6 +104,9 @@ class ProgrammeStageAdmin(admin.ModelAdmin):
     inlines = [StageInline, ]
     ordering = ['display_name', ]
 
+    def get_queryset(self, request):
+        return super(ProgrammeStageAdmin, self).get_queryset(request).with_stage_count()
+
     def has_add_permission(self, request):
         return False
 
@@ -113,6 +124,9 @@ class ProgrammeMasterCourseAdmin(admin.ModelAdmin):
     inlines = [ProgrammeMasterInline, ]
     ordering = ['display_name', ]
 
+    def get_queryset(self, request):
+        return super(ProgrammeMasterCourseAdmin, self).get_queryset(request).with_master_course_count()
+
     def has_add_permission(self, request):
         return False
 
@@ -155,8 +169,23 @@ class ProgrammeCourse(Programme):
 @admin.register(UserProgramme)
 class UserProgrammeAdmin(admin.ModelAdmin):
     list_display = ('user', 'programme',)
+    list_select_related = ('user', 'programme',)
     list_filter = ('programme',)
-    search_fields = ('user__first_name', 'user__last_name', 'user__username', 'user__email', 'programme__name',)
+    search_fields = ('user__first_name', 'user__last_name', 'user__username', 'user__email', 'programme__display_name',)
+
+
+@admin.register(QueuedOperation)
+class QueuedOperationAdmin(admin.ModelAdmin):
+    """
+    admin for JSON API requests waiting to be applied, or which failed
+    """
+    list_display = ('operation', 'created', 'error',)
+    list_filter = ('operation',)
+    readonly_fields = ['operation', 'payload', 'created', 'error', ]
+
+    def has_add_permission(self, request):
+        return False
+
 
 admin.site.register(Programme)
 admin.site.register(ProgrammeStage, ProgrammeStageAdmin)
@@ -6,4 +6,4 @@ class ProgrammesConfig(AppConfig):
     name = 'programmes'
 
     def ready(self):
-        pass
+        from . import signals  # noqa: F401
@@ -0,0 +1,422 @@
+from collections import defaultdict
+from functools import partial
+
+from django.db import transaction
+from django.db.models import CharField, Value
+from django.db.models.functions import Cast, Concat
+from django.utils.translation import gettext as _
+
+from .domain import bump_catalogue_version, invalidate_programme_vle_course_ids, patch_many_memberships
+from .memberships import add_group, rename_group, remove_group
+from .models import MasterCourse, ScheduledCourse, ScheduledCourseGroup, ProgrammeMasterCourse
+from .snapshots import invalidate_programme_snapshots
+from .sync import get_datetime_or_none
+
+MASTER_COURSE_FIELDS = ['vle_course_id', 'display_name', 'compulsory', 'credits', 'commitment', 'weeks_duration']
+SCHEDULED_COURSE_FIELDS = ['vle_course_id', 'display_name', 'open_date', 'start_date', 'end_date', 'close_date']
+GROUP_FIELDS = ['vle_group_id', 'display_name']
+# what renamed objects are moved to while they swap ids, so their unique constraints hold throughout
+RENAMING_PREFIX = '~renaming~'
+
+
+def apply_operations(operations):
+    """
+    apply an ordered list of JSON API operations, each like {"operation": "create_group", "data": {...}} where data is
+    what the single endpoint of that name takes, in one transaction
+    returns a list of {"successMessage": ...} or {"errorMessage": ...} results, one per operation, matching what the
+    single endpoints would have returned had the operations been sent one after the other
+    """
+    batch = Batch(operations)
+    with transaction.atomic():
+        results = [batch.apply(operation) for operation in operations]
+        changed = batch.flush()
+    if changed:
+        # bulk writes don't send the signals that would do this
+        bump_catalogue_version()
+    # once committed, as the caller's transaction (e.g. drain's) may yet roll back
+    transaction.on_commit(partial(patch_many_memberships, batch.membership_changes))
+    return results
+
+
+class Batch(object):
+    """
+    resolves every vle_course_id and vle_group_id the operations refer to in three queries, then applies the
+    operations to those objects in memory, keeping track of what to create, update and delete, so that flush() can
+    write everything with a few bulk queries
+    """
+
+    def __init__(self, operations):
+        master_ids, scheduled_ids = _get_referenced_ids(operations)
+        self.masters = {m.vle_course_id: m for m in MasterCourse.objects.filter(vle_course_id__in=master_ids)}
+        masters_by_pk = {m.pk: m for m in self.masters.values()}
+        # the ids objects were loaded with, to tell which have been renamed
+        self.loaded_ids = {id(m): m.vle_course_id for m in self.masters.values()}
+
+        # scheduled courses and groups are also indexed by the identity of their parent, so deletes don't scan them all
+        self.scheduled = {}
+        self.scheduled_of = defaultdict(dict)
+        scheduled_by_pk = {}
+        for s in ScheduledCourse.objects.select_related('master_course').filter(vle_course_id__in=scheduled_ids):
+            s.master_course = masters_by_pk.get(s.master_course_id, s.master_course)
+            self.scheduled[s.vle_course_id] = s
+            self.scheduled_of[id(s.master_course)][id(s)] = s
+            self.loaded_ids[id(s)] = s.vle_course_id
+            scheduled_by_pk[s.pk] = s
+
+        # groups are keyed by the identity of their scheduled course, which may not have a pk yet, or may be renamed
+        self.groups = {}
+        self.groups_of = defaultdict(dict)
+        for g in ScheduledCourseGroup.objects.filter(scheduled_course_id__in=list(scheduled_by_pk)):
+            g.scheduled_course = scheduled_by_pk[g.scheduled_course_id]
+            self.groups[(id(g.scheduled_course), g.vle_group_id)] = g
+            self.groups_of[id(g.scheduled_course)][id(g)] = g
+            self.loaded_ids[id(g)] = g.vle_group_id
+
+        self.created = defaultdict(dict)
+        self.updated = defaultdict(dict)
+        self.deleted = defaultdict(set)
+        self.deleted_master_scheduled = set()
+        # master courses whose scheduled courses change, so whose next runs need recomputing
+        self.rescheduled = {}
+        self.membership_changes = defaultdict(list)
+
+    def apply(self, operation):
+        try:
+            method = getattr(self, operation['operation']) if operation['operation'] in OPERATIONS else None
+            data = operation.get('data', {})
+        except (KeyError, TypeError, AttributeError):
+            method = None
+        if method is None or not isinstance(data, dict):
+            return _error(_('Must specify a valid operation and its data'))
+        error = validate_operation(operation['operation'], data)
+        if error:
+            return _error(error)
+        return method(data)
+
+    def flush(self):
+        """
+        write everything: deletes, then updates, then creates
+        returns whether anything was written
+        """
+        changed = any(self.created.values()) or any(self.updated.values()) or any(self.deleted.values())
+        if self.deleted[ScheduledCourseGroup]:
+            ScheduledCourseGroup.objects.filter(pk__in=self.deleted[ScheduledCourseGroup]).delete()
+        if self.deleted[ScheduledCourse] or self.deleted_master_scheduled:
+            ScheduledCourse.objects.filter(pk__in=self.deleted[ScheduledCourse]).delete()
+            ScheduledCourse.objects.filter(master_course_id__in=self.deleted_master_scheduled).delete()
+        if self.deleted[MasterCourse]:
+            MasterCourse.objects.filter(pk__in=self.deleted[MasterCourse]).delete()
+
+        for model, fields, id_field in [
+            (MasterCourse, MASTER_COURSE_FIELDS, 'vle_course_id'),
+            (ScheduledCourse, SCHEDULED_COURSE_FIELDS, 'vle_course_id'),
+            (ScheduledCourseGroup, GROUP_FIELDS, 'vle_group_id'),
+        ]:
+            if self.updated[model]:
+                self._move_renamed(model, id_field)
+                model.objects.bulk_update(self.updated[model].values(), fields)
+
+        masters = list(self.created[MasterCourse].values())
+        _bulk_create(MasterCourse, masters, 'vle_course_id')
+        scheduled = list(self.created[ScheduledCourse].values())
+        for s in scheduled:
+            s.master_course_id = s.master_course.pk
+        _bulk_create(ScheduledCourse, scheduled, 'vle_course_id')
+        groups = list(self.created[ScheduledCourseGroup].values())
+        for g in groups:
+            g.scheduled_course_id = g.scheduled_course.pk
+        ScheduledCourseGroup.objects.bulk_create(groups)
+
+        rescheduled = [m.pk for m in self.rescheduled.values() if m.pk is not None]
+        if rescheduled:
+            MasterCourse.objects.filter(pk__in=rescheduled).update_next_runs()
+
+        # bulk updates don't send the signals that would invalidate the programmes of the updated master courses
+        # (new master courses aren't in any programmes, and deletes send them for the programme master courses)
+        if self.updated[MasterCourse]:
+            master_course_ids = [m.pk for m in self.updated[MasterCourse].values()]
+            programme_ids = list(ProgrammeMasterCourse.objects
+                                 .filter(master_course_id__in=master_course_ids)
+                                 .values_list('programme_id', flat=True)
+                                 .distinct())
+            invalidate_programme_vle_course_ids(programme_ids)
+            invalidate_programme_snapshots(programme_ids)
+        return changed
+
+    def _move_renamed(self, model, id_field):
+        """
+        move the updated objects of a model that have been renamed to temporary ids, when there's more than one, as
+        one may be taking another's old id (e.g. A to T, B to A, T to B), which the unique constraint won't allow
+        partway through a bulk update
+        """
+        renamed = [obj.pk for key, obj in self.updated[model].items() if getattr(obj, id_field) != self.loaded_ids[key]]
+        if len(renamed) > 1:
+            model.objects.filter(pk__in=renamed).update(**{
+                id_field: Concat(Value(RENAMING_PREFIX), Cast('pk', CharField())),
+            })
+
+    def _create(self, obj):
+        self.created[type(obj)][id(obj)] = obj
+
+    def _update(self, obj):
+        if obj.pk is not None:
+            self.updated[type(obj)][id(obj)] = obj
+
+    def _delete(self, obj):
+        if obj.pk is None:
+            self.created[type(obj)].pop(id(obj), None)
+        else:
+            self.updated[type(obj)].pop(id(obj), None)
+            self.deleted[type(obj)].add(obj.pk)
+
+    def create_master_course(self, data):
+        vle_course_id = data.get('vle_course_id', '')
+        name = data.get('name', '')
+        if vle_course_id in self.masters:
+            return _error(_('Course with given vle_course_id already exists'))
+
+        course = self.masters[vle_course_id] = MasterCourse(vle_course_id=vle_course_id, display_name=name)
+        _set_master_course_details(course, data)
+        self._create(course)
+        return _success(_('Course created successfully!'))
+
+    def update_master_course(self, data):
+        old_vle_course_id = data.get('old_vle_course_id', '')
+        vle_course_id = data.get('vle_course_id', '')
+        name = data.get('name', '')
+        if old_vle_course_id not in self.masters:
+            return _error(_('Course with given old_vle_course_id does not exist'))
+        if vle_course_id != old_vle_course_id and vle_course_id in self.masters:
+            return _error(_('Course with given vle_course_id already exists'))
+
+        course = self.masters.pop(old_vle_course_id)
+        course.vle_course_id = vle_course_id
+        course.display_name = name
+        _set_master_course_details(course, data)
+        self.masters[vle_course_id] = course
+        self._update(course)
+        return _success(_('Course updated successfully!'))
+
+    def delete_master_course(self, data):
+        vle_course_id = data.get('vle_course_id', '')
+        if vle_course_id not in self.masters:
+            return _error(_('Course with given vle_course_id does not exist'))
+
+        course = self.masters.pop(vle_course_id)
+        for s in list(self.scheduled_of.pop(id(course), {}).values()):
+            self._delete_scheduled_course(s)
+        if course.pk is not None:
+            self.deleted_master_scheduled.add(course.pk)
+        self._delete(course)
+        return _success(_('Course deleted successfully!'))
+
+    def create_scheduled_course(self, data):
+        master_vle_course_id = data.get('master_vle_course_id', '')
+        vle_course_id = data.get('vle_course_id', '')
+        name = data.get('name', '')
+        if vle_course_id in self.scheduled:
+            return _error(_('Course with given vle_course_id already exists'))
+        if master_vle_course_id not in self.masters:
+            return _error(_('Course with given master_vle_course_id does not exist'))
+
+        course = self.scheduled[vle_course_id] = ScheduledCourse(
+            vle_course_id=vle_course_id,
+            display_name=name,
+            master_course=self.masters[master_vle_course_id],
+        )
+        _set_scheduled_course_dates(course, data)
+        self._create(course)
+        self.scheduled_of[id(course.master_course)][id(course)] = course
+        self.rescheduled[id(course.master_course)] = course.master_course
+        return _success(_('Course created successfully!'))
+
+    def update_scheduled_course(self, data):
+        master_vle_course_id = data.get('master_vle_course_id', '')
+        old_vle_course_id = data.get('old_vle_course_id', '')
+        vle_course_id = data.get('vle_course_id', '')
+        name = data.get('name', '')
+        course = self.scheduled.get(old_vle_course_id)
+        if course is None or course.master_course.vle_course_id != master_vle_course_id:
+            return _error(_('Course with given old_vle_course_id and master_vle_course_id does not exist'))
+        if vle_course_id != old_vle_course_id and vle_course_id in self.scheduled:
+            return _error(_('Course with given vle_course_id already exists'))
+
+        del self.scheduled[old_vle_course_id]
+        course.vle_course_id = vle_course_id
+        course.display_name = name
+        _set_scheduled_course_dates(course, data)
+        self.scheduled[vle_course_id] = course
+        self._update(course)
+        self.rescheduled[id(course.master_course)] = course.master_course
+        return _success(_('Course updated successfully!'))
+
+    def delete_scheduled_course(self, data):
+        master_vle_course_id = data.get('master_vle_course_id', '')
+        vle_course_id = data.get('vle_course_id', '')
+        course = self.scheduled.get(vle_course_id)
+        if course is None or course.master_course.vle_course_id != master_vle_course_id:
+            return _error(_('Course with given old_vle_course_id and master_vle_course_id does not exist'))
+
+        self._delete_scheduled_course(course)
+        self.rescheduled[id(course.master_course)] = course.master_course
+        return _success(_('Course deleted successfully!'))
+
+    def _delete_scheduled_course(self, course):
+        del self.scheduled[course.vle_course_id]
+        self.scheduled_of[id(course.master_course)].pop(id(course), None)
+        # only groups that haven't been saved yet can go with it, saved ones protect it (as with the single endpoints)
+        groups = self.groups_of[id(course)]
+        for g in [g for g in groups.values() if g.pk is None]:
+            del self.groups[(id(course), g.vle_group_id)]
+            del groups[id(g)]
+            self._delete(g)
+        self._delete(course)
+
+    def create_group(self, data):
+        vle_course_id = data.get('vle_course_id', '')
+        vle_group_id = data.get('vle_group_id', '')
+        name = data.get('name', '')
+        scheduled_course = self.scheduled.get(vle_course_id)
+        if scheduled_course is None:
+            return _error(_('Course with given vle_course_id does not exist'))
+        key = (id(scheduled_course), vle_group_id)
+        if key in self.groups:
+            return _error(_('Group with given vle_course_id and vle_group_id already exists'))
+
+        group = self.groups[key] = ScheduledCourseGroup(
+            scheduled_course=scheduled_course,
+            vle_group_id=vle_group_id,
+            display_name=name,
+        )
+        self._create(group)
+        self.groups_of[id(scheduled_course)][id(group)] = group
+        self.membership_changes[vle_course_id].append(partial(add_group, vle_group_id=vle_group_id))
+        return _success(_('Group created successfully!'))
+
+    def update_group(self, data):
+        vle_course_id = data.get('vle_course_id', '')
+        old_vle_group_id = data.get('old_vle_group_id', '')
+        vle_group_id = data.get('vle_group_id', '')
+        name = data.get('name', '')
+        scheduled_course = self.scheduled.get(vle_course_id)
+        if scheduled_course is None:
+            return _error(_('Course with given vle_course_id does not exist'))
+        old_key, key = (id(scheduled_course), old_vle_group_id), (id(scheduled_course), vle_group_id)
+        if old_key not in self.groups:
+            return _error(_('Group with given vle_course_id and old_vle_group_id does not exist'))
+        if key != old_key and key in self.groups:
+            return _error(_('Group with given vle_course_id and vle_group_id already exists'))
+
+        group = self.groups.pop(old_key)
+        group.vle_group_id = vle_group_id
+        group.display_name = name
+        self.groups[key] = group
+        self._update(group)
+        if vle_group_id != old_vle_group_id:
+            self.membership_changes[vle_course_id].append(
+                partial(rename_group, old_vle_group_id=old_vle_group_id, vle_group_id=vle_group_id)
+            )
+        return _success(_('Group updated successfully!'))
+
+    def delete_group(self, data):
+        vle_course_id = data.get('vle_course_id', '')
+        vle_group_id = data.get('vle_group_id', '')
+        scheduled_course = self.scheduled.get(vle_course_id)
+        if scheduled_course is None:
+            return _error(_('Course with given vle_course_id does not exist'))
+        key = (id(scheduled_course), vle_group_id)
+        if key not in self.groups:
+            return _error(_('Group with given vle_course_id and vle_group_id does not exist'))
+
+        group = self.groups.pop(key)
+        self.groups_of[id(scheduled_course)].pop(id(group), None)
+        self._delete(group)
+        self.membership_changes[vle_course_id].append(partial(remove_group, vle_group_id=vle_group_id))
+        return _success(_('Group deleted successfully!'))
+
+
+# the fields each operation needs, and the error for when any are missing
+REQUIRED_FIELDS = {
+    'create_master_course': (['vle_course_id', 'name'], 'Must specify vle_course_id and name'),
+    'update_master_course': (['old_vle_course_id', 'vle_course_id', 'name'], 'Must specify old_vle_course_id, vle_course_id, name'),
+    'delete_master_course': (['vle_course_id'], 'Must specify vle_course_id'),
+    'create_scheduled_course': (
+        ['master_vle_course_id', 'vle_course_id', 'name'],
+        'Must specify master_vle_course_id, vle_course_id and name',
+    ),
+    'update_scheduled_course': (
+        ['master_vle_course_id', 'old_vle_course_id', 'vle_course_id', 'name'],
+        'Must specify master_vle_course_id, old_vle_course_id, vle_course_id and name',
+    ),
+    'delete_scheduled_course': (['master_vle_course_id', 'vle_course_id'], 'Must specify master_vle_course_id and vle_course_id'),
+    'create_group': (['vle_course_id', 'vle_group_id', 'name'], 'Must specify vle_course_id, vle_group_id, name'),
+    'update_group': (
+        ['vle_course_id', 'old_vle_group_id', 'vle_group_id', 'name'],
+        'Must specify vle_course_id, old_vle_group_id, vle_group_id, name',
+    ),
+    'delete_group': (['vle_course_id', 'vle_group_id'], 'Must specify vle_course_id and vle_group_id'),
+}
+OPERATIONS = set(REQUIRED_FIELDS)
+
+
+def validate_operation(operation, data):
+    """
+    the error message for an operation missing any of its fields, or None
+    """
+    fields, msg = REQUIRED_FIELDS[operation]
+    if not all(data.get(field, '') for field in fields):
+        return _(msg)
+    return None
+
+
+def _get_referenced_ids(operations):
+    """
+    the master course and scheduled course vle_course_ids the operations refer to
+    """
+    master_ids, scheduled_ids = set(), set()
+    for operation in operations:
+        try:
+            name, data = operation['operation'], operation.get('data', {})
+            if name.endswith('master_course'):
+                master_ids.update([data.get('vle_course_id'), data.get('old_vle_course_id')])
+            elif name.endswith('scheduled_course'):
+                master_ids.add(data.get('master_vle_course_id'))
+                scheduled_ids.update([data.get('vle_course_id'), data.get('old_vle_course_id')])
+            elif name.endswith('group'):
+                scheduled_ids.add(data.get('vle_course_id'))
+        except (KeyError, TypeError, AttributeError):
+            continue
+    return [i for i in master_ids if i], [i for i in scheduled_ids if i]
+
+
+def _set_master_course_details(course, data):
+    course.compulsory = data.get('compulsory', False)
+    course.credits = data.get('credits', None)
+    course.commitment = data.get('commitment', '')
+    course.weeks_duration = data.get('weeks_duration', None)
+
+
+def _set_scheduled_course_dates(course, data):
+    course.open_date = get_datetime_or_none(data.get('opendate', None), '%Y-%m-%d')
+    course.start_date = get_datetime_or_none(data.get('startdate', None), '%Y-%m-%d')
+    course.end_date = get_datetime_or_none(data.get('enddate', None), '%Y-%m-%d')
+    course.close_date = get_datetime_or_none(data.get('closedate', None), '%Y-%m-%d')
+
+
+def _bulk_create(model, objs, unique_field):
+    """
+    bulk create objs, making sure they have their pks afterwards even where the database can't return them
+    """
+    model.objects.bulk_create(objs)
+    missing = {getattr(obj, unique_field): obj for obj in objs if obj.pk is None}
+    if missing:
+        for value, pk in model.objects.filter(**{unique_field + '__in': list(missing)}).values_list(unique_field, 'pk'):
+            missing[value].pk = pk
+
+
+def _success(msg):
+    return {'successMessage': msg}
+
+
+def _error(msg):
+    return {'errorMessage': msg}
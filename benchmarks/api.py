@@ -0,0 +1,71 @@
+"""
+throughput benchmark of the JSON API against running servers, to compare the sync and async views
+
+serve the project under an ASGI server twice, e.g. on two ports, once with PROGRAMMES_API_ASYNC = False and once with
+it True, then point this at the JSON API of each:
+
+    python -m programmes.benchmarks.api --url http://127.0.0.1:8000/api/ --url http://127.0.0.1:8001/api/ \\
+        [--concurrency 200] [--requests 5000]
+
+each run creates a master course (BENCH-<n>), updates it --requests times from --concurrency threads, and deletes it
+"""
+import argparse
+import json
+import statistics
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+
+def run(url, concurrency, number):
+    session = requests.Session()
+    session.mount('http://', HTTPAdapter(pool_connections=concurrency, pool_maxsize=concurrency))
+    vle_course_id = 'BENCH-{}'.format(uuid.uuid4().hex[:8])
+    headers = {'Content-Type': 'application/json'}
+
+    session.post(url + 'create/master/', data=json.dumps({'vle_course_id': vle_course_id, 'name': 'Bench'}), headers=headers)
+
+    def update(i):
+        start = time.perf_counter()
+        response = session.post(url + 'update/master/', headers=headers, data=json.dumps({
+            'old_vle_course_id': vle_course_id,
+            'vle_course_id': vle_course_id,
+            'name': 'Bench {}'.format(i),
+        }))
+        return time.perf_counter() - start, response.status_code
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(update, range(number)))
+    elapsed = time.perf_counter() - start
+
+    session.post(url + 'delete/master/', data=json.dumps({'vle_course_id': vle_course_id}), headers=headers)
+
+    latencies = sorted(duration for duration, status in results)
+    errors = sum(1 for duration, status in results if status >= 400)
+    return {
+        'rps': number / elapsed,
+        'p50': statistics.median(latencies) * 1000,
+        'p99': latencies[int(len(latencies) * 0.99) - 1] * 1000,
+        'errors': errors,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--url', action='append', required=True, help='JSON API root url, may be given more than once')
+    parser.add_argument('--concurrency', type=int, default=200, help='concurrent requests (default: 200)')
+    parser.add_argument('--requests', type=int, default=5000, help='requests per url (default: 5000)')
+    args = parser.parse_args()
+
+    print('{:<40} {:>10} {:>10} {:>10} {:>8}'.format('url', 'req/s', 'p50 (ms)', 'p99 (ms)', 'errors'))
+    for url in args.url:
+        result = run(url if url.endswith('/') else url + '/', args.concurrency, args.requests)
+        print('{:<40} {rps:>10.0f} {p50:>10.1f} {p99:>10.1f} {errors:>8}'.format(url, **result))
+
+
+if __name__ == '__main__':
+    main()
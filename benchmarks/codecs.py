@@ -0,0 +1,102 @@
+"""
+micro-benchmark of the json codecs codec.py can use, on payloads shaped like the ones the app handles
+
+    python -m programmes.benchmarks.codecs [--number N]
+
+codecs that aren't installed are skipped
+"""
+import argparse
+import json
+import timeit
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+
+def get_codecs():
+    codecs = {
+        'json': (json.loads, lambda obj: json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')),
+    }
+    if ujson is not None:
+        codecs['ujson'] = (ujson.loads, lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8'))
+    if orjson is not None:
+        codecs['orjson'] = (orjson.loads, orjson.dumps)
+    return codecs
+
+
+def get_payloads():
+    """
+    a JSON API webhook body, a JSON API response, a tutor's enrolments and the memberships of a large scheduled course
+    """
+    webhook = {
+        'master_vle_course_id': 'MBA-ACC-001',
+        'old_vle_course_id': 'MBA-ACC-001/2020-09',
+        'vle_course_id': 'MBA-ACC-001/2020-09',
+        'name': 'Accounting for Managers (September 2020)',
+        'opendate': '2020-08-24',
+        'startdate': '2020-09-07',
+        'enddate': '2020-12-11',
+        'closedate': '2021-01-08',
+    }
+    response = {'successMessage': 'Course updated successfully!'}
+    enrolments = {
+        'courses': [{
+            'masteridnumber': 'MBA-{:03d}'.format(i),
+            'idnumber': 'MBA-{:03d}/2020-09'.format(i),
+            'fullname': 'Module {} (September 2020)'.format(i),
+            'shortname': 'MBA{:03d}'.format(i),
+            'url': 'https://vle.example.com/course/view.php?id={}'.format(i),
+            'startdate': '2020-09-07',
+            'enddate': '2020-12-11',
+        } for i in range(20)],
+        'module_completions': {
+            'students': [{
+                'username': 'student.{}'.format(i),
+                'firstname': 'Student',
+                'lastname': str(i),
+                'completions': {'MBA-{:03d}'.format(m): m % 3 == 0 for m in range(20)},
+            } for i in range(2000)],
+        },
+    }
+    memberships = {
+        'members': ['student.{}'.format(i) for i in range(5000)],
+        'groups': {
+            'MBA-ACC-001/2020-09/{}'.format(g): ['student.{}'.format(i) for i in range(g, 5000, 50)]
+            for g in range(50)
+        },
+    }
+    return {
+        'webhook': webhook,
+        'response': response,
+        'enrolments': enrolments,
+        'memberships': memberships,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--number', type=int, default=0, help='iterations per measurement (default: auto)')
+    args = parser.parse_args()
+
+    codecs = get_codecs()
+    print('{:<12} {:>10} {:<8} {:>14} {:>14}'.format('payload', 'bytes', 'codec', 'loads (us)', 'dumps (us)'))
+    for name, payload in get_payloads().items():
+        data = json.dumps(payload).encode('utf-8')
+        for codec_name, (loads, dumps) in codecs.items():
+            timings = []
+            for func, arg in [(loads, data), (dumps, payload)]:
+                timer = timeit.Timer(lambda: func(arg))
+                number = args.number or timer.autorange()[0]
+                timings.append(min(timer.repeat(repeat=3, number=number)) / number * 1e6)
+            print('{:<12} {:>10} {:<8} {:>14.1f} {:>14.1f}'.format(name, len(data), codec_name, *timings))
+
+
+if __name__ == '__main__':
+    main()
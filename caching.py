@@ -0,0 +1,147 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import caches
+
+
+class LRUCache(object):
+    """
+    a bounded, thread-safe, process-local least recently used cache, whose entries optionally expire after ttl seconds
+    """
+
+    def __init__(self, maxsize, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._entries[key]
+            except KeyError:
+                return default
+            if expires is not None and expires <= time.time():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl=None):
+        ttl = self.ttl if ttl is None else ttl
+        expires = None if ttl is None else time.time() + ttl
+        with self._lock:
+            self._entries[key] = (value, expires)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache(object):
+    """
+    a process-local LRU (L1) in front of a shared django cache (L2)
+    other processes' L1s are invalidated by bumping a generation counter kept in L2, which each process checks at most
+    every check_interval seconds, so only use L1 for values that are either immutable or fine to be a little stale
+    counts hits and misses for each tier in stats
+    """
+
+    def __init__(self, alias='default', maxsize=1000, ttl=300, generation_key='programmes_cache_generation',
+                 check_interval=1.0):
+        self.alias = alias
+        self.generation_key = generation_key
+        self.check_interval = check_interval
+        self.stats = {'l1_hits': 0, 'l1_misses': 0, 'l2_hits': 0, 'l2_misses': 0}
+        self._l1 = LRUCache(maxsize, ttl)
+        self._generation = None
+        self._checked = 0
+
+    @property
+    def l2(self):
+        return caches[self.alias]
+
+    def get(self, key, default=None):
+        return self.get_many([key]).get(key, default)
+
+    def get_many(self, keys):
+        self._check_generation()
+        values = {}
+        misses = []
+        for key in keys:
+            value = self._l1.get(key, _missing)
+            if value is _missing:
+                misses.append(key)
+            else:
+                values[key] = value
+        self._count('l1', len(values), len(misses))
+
+        if misses:
+            found = self.l2.get_many(misses)
+            self._count('l2', len(found), len(misses) - len(found))
+            for key, value in found.items():
+                self._l1.set(key, value)
+            values.update(found)
+
+        return values
+
+    def set(self, key, value, timeout):
+        self.set_many({key: value}, timeout)
+
+    def set_many(self, data, timeout):
+        self.l2.set_many(data, timeout)
+        for key, value in data.items():
+            self._l1.set(key, value, None if timeout is None else min(timeout, self._l1.ttl or timeout))
+
+    def delete(self, key):
+        """
+        delete from L2 and this process's L1, other processes' L1s still need invalidating
+        """
+        self.delete_many([key])
+
+    def delete_many(self, keys):
+        self.l2.delete_many(keys)
+        for key in keys:
+            self._l1.delete(key)
+
+    def invalidate(self):
+        """
+        drop every process's L1
+        """
+        try:
+            self._generation = self.l2.incr(self.generation_key)
+        except ValueError:
+            self._generation = 1 if self.l2.add(self.generation_key, 1, None) else self.l2.get(self.generation_key)
+        self._checked = time.time()
+        self._l1.clear()
+
+    def clear_l1(self):
+        self._l1.clear()
+
+    def _check_generation(self):
+        now = time.time()
+        if now - self._checked < self.check_interval:
+            return
+        self._checked = now
+        generation = self.l2.get(self.generation_key)
+        if generation != self._generation:
+            self._generation = generation
+            self._l1.clear()
+
+    def _count(self, tier, hits, misses):
+        # approximate, as these aren't locked
+        self.stats[tier + '_hits'] += hits
+        self.stats[tier + '_misses'] += misses
+
+
+_missing = object()
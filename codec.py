@@ -0,0 +1,37 @@
+import json
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# the fastest json codec installed
+CODEC = 'orjson' if orjson is not None else 'ujson' if ujson is not None else 'json'
+
+
+def loads(data):
+    """
+    decode json from bytes (or str) without decoding the bytes to str first
+    raises ValueError for invalid json, whichever codec is used
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    if ujson is not None:
+        return ujson.loads(data)
+    return json.loads(data)
+
+
+def dumps(obj):
+    """
+    encode obj as compact json bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(obj)
+    if ujson is not None:
+        return ujson.dumps(obj, ensure_ascii=False).encode('utf-8')
+    return json.dumps(obj, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
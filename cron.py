@@ -1,5 +1,10 @@
+from datetime import datetime
+
 from django_cron import CronJobBase, Schedule
 
+from .domain import refresh_memberships_from_changes
+from .ingest import drain
+from .models import MasterCourse
 from .sync import full_sync
 
 
@@ -12,3 +17,37 @@ class FullSync(CronJobBase):
     def do(self):
         result = full_sync()
         return result
+
+
+class MembershipsRefresh(CronJobBase):
+    RUN_EVERY_MINS = 5
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'programmes.memberships_refresh'
+
+    def do(self):
+        result = refresh_memberships_from_changes()
+        return result
+
+
+class IngestDrain(CronJobBase):
+    RUN_EVERY_MINS = 1
+
+    schedule = Schedule(run_every_mins=RUN_EVERY_MINS)
+    code = 'programmes.ingest_drain'
+
+    def do(self):
+        applied, failed = drain()
+        return '{} applied, {} failed'.format(applied, failed)
+
+
+class NextRunsRollForward(CronJobBase):
+    RUN_AT_TIMES = ['00:05']
+
+    schedule = Schedule(run_at_times=RUN_AT_TIMES)
+    code = 'programmes.next_runs_roll_forward'
+
+    def do(self):
+        # only courses whose next run has started since they were last computed
+        updated = MasterCourse.objects.filter(next_start_date__lt=datetime.today().date()).update_next_runs()
+        return '{} master courses rolled forward'.format(updated)
@@ -1,40 +1,116 @@
-from functools import partial
+import math
+import random
+import threading
+import time
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
 
 from django.contrib.auth import get_user_model
 from django.conf import settings
 from django.core.cache import caches
+from django.db import transaction
+from django.db.models import Prefetch
+from django.utils.translation import gettext as _
 
-import requests
+from requests import RequestException
 
-from .models import UserProgramme, ProgrammeMasterCourse
+from . import codec, vle
+from .caching import LRUCache, TwoTierCache
+from .memberships import Memberships, SHARD_COMPRESSION, get_shard_key, pack_shard, unpack_shard, get_membership_change
+from .models import Programme, Stage, UserProgramme, ProgrammeMasterCourse, MasterCourse
+from .vle import get_max_duration
 
-course_and_group_memberships_cache_key = 'course_and_group_memberships'
+course_and_group_memberships_cache_key = 'course_and_group_memberships:4'
+course_and_group_memberships_shard_key = 'course_and_group_memberships_shard'
+course_and_group_memberships_index_key = 'course_and_group_memberships_index'
+course_and_group_memberships_lock_key = 'course_and_group_memberships_lock'
+course_and_group_memberships_patch_lock_key = 'course_and_group_memberships_patch_lock'
+user_id_cache_key = 'programmes_user_id'
+
+# the fields of each enrolled course that the dashboard uses
+DEFAULT_ENROLMENT_COURSE_FIELDS = ('masteridnumber', 'idnumber', 'fullname', 'shortname', 'url', 'startdate', 'enddate')
+programme_vle_course_ids_cache_key = 'programme_vle_course_ids'
+enrolments_cache_key = 'enrolments'
+catalogue_version_cache_key = 'programmes_catalogue_version'
+
+# the indexed memberships for the most recently seen version
+_memberships = (None, Memberships({}))
+
+# hot data, with a process-local tier in front of the shared cache
+hot_cache = TwoTierCache(
+    maxsize=getattr(settings, 'PROGRAMMES_L1_CACHE_SIZE', 1000),
+    ttl=getattr(settings, 'PROGRAMMES_L1_CACHE_TIMEOUT', 300),
+)
+
+# programmes' cached data, which changes whenever a programme or its master courses do, so has its own generation, so
+# invalidating it leaves the memberships shards and enrolments in hot_cache's L1s alone
+programme_cache = TwoTierCache(
+    maxsize=getattr(settings, 'PROGRAMMES_L1_CACHE_SIZE', 1000),
+    ttl=getattr(settings, 'PROGRAMMES_L1_CACHE_TIMEOUT', 300),
+    generation_key='programmes_programme_cache_generation',
+)
+
+# ids of known usernames, which expire so that other processes' invalidate_user_id is seen
+_user_ids = LRUCache(getattr(settings, 'USER_IDS_LRU_SIZE', 10000), getattr(settings, 'USER_IDS_LRU_TIMEOUT', 300))
 
 
 def get_user_enrolled_scheduled_courses_by_programme(user, role='student'):
-    # two queries and one http request
-    user_programmes = get_user_programmes(user)
-    programme_master_courses = get_programme_master_courses(user_programmes.values_list('programme__id', flat=True))
+    # at most two queries and one http request
+    user_programmes = list(get_user_programmes(user))
+    vle_course_ids = get_programme_vle_course_ids([up.programme.id for up in user_programmes])
     user_enrolled_scheduled_courses = get_user_enrolled_scheduled_courses(user.username, role)
 
     # list of programmes
-    programmes = [{
-        'id': up.programme.id,
-        'display_name': up.programme.display_name,
-        'courses': list(filter(
-            partial(_filter_master_courses, programme_id=up.programme.id, master_course_ids=programme_master_courses),
-            user_enrolled_scheduled_courses.get('courses', [])
-        )),
-    } for up in user_programmes]
+    programmes = _get_programmes(user_programmes, vle_course_ids, user_enrolled_scheduled_courses)
 
     # completion data
-    completions = user_enrolled_scheduled_courses.get('module_completions', {})
+    completions = dict(user_enrolled_scheduled_courses.get('module_completions', {}))
     if role == 'tutor':
         completions['students'] = _set_user_ids(completions.get('students', []))
 
     return programmes, completions
 
 
+def get_users_enrolled_scheduled_courses_by_programme(users, role='student'):
+    """
+    batch version of get_user_enrolled_scheduled_courses_by_programme, for reports over many users
+    at most two queries, plus either batched http requests (if BATCH_ENROLMENTS_URL is set) or one http request
+    per user with at most ENROLMENTS_MAX_CONCURRENCY in flight
+    returns a dict of (programmes, completions) tuples keyed by user id
+    """
+    users = list(users)
+    user_programmes = list(get_users_programmes(users))
+    vle_course_ids = get_programme_vle_course_ids({up.programme.id for up in user_programmes})
+    enrolments = get_users_enrolled_scheduled_courses([u.username for u in users], role)
+
+    # group the user programmes by user, preserving the programme ordering
+    user_programmes_by_user = defaultdict(list)
+    for up in user_programmes:
+        user_programmes_by_user[up.user.id].append(up)
+
+    results = {}
+    for user in users:
+        user_enrolled_scheduled_courses = enrolments.get(user.username, {})
+        programmes = _get_programmes(
+            user_programmes_by_user[user.id],
+            vle_course_ids,
+            user_enrolled_scheduled_courses
+        )
+        completions = dict(user_enrolled_scheduled_courses.get('module_completions', {}))
+        if role == 'tutor':
+            completions['students'] = completions.get('students', [])
+        results[user.id] = (programmes, completions)
+
+    # set the ids of every student across all the tutors in one go
+    if role == 'tutor':
+        ids = get_user_ids(u['username'] for _programmes, completions in results.values() for u in completions['students'])
+        for _programmes, completions in results.values():
+            completions['students'] = [dict(u, id=ids.get(u['username'])) for u in completions['students']]
+
+    return results
+
+
 def get_user_programmes(user):
     """
     one query to get the user programmes for a given user
@@ -47,6 +123,18 @@ def get_user_programmes(user):
         .order_by('programme__display_name')
 
 
+def get_users_programmes(users):
+    """
+    one query to get the user programmes for the given users
+    """
+    return UserProgramme\
+        .objects\
+        .select_related('programme')\
+        .select_related('user')\
+        .filter(user__id__in=[u.id for u in users])\
+        .order_by('programme__display_name')
+
+
 def get_programme_master_courses(programme_ids):
     """
     one query to get the programme master courses for given programme ids
@@ -58,56 +146,641 @@ def get_programme_master_courses(programme_ids):
         .filter(programme__id__in=programme_ids)
 
 
+def get_programme_structure(programme_ids):
+    """
+    three queries to get the given programmes with their stages (as stages, in order) and available programme master
+    courses with their master courses (as available_courses, in display order), which Stage.courses_available uses
+    """
+    return Programme.objects.filter(pk__in=programme_ids).order_by('display_name').prefetch_related(
+        Prefetch('stage_set', queryset=Stage.objects.order_by('stage_order'), to_attr='stages'),
+        Prefetch(
+            'programmemastercourse_set',
+            queryset=ProgrammeMasterCourse.objects
+                .filter(available=True)
+                .select_related('master_course')
+                .order_by('display_order', 'master_course__display_name'),
+            to_attr='available_courses',
+        ),
+    )
+
+
+def set_module_courses(modules):
+    """
+    one query to set the course of each of the given modules (the module overview CMS plugin's instances, whose course
+    is a foreign key to MasterCourse), so module_overview.html renders without a query per module
+    """
+    modules = list(modules)
+    courses = MasterCourse.objects.in_bulk({module.course_id for module in modules})
+    for module in modules:
+        if module.course_id in courses:
+            module.course = courses[module.course_id]
+    return modules
+
+
+def get_programme_vle_course_ids(programme_ids):
+    """
+    the vle_course_ids of the master courses of the given programmes, as a dict of sets keyed by programme id
+    read through the two-tier cache, with one query for any misses
+    """
+    keys = {_get_programme_vle_course_ids_cache_key(programme_id): programme_id for programme_id in programme_ids}
+    cached = programme_cache.get_many(list(keys))
+    vle_course_ids = {keys[key]: ids for key, ids in cached.items()}
+
+    misses = [programme_id for key, programme_id in keys.items() if key not in cached]
+    if misses:
+        found = _get_vle_course_ids_by_programme(get_programme_master_courses(misses))
+        found = {programme_id: frozenset(found.get(programme_id, ())) for programme_id in misses}
+        programme_cache.set_many(
+            {_get_programme_vle_course_ids_cache_key(programme_id): ids for programme_id, ids in found.items()},
+            getattr(settings, 'PROGRAMME_VLE_COURSE_IDS_CACHE_TIMEOUT', 86400)
+        )
+        vle_course_ids.update(found)
+
+    return vle_course_ids
+
+
+def invalidate_programme_vle_course_ids(programme_ids):
+    """
+    forget the cached vle_course_ids of the given programmes, in every process, once the current transaction (if any)
+    commits, so no one can re-cache them from what the transaction is changing in the meantime
+    """
+    keys = [_get_programme_vle_course_ids_cache_key(programme_id) for programme_id in programme_ids]
+
+    def invalidate():
+        programme_cache.delete_many(keys)
+        programme_cache.invalidate()
+    transaction.on_commit(invalidate)
+
+
+def _get_programme_vle_course_ids_cache_key(programme_id):
+    return '{}:{}'.format(programme_vle_course_ids_cache_key, programme_id)
+
+
+def get_catalogue_version():
+    """
+    a version for the master courses, scheduled courses and groups, which changes whenever any of them do
+    """
+    cache = caches['default']
+    version = cache.get(catalogue_version_cache_key)
+    if version is None:
+        # start from the time, so versions aren't reused if the cache is cleared
+        cache.add(catalogue_version_cache_key, int(time.time() * 1000), None)
+        version = cache.get(catalogue_version_cache_key)
+    return version
+
+
+def bump_catalogue_version():
+    """
+    change the catalogue version once the current transaction (if any) commits, so no one can read what the
+    transaction is changing under the new version, and be told it's unchanged after
+    """
+    transaction.on_commit(_bump_catalogue_version)
+
+
+def _bump_catalogue_version():
+    cache = caches['default']
+    try:
+        cache.incr(catalogue_version_cache_key)
+    except ValueError:
+        get_catalogue_version()
+
+
 def get_user_enrolled_scheduled_courses(username, role):
     """
     one http request to get all the enrolled courses for a given username
+    cached in the two-tier cache for ENROLMENTS_CACHE_TIMEOUT seconds, if set
     """
-    response = requests.get(
-        '{}'.format(settings.ENROLMENTS_URL),
-        params={
-            'username': username,
-            'role': role,
-        }
+    timeout = getattr(settings, 'ENROLMENTS_CACHE_TIMEOUT', 0)
+    if timeout:
+        enrolments = hot_cache.get(_get_enrolments_cache_key(username, role))
+        if enrolments is not None:
+            return enrolments
+
+    try:
+        response = vle.get(
+            '{}'.format(settings.ENROLMENTS_URL),
+            params={
+                'username': username,
+                'role': role,
+            },
+            endpoint='enrolments'
+        )
+    except RequestException:
+        return {}
+    if response.status_code != 200:
+        return {}
+
+    enrolments = _project_enrolments(codec.loads(response.content))
+    if timeout:
+        hot_cache.set(_get_enrolments_cache_key(username, role), enrolments, timeout)
+    return enrolments
+
+
+def get_users_enrolled_scheduled_courses(usernames, role):
+    """
+    get all the enrolled courses for the given usernames, as a dict keyed by username
+    uses the VLE's batch endpoint when BATCH_ENROLMENTS_URL is set, otherwise fans out single requests
+    """
+    usernames = list(usernames)
+    if not usernames:
+        return {}
+
+    if getattr(settings, 'BATCH_ENROLMENTS_URL', None):
+        timeout = getattr(settings, 'ENROLMENTS_CACHE_TIMEOUT', 0)
+        enrolments = {}
+        if timeout:
+            keys = {_get_enrolments_cache_key(username, role): username for username in usernames}
+            enrolments = {keys[key]: e for key, e in hot_cache.get_many(list(keys)).items()}
+        misses = [username for username in usernames if username not in enrolments]
+
+        batch_size = getattr(settings, 'BATCH_ENROLMENTS_SIZE', 200)
+        for i in range(0, len(misses), batch_size):
+            found = _get_batch_enrolled_scheduled_courses(misses[i:i + batch_size], role)
+            if timeout:
+                hot_cache.set_many({_get_enrolments_cache_key(u, role): e for u, e in found.items()}, timeout)
+            enrolments.update(found)
+        return enrolments
+
+    max_workers = min(getattr(settings, 'ENROLMENTS_MAX_CONCURRENCY', 8), len(usernames))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        responses = executor.map(lambda username: get_user_enrolled_scheduled_courses(username, role), usernames)
+        return dict(zip(usernames, responses))
+
+
+def _project_enrolments(enrolments):
+    """
+    keep just the parts of an enrolments payload that are used: the ENROLMENT_COURSE_FIELDS of each course, and the
+    module completions
+    the projected courses all share the same key strings
+    """
+    fields = getattr(settings, 'ENROLMENT_COURSE_FIELDS', DEFAULT_ENROLMENT_COURSE_FIELDS)
+    projected = {}
+    if 'courses' in enrolments:
+        projected['courses'] = [{f: c[f] for f in fields if f in c} for c in enrolments['courses']]
+    if 'module_completions' in enrolments:
+        projected['module_completions'] = enrolments['module_completions']
+    return projected
+
+
+def _get_enrolments_cache_key(username, role):
+    return '{}:{}:{}'.format(enrolments_cache_key, role, username)
+
+
+def _get_batch_enrolled_scheduled_courses(usernames, role):
+    """
+    one http request to get all the enrolled courses for a batch of usernames
+    """
+    try:
+        response = vle.post(
+            '{}'.format(settings.BATCH_ENROLMENTS_URL),
+            json={
+                'usernames': usernames,
+                'role': role,
+            },
+            endpoint='batch_enrolments'
+        )
+    except RequestException:
+        return {}
+    if response.status_code != 200:
+        return {}
+    return {username: _project_enrolments(e) for username, e in codec.loads(response.content).items()}
+
+
+def get_scheduled_course_and_group_memberships_from_cache(vle_course_ids=None):
+    """
+    the course and group memberships, for all scheduled courses or just the given ones
+    """
+    manifest = _get_memberships_manifest()
+    return {} if manifest is None else _get_memberships_shards(manifest, vle_course_ids)
+
+
+def get_memberships(vle_course_ids=None):
+    """
+    the course and group memberships as an indexed Memberships, for all scheduled courses or just the given ones
+    the index of all the memberships is built once per process for each version of the memberships
+    """
+    global _memberships
+    manifest = _get_memberships_manifest()
+    if manifest is None:
+        return Memberships({})
+    if vle_course_ids is not None:
+        return Memberships(_get_memberships_shards(manifest, vle_course_ids))
+
+    version, memberships = _memberships
+    if version != manifest['version']:
+        memberships = Memberships(_get_memberships_shards(manifest))
+        _memberships = (manifest['version'], memberships)
+    return memberships
+
+
+def _get_memberships_manifest():
+    """
+    one cache read to get the manifest of the memberships shards
+    the memberships are cached with a soft timeout (COURSE_AND_GROUP_MEMBERSHIPS_CACHE_TIMEOUT) but kept for much
+    longer, so that the last good value is served while a single lock holder refreshes it in the background
+    """
+    cache = caches['default']
+    manifest = cache.get(course_and_group_memberships_cache_key)
+
+    # nothing cached yet, so the lock holder downloads the memberships and everyone else gets nothing
+    if manifest is None:
+        if _acquire_memberships_lock(cache):
+            manifest = _refresh_memberships(None)
+        return manifest
+
+    # refresh once the soft timeout has passed, or probabilistically just before it
+    if _should_refresh_memberships(manifest):
+        _refresh_memberships_in_background(cache, manifest)
+
+    return manifest
+
+
+def _get_memberships_shards(manifest, vle_course_ids=None):
+    """
+    one cache read to get the shards of the given scheduled courses, or two for all of them, to read which they are
+    shards never change once written, so they're read through the two-tier cache
+    """
+    everything = vle_course_ids is None
+    cached = _get_memberships_vle_course_ids(manifest) if everything else None
+    keys = {
+        _get_memberships_shard_key(manifest, vle_course_id): vle_course_id
+        for vle_course_id in ((cached or ()) if everything else vle_course_ids)
+    }
+    blobs = hot_cache.get_many(list(keys))
+
+    # scheduled courses without memberships don't have shards, so check whether any missing ones were evicted
+    missing = {vle_course_id for key, vle_course_id in keys.items() if key not in blobs}
+    if missing and not everything:
+        cached = _get_memberships_vle_course_ids(manifest)
+
+    # shards have been evicted, so serve what's left until they're downloaded again
+    if (everything or missing) and (cached is None or not missing.isdisjoint(cached)):
+        _refresh_memberships_in_background(caches['default'], manifest)
+
+    return {keys[key]: unpack_shard(blob, manifest['compression']) for key, blob in blobs.items()}
+
+
+def _get_memberships_shard_key(manifest, vle_course_id):
+    """
+    the key of a scheduled course's shard, which is at the version of the last full download unless it's been patched
+    since, so the manifest needn't list them all
+    """
+    version = manifest['patched'].get(vle_course_id, manifest['downloaded_version'])
+    return get_shard_key(course_and_group_memberships_shard_key, vle_course_id, version)
+
+
+def _get_memberships_vle_course_ids(manifest):
+    """
+    the scheduled courses with cached memberships: those in the index written with the last full download, and any
+    patched in since, or None if the index has been evicted
+    """
+    index = hot_cache.get(_get_memberships_index_key(manifest['downloaded_version']))
+    return None if index is None else set(index).union(manifest['patched'])
+
+
+def _get_memberships_index_key(version):
+    return '{}:{}'.format(course_and_group_memberships_index_key, version)
+
+
+def _should_refresh_memberships(manifest):
+    """
+    probabilistic early expiration: the closer to the soft timeout, and the slower the last download was,
+    the more likely a request is to trigger the refresh
+    """
+    beta = getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_EARLY_REFRESH_BETA', 1.0)
+    return time.time() - manifest['delta'] * beta * math.log(1.0 - random.random()) >= manifest['expires']
+
+
+def _acquire_memberships_lock(cache):
+    return cache.add(course_and_group_memberships_lock_key, True, _get_memberships_lock_timeout())
+
+
+def _get_memberships_lock_timeout():
+    """
+    COURSE_AND_GROUP_MEMBERSHIPS_LOCK_TIMEOUT, but at least as long as the download can take with all its retries (and
+    a minute to cache it), so the lock can't expire and let another download start alongside
+    """
+    return max(
+        getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_LOCK_TIMEOUT', 300),
+        math.ceil(get_max_duration('memberships')) + 60,
     )
-    return response.json() if response.status_code == 200 else {}
 
 
-def get_scheduled_course_and_group_memberships_from_cache():
+def _refresh_memberships_in_background(cache, manifest):
+    if _acquire_memberships_lock(cache):
+        threading.Thread(target=_refresh_memberships, args=(manifest,), daemon=True).start()
+
+
+def _refresh_memberships(manifest):
+    """
+    download the memberships and cache them, releasing the lock afterwards
+    on failure the last good manifest (if any) is kept, and retried after COURSE_AND_GROUP_MEMBERSHIPS_RETRY_TIMEOUT
+    """
     cache = caches['default']
-    if cache.get(course_and_group_memberships_cache_key) is None:
-        response = requests.get(
-            '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL)
-        )
-        if response.status_code == 200:
-            cache.set(
-                course_and_group_memberships_cache_key,
-                response.json(),
-                settings.COURSE_AND_GROUP_MEMBERSHIPS_CACHE_TIMEOUT
-                if hasattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_CACHE_TIMEOUT')
-                else 21600
+    try:
+        start = time.time()
+        try:
+            response = vle.get(
+                '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL),
+                endpoint='memberships'
             )
-    data = cache.get(course_and_group_memberships_cache_key)
-    return {} if data is None else data
+            data = codec.loads(response.content) if response.status_code == 200 else None
+        except (RequestException, ValueError):
+            data = None
+        # anything but {vle_course_id: {...}, ...} isn't understood
+        if not isinstance(data, dict):
+            data = None
+        now = time.time()
 
+        if data is not None:
+            sequence = _get_memberships_sequence(response)
+            return _cache_memberships(data, now + _get_memberships_timeout(), now - start, sequence)
 
-def _filter_master_courses(user_enrolled_scheduled_course, programme_id, master_course_ids):
-    vle_course_ids = list(map(
-        lambda pmc: pmc.master_course.vle_course_id,
-        filter(
-            lambda pmc: pmc.programme.id == programme_id,
-            master_course_ids
-        ),
-    ))
-    return user_enrolled_scheduled_course['masteridnumber'] in vle_course_ids
+        # keep the last good manifest, but not for longer than its shards
+        if manifest is not None:
+            timeout = _get_memberships_stale_timeout() - (now - manifest['downloaded'])
+            if timeout > 0:
+                manifest = dict(manifest, expires=now + getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_RETRY_TIMEOUT', 300))
+                cache.set(course_and_group_memberships_cache_key, manifest, timeout)
+        return manifest
+    finally:
+        cache.delete(course_and_group_memberships_lock_key)
 
 
-def _set_user_ids(users):
-    ids = get_user_model().objects. \
-        filter(username__in=[u['username'] for u in users]). \
-        values_list('username', 'id')
-    ids = {u[0]: u[1] for u in ids}
+def _cache_memberships(data, expires, delta=0.0, sequence=None):
+    """
+    cache the memberships as one compressed shard per scheduled course, then flip the manifest over to them
+    the previous shards are kept just long enough for any requests still reading them
+    sequence is the VLE's membership changes sequence number to read changes from next, or None if it's not known, in
+    which case the next refresh downloads everything again
+    """
+    cache = caches['default']
+    now = time.time()
+    with _memberships_patch_lock(cache) as locked:
+        previous = cache.get(course_and_group_memberships_cache_key)
+
+        # can't write safely while a patch is, so keep what's cached, and have the next request download again
+        if not locked:
+            return previous
+
+        version = max(int(now * 1000), previous['version'] + 1 if previous else 0)
+        manifest = {
+            'version': version,
+            'downloaded_version': version,
+            'patched': {},
+            'compression': SHARD_COMPRESSION,
+            'downloaded': now,
+            'expires': expires,
+            'delta': delta,
+            'sequence': sequence,
+        }
+        blobs = {
+            _get_memberships_shard_key(manifest, vle_course_id): pack_shard(course)
+            for vle_course_id, course in data.items()
+        }
+        blobs[_get_memberships_index_key(version)] = list(data)
+        hot_cache.set_many(blobs, _get_memberships_stale_timeout())
+        cache.set(course_and_group_memberships_cache_key, manifest, _get_memberships_stale_timeout())
+
+    if previous is not None:
+        previous_vle_course_ids = _get_memberships_vle_course_ids(previous) or ()
+        _expire_memberships_shards(cache, [_get_memberships_index_key(previous['downloaded_version'])] + [
+            _get_memberships_shard_key(previous, vle_course_id) for vle_course_id in previous_vle_course_ids
+        ])
+
+    return manifest
+
+
+def _get_memberships_sequence(response):
+    """
+    the VLE's membership changes sequence number that a full download is as of, from the MEMBERSHIPS_SEQUENCE_HEADER
+    header, so the changes feed is always read in the VLE's own units, or None if it's missing
+    """
+    sequence = response.headers.get(getattr(settings, 'MEMBERSHIPS_SEQUENCE_HEADER', 'X-Membership-Sequence'))
+    return int(sequence) if isinstance(sequence, str) and sequence.isdigit() else None
+
+
+def patch_memberships(vle_course_id, change):
+    """
+    apply a change to the cached memberships of one scheduled course, rather than downloading them all again
+    change is called with the scheduled course's memberships and should update them in place (see memberships.py)
+    """
+    _patch_memberships({vle_course_id: [change]})
+
+
+def patch_many_memberships(changes):
+    """
+    apply lists of changes, keyed by scheduled course vle_course_id, to the cached memberships in one go
+    """
+    if changes:
+        _patch_memberships(changes)
+
+
+def refresh_memberships_from_changes():
+    """
+    apply the VLE's membership changes since the last refresh (MEMBERSHIP_CHANGES_URL) to the cached memberships
+    downloads all the memberships instead if there are none cached, if the VLE didn't say which change they're as of,
+    if the changes can't be read, or if the last full download is older than
+    COURSE_AND_GROUP_MEMBERSHIPS_RECONCILE_INTERVAL
+    """
+    cache = caches['default']
+    manifest = cache.get(course_and_group_memberships_cache_key)
+    reconcile = manifest is None \
+        or manifest.get('sequence') is None \
+        or not getattr(settings, 'MEMBERSHIP_CHANGES_URL', None) \
+        or time.time() - manifest['downloaded'] >= getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_RECONCILE_INTERVAL', 86400)
+
+    feed = None
+    if not reconcile:
+        try:
+            response = vle.get(
+                '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIP_CHANGES_URL),
+                params={
+                    'since': manifest['sequence'],
+                },
+                endpoint='membership_changes'
+            )
+            feed = codec.loads(response.content) if response.status_code == 200 else None
+            # anything but {"sequence": ..., "changes": [{...}, ...]} isn't understood
+            if not isinstance(feed, dict) or not isinstance(feed.get('changes'), list):
+                feed = None
+            else:
+                changes, sequence = _group_membership_changes(feed['changes']), feed['sequence']
+        except (RequestException, ValueError, KeyError, TypeError):
+            feed = None
+
+    if feed is None:
+        if not _acquire_memberships_lock(cache):
+            return _('Memberships are already being downloaded')
+        _refresh_memberships(manifest)
+        return _('Memberships downloaded')
+
+    _patch_memberships(changes, sequence=sequence, expires=time.time() + _get_memberships_timeout())
+    return _('Memberships updated')
+
+
+def _group_membership_changes(feed_changes):
+    """
+    the changes from the feed as lists of functions to apply, by scheduled course
+    """
+    changes = defaultdict(list)
+    for change in feed_changes:
+        changes[change['vle_course_id']].append(get_membership_change(change))
+    return changes
+
+
+def _patch_memberships(changes, **updates):
+    """
+    apply lists of changes to the cached memberships of some scheduled courses, updating the manifest with any updates
+    the patched shards are written under a new version and the manifest flipped to them, so readers never see half a
+    set of changes
+    """
+    cache = caches['default']
+    with _memberships_patch_lock(cache) as locked:
+        manifest = cache.get(course_and_group_memberships_cache_key)
+        if manifest is None:
+            return
+
+        keys = {vle_course_id: _get_memberships_shard_key(manifest, vle_course_id) for vle_course_id in changes}
+        blobs = hot_cache.get_many(list(keys.values()))
+
+        # scheduled courses without shards are new, unless their shards have been evicted
+        missing = {vle_course_id for vle_course_id, key in keys.items() if key not in blobs}
+        cached = _get_memberships_vle_course_ids(manifest) if missing else ()
+
+        # can't patch safely, so have the next request download everything again instead
+        timeout = _get_memberships_stale_timeout() - (time.time() - manifest['downloaded'])
+        if not locked or timeout <= 0 or cached is None or not missing.isdisjoint(cached):
+            cache.set(course_and_group_memberships_cache_key, dict(manifest, expires=0), max(timeout, 1))
+            return
+
+        version = manifest['version'] + 1
+        patched = dict(manifest['patched'])
+        patched_blobs = {}
+        for vle_course_id, course_changes in changes.items():
+            blob = blobs.get(keys[vle_course_id])
+            course = {'members': [], 'groups': {}} if blob is None else unpack_shard(blob, manifest['compression'])
+            for change in course_changes:
+                change(course)
+            patched[vle_course_id] = version
+            key = get_shard_key(course_and_group_memberships_shard_key, vle_course_id, version)
+            patched_blobs[key] = pack_shard(course, manifest['compression'])
+        patched_manifest = dict(manifest, version=version, patched=patched, **updates)
+
+        hot_cache.set_many(patched_blobs, timeout)
+        cache.set(course_and_group_memberships_cache_key, patched_manifest, timeout)
+
+    _expire_memberships_shards(cache, blobs.keys())
+
+
+@contextmanager
+def _memberships_patch_lock(cache):
+    """
+    serialise changes to the manifest, waiting up to COURSE_AND_GROUP_MEMBERSHIPS_PATCH_LOCK_WAIT seconds
+    yields whether the lock was acquired
+    """
+    deadline = time.time() + getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_PATCH_LOCK_WAIT', 2)
+    locked = cache.add(course_and_group_memberships_patch_lock_key, True, 30)
+    while not locked and time.time() < deadline:
+        time.sleep(0.05)
+        locked = cache.add(course_and_group_memberships_patch_lock_key, True, 30)
+    try:
+        yield locked
+    finally:
+        if locked:
+            cache.delete(course_and_group_memberships_patch_lock_key)
+
+
+def _expire_memberships_shards(cache, keys):
+    for key in keys:
+        cache.touch(key, getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_SHARD_GRACE_TIMEOUT', 60))
+
+
+def _get_memberships_timeout():
+    return getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_CACHE_TIMEOUT', 21600)
 
-    for u in users:
-        u['id'] = ids.get(u['username'], None)
 
-    return users
+def _get_memberships_stale_timeout():
+    return getattr(settings, 'COURSE_AND_GROUP_MEMBERSHIPS_STALE_TIMEOUT', 604800)
+
+
+def _get_vle_course_ids_by_programme(programme_master_courses):
+    vle_course_ids = defaultdict(set)
+    for pmc in programme_master_courses:
+        vle_course_ids[pmc.programme.id].add(pmc.master_course.vle_course_id)
+    return vle_course_ids
+
+
+def _get_programmes(user_programmes, vle_course_ids, user_enrolled_scheduled_courses):
+    return [{
+        'id': up.programme.id,
+        'display_name': up.programme.display_name,
+        'courses': [
+            c for c in user_enrolled_scheduled_courses.get('courses', [])
+            if c['masteridnumber'] in vle_course_ids.get(up.programme.id, ())
+        ],
+    } for up in user_programmes]
+
+
+def get_user_ids(usernames):
+    """
+    user ids for the given usernames, as a dict with None for unknown usernames
+    looks in a process-local LRU, then the shared cache, then the database in chunks of USER_IDS_QUERY_CHUNK_SIZE
+    """
+    usernames = set(usernames)
+    ids = {}
+
+    # process-local cache (which only holds known usernames, and only for USER_IDS_LRU_TIMEOUT, as it can't be
+    # invalidated by other processes)
+    misses = []
+    for username in usernames:
+        user_id = _user_ids.get(username)
+        if user_id is None:
+            misses.append(username)
+        else:
+            ids[username] = user_id
+
+    # shared cache (where unknown usernames are cached as 0)
+    if misses:
+        cache = caches['default']
+        keys = {_get_user_id_cache_key(username): username for username in misses}
+        cached = cache.get_many(list(keys))
+        ids.update({keys[key]: user_id for key, user_id in cached.items()})
+        misses = [username for key, username in keys.items() if key not in cached]
+
+    # database
+    if misses:
+        chunk_size = getattr(settings, 'USER_IDS_QUERY_CHUNK_SIZE', 500)
+        found = {}
+        for i in range(0, len(misses), chunk_size):
+            found.update(
+                get_user_model().objects.filter(username__in=misses[i:i + chunk_size]).values_list('username', 'id')
+            )
+        cache.set_many(
+            {_get_user_id_cache_key(username): found.get(username, 0) for username in misses},
+            getattr(settings, 'USER_IDS_CACHE_TIMEOUT', 86400)
+        )
+        ids.update(found)
+
+    for username, user_id in ids.items():
+        if user_id:
+            _user_ids.set(username, user_id)
+
+    return {username: ids.get(username) or None for username in usernames}
+
+
+def invalidate_user_id(username):
+    """
+    forget the cached id of a username, e.g. when a user with that username is created
+    """
+    _user_ids.delete(username)
+    caches['default'].delete(_get_user_id_cache_key(username))
+
+
+def _get_user_id_cache_key(username):
+    return '{}:{}'.format(user_id_cache_key, username)
+
+
+def _set_user_ids(users):
+    ids = get_user_ids([u['username'] for u in users])
+    return [dict(u, id=ids.get(u['username'], None)) for u in users]
@@ -0,0 +1,97 @@
+import csv
+
+from django.conf import settings
+
+from . import codec
+from .models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+
+MASTER_COURSE_COLUMNS = ['vle_course_id', 'display_name', 'compulsory', 'credits', 'commitment', 'weeks_duration']
+SCHEDULED_COURSE_COLUMNS = ['vle_course_id', 'display_name', 'open_date', 'start_date', 'end_date', 'close_date']
+GROUP_COLUMNS = ['vle_group_id', 'display_name']
+
+# one row per group, or per scheduled course or master course with none, like a left join of the three
+COLUMNS = ['master_' + c for c in MASTER_COURSE_COLUMNS] \
+    + ['scheduled_' + c for c in SCHEDULED_COURSE_COLUMNS] \
+    + ['group_' + c for c in GROUP_COLUMNS]
+
+CONTENT_TYPES = {
+    'ndjson': 'application/x-ndjson',
+    'csv': 'text/csv',
+}
+
+
+def iter_catalogue(chunk_size=None):
+    """
+    yield the whole catalogue as tuples of COLUMNS, without holding more than a few chunks of it in memory
+    each level is read by one query, ordered by its parent's key, and they're merged like a merge join, so there are
+    three queries however big the catalogue is
+    """
+    chunk_size = chunk_size or getattr(settings, 'PROGRAMMES_EXPORT_CHUNK_SIZE', 2000)
+    masters = MasterCourse.objects.order_by('pk').values_list('pk', *MASTER_COURSE_COLUMNS).iterator(chunk_size)
+    scheduled = ScheduledCourse.objects.order_by('master_course_id', 'pk') \
+        .values_list('master_course_id', 'pk', *SCHEDULED_COURSE_COLUMNS).iterator(chunk_size)
+    groups = ScheduledCourseGroup.objects.order_by('scheduled_course__master_course_id', 'scheduled_course_id', 'pk') \
+        .values_list('scheduled_course__master_course_id', 'scheduled_course_id', *GROUP_COLUMNS).iterator(chunk_size)
+
+    no_scheduled = (None,) * len(SCHEDULED_COURSE_COLUMNS)
+    no_group = (None,) * len(GROUP_COLUMNS)
+    s = next(scheduled, None)
+    g = next(groups, None)
+    for m in masters:
+        # skip children of master courses deleted since the masters query ran
+        while s is not None and s[0] < m[0]:
+            s = next(scheduled, None)
+        while g is not None and g[0] < m[0]:
+            g = next(groups, None)
+
+        if s is None or s[0] != m[0]:
+            yield m[1:] + no_scheduled + no_group
+            continue
+
+        while s is not None and s[0] == m[0]:
+            while g is not None and g[0] == m[0] and g[1] < s[1]:
+                g = next(groups, None)
+            if g is None or g[:2] != s[:2]:
+                yield m[1:] + s[2:] + no_group
+            while g is not None and g[:2] == s[:2]:
+                yield m[1:] + s[2:] + g[2:]
+                g = next(groups, None)
+            s = next(scheduled, None)
+
+
+def to_ndjson(rows):
+    """
+    yield rows as lines of JSON objects
+    """
+    for row in rows:
+        yield codec.dumps({c: _to_json(v) for c, v in zip(COLUMNS, row)}) + b'\n'
+
+
+def to_csv(rows):
+    """
+    yield a header line then rows as lines of CSV
+    """
+    buffer = _Echo()
+    writer = csv.writer(buffer)
+    yield writer.writerow(COLUMNS)
+    for row in rows:
+        yield writer.writerow(row)
+
+
+FORMATS = {
+    'ndjson': to_ndjson,
+    'csv': to_csv,
+}
+
+
+def _to_json(value):
+    return value.isoformat() if hasattr(value, 'isoformat') else value
+
+
+class _Echo(object):
+    """
+    a file-like object for csv.writer that returns what's written rather than buffering it
+    """
+
+    def write(self, value):
+        return value
@@ -0,0 +1,108 @@
+import asyncio
+import hashlib
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from django.http.response import HttpResponse
+from django.utils.translation import gettext as _
+
+from . import codec
+
+idempotency_cache_key = 'programmes_idempotency'
+_in_flight = 'in_flight'
+
+
+def idempotent(view):
+    """
+    let clients safely retry a request by sending the same Idempotency-Key header with it
+    the first response (unless it's a 5xx) is stored for PROGRAMMES_IDEMPOTENCY_TIMEOUT seconds and returned for
+    any retry without calling the view again; a retry while the first request is still being handled gets a 409, and
+    reusing a key for a different request gets a 422
+    requests without the header are handled as usual
+    works for both sync and async views
+    """
+    if asyncio.iscoroutinefunction(view):
+        @wraps(view)
+        async def async_wrapper(request, *args, **kwargs):
+            if not request.META.get('HTTP_IDEMPOTENCY_KEY'):
+                return await view(request, *args, **kwargs)
+
+            cache_key, fingerprint, stored = await sync_to_async(_claim)(request)
+            if stored is not None:
+                return stored
+            try:
+                response = await view(request, *args, **kwargs)
+            except Exception:
+                await sync_to_async(caches['default'].delete)(cache_key)
+                raise
+            await sync_to_async(_store)(cache_key, fingerprint, response)
+            return response
+
+        return async_wrapper
+
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not request.META.get('HTTP_IDEMPOTENCY_KEY'):
+            return view(request, *args, **kwargs)
+
+        cache_key, fingerprint, stored = _claim(request)
+        if stored is not None:
+            return stored
+        try:
+            response = view(request, *args, **kwargs)
+        except Exception:
+            caches['default'].delete(cache_key)
+            raise
+        _store(cache_key, fingerprint, response)
+        return response
+
+    return wrapper
+
+
+def _claim(request):
+    """
+    claim the request's key, returning its cache key and the request's fingerprint, and the response to return
+    instead of calling the view if the key has been used already
+    """
+    cache = caches['default']
+    cache_key = _get_cache_key(request.path, request.META['HTTP_IDEMPOTENCY_KEY'])
+    fingerprint = hashlib.md5(request.body).hexdigest()
+
+    if not cache.add(cache_key, (_in_flight, fingerprint), getattr(settings, 'PROGRAMMES_IDEMPOTENCY_LOCK_TIMEOUT', 60)):
+        stored = cache.get(cache_key)
+        if stored is not None:
+            if stored[1] != fingerprint:
+                return cache_key, fingerprint, _error(_('Idempotency-Key has already been used for a different request'), 422)
+            if stored[0] == _in_flight:
+                return cache_key, fingerprint, _error(_('A request with this Idempotency-Key is already in progress'), 409)
+            status, content, content_type = stored[2:]
+            return cache_key, fingerprint, HttpResponse(content, content_type=content_type, status=status)
+
+    return cache_key, fingerprint, None
+
+
+def _store(cache_key, fingerprint, response):
+    """
+    store the response for retries, or release the key for them to try again if it's a 5xx
+    """
+    cache = caches['default']
+    if response.status_code >= 500:
+        cache.delete(cache_key)
+    else:
+        cache.set(
+            cache_key,
+            ('done', fingerprint, response.status_code, response.content, response['Content-Type']),
+            getattr(settings, 'PROGRAMMES_IDEMPOTENCY_TIMEOUT', 86400),
+        )
+
+
+def _get_cache_key(path, key):
+    return '{}:{}'.format(idempotency_cache_key, hashlib.md5('{}:{}'.format(path, key).encode('utf-8')).hexdigest())
+
+
+def _error(msg, status):
+    return HttpResponse(codec.dumps({
+        'errorMessage': msg
+    }), content_type='application/json', status=status)
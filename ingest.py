@@ -0,0 +1,73 @@
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.db import DatabaseError, transaction
+
+from . import codec
+from .batch import apply_operations
+from .models import QueuedOperation
+
+
+# what a bad operation can raise, which rolls back its batch (ProtectedError and IntegrityError are DatabaseErrors)
+APPLY_ERRORS = (DatabaseError, ValueError, ValidationError)
+
+
+def is_async():
+    """
+    whether the JSON API should queue requests for drain() rather than applying them straight away
+    """
+    return getattr(settings, 'PROGRAMMES_API_ASYNC_INGEST', False)
+
+
+def enqueue(operations):
+    """
+    queue a list of (operation, data) pairs to be applied in order
+    """
+    QueuedOperation.objects.bulk_create([
+        QueuedOperation(operation=operation, payload=codec.dumps(data).decode('utf-8'))
+        for operation, data in operations
+    ])
+
+
+def drain(batch_size=None):
+    """
+    apply queued operations, oldest first, batch_size (PROGRAMMES_API_INGEST_BATCH_SIZE) at a time, until none are left
+    each batch goes through the batch applier, so any number of updates to the same course or group become one write
+    operations that fail are kept, with their error, rather than retried
+    returns the number of operations applied and failed
+    """
+    batch_size = batch_size or getattr(settings, 'PROGRAMMES_API_INGEST_BATCH_SIZE', 500)
+    applied = failed = 0
+    while True:
+        with transaction.atomic():
+            # wait for any other worker's batch, rather than skipping it, as later operations can depend on earlier
+            # ones (e.g. an update on a create), so must be applied strictly in order
+            queued = list(QueuedOperation.objects.select_for_update().filter(error='').order_by('pk')[:batch_size])
+            if not queued:
+                return applied, failed
+
+            errors = _apply(queued)
+            QueuedOperation.objects.filter(pk__in=[q.pk for q in queued if q.pk not in errors]).delete()
+            for pk, error in errors.items():
+                QueuedOperation.objects.filter(pk=pk).update(error=error[:255])
+
+        applied += len(queued) - len(errors)
+        failed += len(errors)
+
+
+def _apply(queued):
+    """
+    apply some queued operations, returning {pk: error} for those that failed
+    """
+    operations = [{'operation': q.operation, 'data': codec.loads(q.payload)} for q in queued]
+    try:
+        results = apply_operations(operations)
+    except APPLY_ERRORS:
+        # one operation is rolling the lot back, so apply them one at a time to find it
+        results = []
+        for operation in operations:
+            try:
+                results.extend(apply_operations([operation]))
+            except APPLY_ERRORS as e:
+                results.append({'errorMessage': str(e.args[0]) if e.args else repr(e)})
+
+    return {q.pk: result['errorMessage'] for q, result in zip(queued, results) if 'errorMessage' in result}
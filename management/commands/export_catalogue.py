@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from programmes.export import FORMATS, iter_catalogue
+
+
+class Command(BaseCommand):
+    help = 'Stream every master course, scheduled course and group, one row per group, as ndjson or csv'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--format', choices=sorted(FORMATS), default='ndjson')
+        parser.add_argument('--output', help='file to write to (default: stdout)')
+        parser.add_argument('--chunk-size', type=int, help='rows fetched at a time (default: PROGRAMMES_EXPORT_CHUNK_SIZE)')
+
+    def handle(self, *args, **options):
+        lines = FORMATS[options['format']](iter_catalogue(options['chunk_size']))
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8', newline='') as f:
+                for line in lines:
+                    f.write(_to_str(line))
+        else:
+            for line in lines:
+                self.stdout.write(_to_str(line), ending='')
+
+
+def _to_str(line):
+    return line.decode('utf-8') if isinstance(line, bytes) else line
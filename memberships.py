@@ -0,0 +1,171 @@
+import hashlib
+import zlib
+from array import array
+from functools import partial
+from sys import intern
+
+try:
+    import lz4.frame
+except ImportError:
+    lz4 = None
+
+from . import codec
+
+# cached shards are compressed with lz4 if it's installed, otherwise zlib
+SHARD_COMPRESSION = 'lz4' if lz4 is not None else 'zlib'
+
+
+class Memberships(object):
+    """
+    indexed course and group memberships, built from the VLE memberships blob, which looks like
+
+        {
+            "<scheduled course vle_course_id>": {
+                "members": ["<username>", ...],
+                "groups": {
+                    "<vle_group_id>": ["<username>", ...],
+                },
+            },
+        }
+
+    usernames and ids are interned, users are numbered, and member lists are stored as arrays of user numbers,
+    so lookups cost the same whatever the size of the blob
+    groups are identified by (vle_course_id, vle_group_id), as a vle_group_id is only unique within its scheduled course
+    """
+    __slots__ = ('_usernames', '_user_numbers', '_course_members', '_group_members', '_user_groups')
+
+    def __init__(self, data):
+        self._usernames = []
+        self._user_numbers = {}
+        self._course_members = {}
+        self._group_members = {}
+        user_groups = {}
+
+        for vle_course_id, course in data.items():
+            self._course_members[intern(vle_course_id)] = self._numbers(course.get('members', []))
+            for vle_group_id, usernames in course.get('groups', {}).items():
+                group = (intern(vle_course_id), intern(vle_group_id))
+                members = self._numbers(usernames)
+                self._group_members[group] = members
+                for n in members:
+                    user_groups.setdefault(n, set()).add(group)
+
+        self._user_groups = {n: frozenset(groups) for n, groups in user_groups.items()}
+
+    def _numbers(self, usernames):
+        numbers = array('L')
+        for username in usernames:
+            n = self._user_numbers.get(username)
+            if n is None:
+                username = intern(username)
+                n = self._user_numbers[username] = len(self._usernames)
+                self._usernames.append(username)
+            numbers.append(n)
+        return numbers
+
+    def members_of(self, vle_course_id):
+        """
+        usernames of the members of a scheduled course
+        """
+        return [self._usernames[n] for n in self._course_members.get(vle_course_id, ())]
+
+    def group_members_of(self, vle_course_id, vle_group_id):
+        """
+        usernames of the members of a scheduled course's group
+        """
+        return [self._usernames[n] for n in self._group_members.get((vle_course_id, vle_group_id), ())]
+
+    def groups_of(self, username):
+        """
+        the groups a user is in, as (vle_course_id, vle_group_id) pairs
+        """
+        n = self._user_numbers.get(username)
+        return self._user_groups.get(n, frozenset())
+
+    def is_member(self, username, vle_course_id, vle_group_id):
+        return (vle_course_id, vle_group_id) in self.groups_of(username)
+
+    def __len__(self):
+        return len(self._course_members)
+
+
+def get_shard_key(prefix, vle_course_id, version):
+    """
+    cache key for the shard of a scheduled course at a given version, hashed to be safe for memcached
+    """
+    return '{}:{}:{}'.format(prefix, hashlib.md5(vle_course_id.encode('utf-8')).hexdigest(), version)
+
+
+def pack_shard(course, compression=SHARD_COMPRESSION):
+    data = codec.dumps(course)
+    return lz4.frame.compress(data) if compression == 'lz4' else zlib.compress(data)
+
+
+def unpack_shard(blob, compression):
+    data = lz4.frame.decompress(blob) if compression == 'lz4' else zlib.decompress(blob)
+    return codec.loads(data)
+
+
+def add_group(course, vle_group_id):
+    course.setdefault('groups', {}).setdefault(vle_group_id, [])
+
+
+def rename_group(course, old_vle_group_id, vle_group_id):
+    groups = course.setdefault('groups', {})
+    groups[vle_group_id] = groups.pop(old_vle_group_id, [])
+
+
+def remove_group(course, vle_group_id):
+    course.get('groups', {}).pop(vle_group_id, None)
+
+
+def add_member(course, username, vle_group_id=None):
+    """
+    add a user to a scheduled course, and to one of its groups if given
+    """
+    members = course.setdefault('members', [])
+    if username not in members:
+        members.append(username)
+    if vle_group_id:
+        group = course.setdefault('groups', {}).setdefault(vle_group_id, [])
+        if username not in group:
+            group.append(username)
+
+
+def remove_member(course, username, vle_group_id=None):
+    """
+    remove a user from one group of a scheduled course if given, otherwise from the course and all its groups
+    """
+    groups = course.get('groups', {})
+    if vle_group_id:
+        groups[vle_group_id] = [u for u in groups.get(vle_group_id, []) if u != username]
+        return
+    course['members'] = [u for u in course.get('members', []) if u != username]
+    for vle_group_id in groups:
+        groups[vle_group_id] = [u for u in groups[vle_group_id] if u != username]
+
+
+def get_membership_change(change):
+    """
+    the function to apply a change from the VLE's membership changes feed, which look like
+
+        {"type": "member_added", "vle_course_id": "...", "username": "...", "vle_group_id": "..."}
+        {"type": "member_removed", "vle_course_id": "...", "username": "...", "vle_group_id": "..."}
+        {"type": "group_added", "vle_course_id": "...", "vle_group_id": "..."}
+        {"type": "group_renamed", "vle_course_id": "...", "old_vle_group_id": "...", "vle_group_id": "..."}
+        {"type": "group_removed", "vle_course_id": "...", "vle_group_id": "..."}
+
+    where vle_group_id is optional for members; raises KeyError for anything else
+    """
+    change_type = change['type']
+    if change_type == 'member_added':
+        return partial(add_member, username=change['username'], vle_group_id=change.get('vle_group_id'))
+    if change_type == 'member_removed':
+        return partial(remove_member, username=change['username'], vle_group_id=change.get('vle_group_id'))
+    if change_type == 'group_added':
+        return partial(add_group, vle_group_id=change['vle_group_id'])
+    if change_type == 'group_renamed':
+        return partial(rename_group, old_vle_group_id=change['old_vle_group_id'], vle_group_id=change['vle_group_id'])
+    if change_type == 'group_removed':
+        return partial(remove_group, vle_group_id=change['vle_group_id'])
+    raise KeyError(change_type)
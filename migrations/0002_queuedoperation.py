@@ -0,0 +1,23 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:45
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('programmes', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='QueuedOperation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('operation', models.CharField(max_length=50, verbose_name='operation')),
+                ('payload', models.TextField(verbose_name='payload')),
+                ('created', models.DateTimeField(auto_now_add=True, verbose_name='created')),
+                ('error', models.CharField(blank=True, max_length=255, verbose_name='error')),
+            ],
+        ),
+    ]
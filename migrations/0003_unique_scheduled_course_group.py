@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:46
+
+from django.db import migrations, models
+
+
+def delete_duplicate_groups(apps, schema_editor):
+    """
+    keep the first of any groups with the same scheduled course and vle_group_id
+    """
+    ScheduledCourseGroup = apps.get_model('programmes', 'ScheduledCourseGroup')
+    duplicates = ScheduledCourseGroup.objects.values('scheduled_course', 'vle_group_id') \
+        .annotate(first=models.Min('pk'), count=models.Count('pk')).filter(count__gt=1)
+    for duplicate in duplicates:
+        ScheduledCourseGroup.objects.filter(
+            scheduled_course=duplicate['scheduled_course'],
+            vle_group_id=duplicate['vle_group_id'],
+        ).exclude(pk=duplicate['first']).delete()
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('programmes', '0002_queuedoperation'),
+    ]
+
+    operations = [
+        migrations.RunPython(delete_duplicate_groups, migrations.RunPython.noop),
+        migrations.AddConstraint(
+            model_name='scheduledcoursegroup',
+            constraint=models.UniqueConstraint(fields=('scheduled_course', 'vle_group_id'), name='unique_scheduled_course_group'),
+        ),
+    ]
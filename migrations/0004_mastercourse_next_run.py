@@ -0,0 +1,39 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:51
+
+from datetime import datetime
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def populate_next_runs(apps, schema_editor):
+    MasterCourse = apps.get_model('programmes', 'MasterCourse')
+    ScheduledCourse = apps.get_model('programmes', 'ScheduledCourse')
+    next_runs = ScheduledCourse.objects \
+        .filter(master_course=models.OuterRef('pk'), start_date__gte=datetime.today().date()) \
+        .order_by('start_date', 'pk')
+    MasterCourse.objects.update(
+        next_start_date=models.Subquery(next_runs.values('start_date')[:1]),
+        next_run=models.Subquery(next_runs.values('pk')[:1]),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('programmes', '0003_unique_scheduled_course_group'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='mastercourse',
+            name='next_run',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='programmes.scheduledcourse', verbose_name='next run'),
+        ),
+        migrations.AddField(
+            model_name='mastercourse',
+            name='next_start_date',
+            field=models.DateField(blank=True, db_index=True, editable=False, null=True, verbose_name='next start date'),
+        ),
+        migrations.RunPython(populate_next_runs, migrations.RunPython.noop),
+    ]
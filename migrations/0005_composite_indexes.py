@@ -0,0 +1,25 @@
+# Generated by Django 3.2.25 on 2026-10-19 06:59
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('programmes', '0004_mastercourse_next_run'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='programmemastercourse',
+            index=models.Index(fields=['programme', 'available', 'display_order'], name='programmecourse_available'),
+        ),
+        migrations.AddIndex(
+            model_name='scheduledcourse',
+            index=models.Index(fields=['master_course', 'start_date'], name='scheduledcourse_master_start'),
+        ),
+        migrations.AddIndex(
+            model_name='userprogramme',
+            index=models.Index(fields=['programme', 'user'], name='userprogramme_programme_user'),
+        ),
+    ]
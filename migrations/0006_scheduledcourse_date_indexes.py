@@ -0,0 +1,28 @@
+# Generated by Django 3.2.25 on 2026-10-19 07:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('programmes', '0005_composite_indexes'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='scheduledcourse',
+            name='close_date',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='close date'),
+        ),
+        migrations.AlterField(
+            model_name='scheduledcourse',
+            name='end_date',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='end (complete) date'),
+        ),
+        migrations.AlterField(
+            model_name='scheduledcourse',
+            name='start_date',
+            field=models.DateField(blank=True, db_index=True, null=True, verbose_name='start date'),
+        ),
+    ]
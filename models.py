@@ -1,29 +1,68 @@
-from datetime import datetime
+from datetime import datetime, timedelta
 
 from django.conf import settings
 from django.db import models
+from django.dispatch import Signal
 from django.utils.translation import gettext_lazy as _
 
+# sent by MasterCourseQuerySet.update_next_runs, which saves no instances, with the number of master courses it updated
+# and the ids of their programmes
+next_runs_updated = Signal()
+
+
+class ProgrammeQuerySet(models.QuerySet):
+
+    def with_stage_count(self):
+        """
+        annotate annotated_stage_count, which stage_count then uses rather than counting per programme
+        """
+        return self.annotate(annotated_stage_count=models.Count('stage', distinct=True))
+
+    def with_master_course_count(self):
+        """
+        annotate annotated_master_course_count, which master_course_count then uses rather than counting per programme
+        """
+        return self.annotate(annotated_master_course_count=models.Count('programmemastercourse', distinct=True))
+
 
 class Programme(models.Model):
     display_name = models.CharField(_('Display name'), max_length=100)
 
+    objects = ProgrammeQuerySet.as_manager()
+
     def stage_count(self):
+        if hasattr(self, 'annotated_stage_count'):
+            return self.annotated_stage_count
         return self.stage_set.count()
     stage_count.short_description = _('Number of stages')
+    stage_count.admin_order_field = 'annotated_stage_count'
 
     def master_course_count(self):
+        if hasattr(self, 'annotated_master_course_count'):
+            return self.annotated_master_course_count
         return self.programmemastercourse_set.count()
     master_course_count.short_description = _('Number of master courses')
+    master_course_count.admin_order_field = 'annotated_master_course_count'
 
     def __str__(self):
         return self.display_name
 
 
+class UserProgrammeQuerySet(models.QuerySet):
+
+    def with_related(self):
+        """
+        select what __str__ uses
+        """
+        return self.select_related('user', 'programme')
+
+
 class UserProgramme(models.Model):
     user = models.ForeignKey(settings.AUTH_USER_MODEL, on_delete=models.CASCADE)
     programme = models.ForeignKey(Programme, on_delete=models.CASCADE)
 
+    objects = UserProgrammeQuerySet.as_manager()
+
     def __str__(self):
         return '"{} {}" is a member of programme "{}"'.format(
             self.user.first_name,
@@ -33,6 +72,10 @@ class UserProgramme(models.Model):
 
     class Meta:
         unique_together = ('user', 'programme',)
+        indexes = [
+            # the unique index leads with user, this is for a programme's members
+            models.Index(fields=['programme', 'user'], name='userprogramme_programme_user'),
+        ]
 
 
 class Stage(models.Model):
@@ -42,7 +85,16 @@ class Stage(models.Model):
 
     @property
     def courses_available(self):
-        return self.programmemastercourse_set.filter(available=True).order_by('display_order')
+        """
+        the programme's available master courses, as master courses aren't assigned to stages
+        uses those get_programme_structure prefetched, if it did
+        """
+        if hasattr(self.programme, 'available_courses'):
+            return self.programme.available_courses
+        return self.programme.programmemastercourse_set \
+            .filter(available=True) \
+            .select_related('master_course') \
+            .order_by('display_order', 'master_course__display_name')
 
     def __str__(self):
         return self.display_name
@@ -51,6 +103,33 @@ class Stage(models.Model):
         unique_together = ('programme', 'stage_order',)
 
 
+class MasterCourseQuerySet(models.QuerySet):
+
+    def update_next_runs(self, today=None):
+        """
+        recompute next_run and next_start_date, from each course's first scheduled course starting today or later,
+        with one update, then send next_runs_updated
+        """
+        # before updating, as the update can change which courses this queryset matches
+        programme_ids = None
+        if next_runs_updated.has_listeners(self.model):
+            programme_ids = list(ProgrammeMasterCourse.objects
+                                 .filter(master_course__in=self)
+                                 .values_list('programme_id', flat=True)
+                                 .distinct())
+        today = today or datetime.today().date()
+        next_runs = ScheduledCourse.objects \
+            .filter(master_course=models.OuterRef('pk'), start_date__gte=today) \
+            .order_by('start_date', 'pk')
+        updated = self.update(
+            next_start_date=models.Subquery(next_runs.values('start_date')[:1]),
+            next_run=models.Subquery(next_runs.values('pk')[:1]),
+        )
+        if programme_ids is not None:
+            next_runs_updated.send(sender=self.model, updated=updated, programme_ids=programme_ids)
+        return updated
+
+
 class MasterCourse(models.Model):
     display_name = models.CharField(_('display name'), max_length=100)
     vle_course_id = models.CharField(_('VLE Course ID Number'), max_length=100, db_index=True, unique=True)
@@ -59,26 +138,136 @@ class MasterCourse(models.Model):
     credits = models.PositiveIntegerField(_('credits'), null=True, blank=True)
     weeks_duration = models.PositiveIntegerField(_('duration in weeks'), null=True, blank=True)
 
-    @property
-    def next_start_date(self):
-        all_dates = [s.start_date for s in self.scheduledcourse_set.all()]
-        future_dates = [d for d in all_dates if d is not None and d >= datetime.today().date()]
-        if len(future_dates) == 0:
-            return None
-        return min(future_dates)
+    # denormalised from the scheduled courses by MasterCourse.objects.update_next_runs()
+    next_start_date = models.DateField(_('next start date'), null=True, blank=True, db_index=True, editable=False)
+    next_run = models.ForeignKey(
+        'ScheduledCourse',
+        verbose_name=_('next run'),
+        null=True,
+        blank=True,
+        editable=False,
+        on_delete=models.SET_NULL,
+        related_name='+',
+    )
+
+    objects = MasterCourseQuerySet.as_manager()
 
     def __str__(self):
         return self.display_name
 
 
+# the dates of a scheduled course that a calendar shows, as (event, field)
+CALENDAR_EVENTS = [
+    ('opening', 'open_date'),
+    ('starting', 'start_date'),
+    ('ending', 'end_date'),
+    ('closing', 'close_date'),
+]
+
+
+class ScheduledCourseQuerySet(models.QuerySet):
+
+    def with_related(self):
+        """
+        select what __str__ uses
+        """
+        return self.select_related('master_course')
+
+    def opening(self, weeks, today=None):
+        """
+        courses opening in the given number of weeks, starting with this one (from monday)
+        """
+        return self.filter(_in_weeks('open_date', weeks, today))
+
+    def starting(self, weeks, today=None):
+        """
+        courses starting in the given number of weeks, like opening
+        """
+        return self.filter(_in_weeks('start_date', weeks, today))
+
+    def ending(self, weeks, today=None):
+        """
+        courses ending in the given number of weeks, like opening
+        """
+        return self.filter(_in_weeks('end_date', weeks, today))
+
+    def closing(self, weeks, today=None):
+        """
+        courses closing in the given number of weeks, like opening
+        """
+        return self.filter(_in_weeks('close_date', weeks, today))
+
+    def currently_open(self, today=None):
+        """
+        courses that have opened and not yet closed, or have no close date
+        open_date is repeated in each branch so both search close_date's index, rather than open_date's, which nearly
+        every past course matches
+        """
+        today = today or datetime.today().date()
+        return self.filter(
+            models.Q(close_date__gte=today, open_date__lte=today) |
+            models.Q(close_date__isnull=True, open_date__lte=today)
+        )
+
+    def in_calendar(self, weeks, today=None):
+        """
+        courses with any of their dates in the given number of weeks, like opening
+        """
+        in_weeks = models.Q()
+        for event, field in CALENDAR_EVENTS:
+            in_weeks |= _in_weeks(field, weeks, today)
+        return self.filter(in_weeks)
+
+    def calendar(self, weeks, today=None):
+        """
+        [(monday, {event: [course, ...]})] for each of the given number of weeks, starting with this one, with each
+        course (a dict of its vle_course_id, master_vle_course_id, display_name and dates) under every week and event
+        (of CALENDAR_EVENTS) one of its dates falls in, in date order, with one query
+        """
+        monday = _get_monday(today)
+        calendar = [(monday + timedelta(weeks=week), {event: [] for event, field in CALENDAR_EVENTS}) for week in range(weeks)]
+
+        courses = self.in_calendar(weeks, today).order_by('vle_course_id').values(
+            'vle_course_id',
+            'display_name',
+            *[field for event, field in CALENDAR_EVENTS],
+            master_vle_course_id=models.F('master_course__vle_course_id'),
+        )
+
+        for course in courses:
+            for event, field in CALENDAR_EVENTS:
+                days = (course[field] - monday).days if course[field] is not None else -1
+                if 0 <= days < weeks * 7:
+                    calendar[days // 7][1][event].append(course)
+        for week, events in calendar:
+            for event, field in CALENDAR_EVENTS:
+                events[event].sort(key=lambda course: course[field])
+        return calendar
+
+
+def _get_monday(today=None):
+    today = today or datetime.today().date()
+    return today - timedelta(days=today.weekday())
+
+
+def _in_weeks(field, weeks, today=None):
+    """
+    a range on field, so it can use field's index
+    """
+    monday = _get_monday(today)
+    return models.Q(**{field + '__gte': monday, field + '__lt': monday + timedelta(weeks=weeks)})
+
+
 class ScheduledCourse(models.Model):
     display_name = models.CharField(_('display name'), max_length=100)
     master_course = models.ForeignKey(MasterCourse, on_delete=models.PROTECT)
     vle_course_id = models.CharField(_('VLE Course ID Number'), max_length=100, db_index=True, unique=True)
     open_date = models.DateField(_('open date'), null=True, blank=True, db_index=True)
-    start_date = models.DateField(_('start date'), null=True, blank=True)
-    end_date = models.DateField(_('end (complete) date'), null=True, blank=True)
-    close_date = models.DateField(_('close date'), null=True, blank=True)
+    start_date = models.DateField(_('start date'), null=True, blank=True, db_index=True)
+    end_date = models.DateField(_('end (complete) date'), null=True, blank=True, db_index=True)
+    close_date = models.DateField(_('close date'), null=True, blank=True, db_index=True)
+
+    objects = ScheduledCourseQuerySet.as_manager()
 
     def __str__(self):
         return '{} - {}'.format(
@@ -86,12 +275,29 @@ class ScheduledCourse(models.Model):
             self.display_name
         )
 
+    class Meta:
+        indexes = [
+            # for MasterCourseQuerySet.update_next_runs
+            models.Index(fields=['master_course', 'start_date'], name='scheduledcourse_master_start'),
+        ]
+
+
+class ScheduledCourseGroupQuerySet(models.QuerySet):
+
+    def with_related(self):
+        """
+        select what __str__ uses
+        """
+        return self.select_related('scheduled_course__master_course')
+
 
 class ScheduledCourseGroup(models.Model):
     display_name = models.CharField(_('display name'), max_length=100)
     scheduled_course = models.ForeignKey(ScheduledCourse, on_delete=models.PROTECT)
     vle_group_id = models.CharField(_('VLE Group ID Number'), max_length=100, db_index=True)
 
+    objects = ScheduledCourseGroupQuerySet.as_manager()
+
     def __str__(self):
         return '{} - {} - {}'.format(
             self.scheduled_course.master_course.display_name,
@@ -99,6 +305,20 @@ class ScheduledCourseGroup(models.Model):
             self.display_name
         )
 
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['scheduled_course', 'vle_group_id'], name='unique_scheduled_course_group'),
+        ]
+
+
+class ProgrammeMasterCourseQuerySet(models.QuerySet):
+
+    def with_related(self):
+        """
+        select what __str__ uses
+        """
+        return self.select_related('programme', 'master_course')
+
 
 class ProgrammeMasterCourse(models.Model):
     programme = models.ForeignKey(Programme, on_delete=models.CASCADE)
@@ -106,12 +326,30 @@ class ProgrammeMasterCourse(models.Model):
     available = models.BooleanField(default=True)
     display_order = models.PositiveIntegerField(_('display order'), default=0)
 
+    objects = ProgrammeMasterCourseQuerySet.as_manager()
+
     def __str__(self):
-        return '{} / {} {}'.format(
+        return '{} / {}'.format(
             self.programme.display_name,
             self.master_course.display_name,
-            '(' + self.stage.display_name + ')' if self.stage else ''
         )
 
     class Meta:
         unique_together = ('programme', 'master_course',)
+        indexes = [
+            # for a programme's available courses, in order
+            models.Index(fields=['programme', 'available', 'display_order'], name='programmecourse_available'),
+        ]
+
+
+class QueuedOperation(models.Model):
+    """
+    a JSON API request accepted but not yet applied (see ingest.py)
+    """
+    operation = models.CharField(_('operation'), max_length=50)
+    payload = models.TextField(_('payload'))
+    created = models.DateTimeField(_('created'), auto_now_add=True)
+    error = models.CharField(_('error'), max_length=255, blank=True)
+
+    def __str__(self):
+        return '{} {}'.format(self.operation, self.created)
@@ -0,0 +1,124 @@
+import threading
+from contextlib import contextmanager
+
+from django.conf import settings
+from django.db.models.signals import post_init, post_save, post_delete
+from django.dispatch import receiver
+
+from .domain import invalidate_user_id, invalidate_programme_vle_course_ids, bump_catalogue_version
+from .models import Programme, Stage, ProgrammeMasterCourse, MasterCourse, ScheduledCourse, ScheduledCourseGroup, \
+    next_runs_updated
+from .snapshots import invalidate_programme_snapshots
+
+# set inside deferred_programme_invalidation
+_local = threading.local()
+
+
+@contextmanager
+def deferred_programme_invalidation():
+    """
+    skip the per row invalidation of programmes' cached data and catalogue version bumps below inside, and invalidate
+    every programme's cached vle_course_ids and bump the catalogue version once at the end, e.g. for full_sync, which
+    saves every course (and rebuilds every snapshot after)
+    """
+    _local.deferred = True
+    try:
+        yield
+    finally:
+        _local.deferred = False
+        invalidate_programme_vle_course_ids(Programme.objects.values_list('id', flat=True))
+        bump_catalogue_version()
+
+
+def _is_deferred():
+    return getattr(_local, 'deferred', False)
+
+
+@receiver(post_init, sender=settings.AUTH_USER_MODEL)
+def user_loaded(sender, instance, **kwargs):
+    # remember the username it was loaded with, to forget that too if it's renamed (without loading it if deferred)
+    instance._loaded_username = instance.__dict__.get('username')
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def user_saved(sender, instance, **kwargs):
+    # the new username may have been cached as unknown, and the old one as this user's
+    invalidate_user_id(instance.username)
+    loaded_username = getattr(instance, '_loaded_username', None)
+    if loaded_username and loaded_username != instance.username:
+        invalidate_user_id(loaded_username)
+    instance._loaded_username = instance.username
+
+
+@receiver(post_delete, sender=settings.AUTH_USER_MODEL)
+def user_deleted(sender, instance, **kwargs):
+    invalidate_user_id(instance.username)
+
+
+@receiver(post_save, sender=Programme)
+@receiver(post_delete, sender=Programme)
+def programme_changed(sender, instance, **kwargs):
+    if _is_deferred():
+        return
+    invalidate_programme_vle_course_ids([instance.id])
+    invalidate_programme_snapshots([instance.id])
+
+
+@receiver(post_save, sender=Stage)
+@receiver(post_delete, sender=Stage)
+def stage_changed(sender, instance, **kwargs):
+    if _is_deferred():
+        return
+    invalidate_programme_snapshots([instance.programme_id])
+
+
+@receiver(post_save, sender=ProgrammeMasterCourse)
+@receiver(post_delete, sender=ProgrammeMasterCourse)
+def programme_master_course_changed(sender, instance, **kwargs):
+    if _is_deferred():
+        return
+    invalidate_programme_vle_course_ids([instance.programme_id])
+    invalidate_programme_snapshots([instance.programme_id])
+
+
+@receiver(post_save, sender=MasterCourse)
+def master_course_saved(sender, instance, created, **kwargs):
+    # a new master course isn't in any programmes yet
+    if not created and not _is_deferred():
+        programme_ids = list(
+            ProgrammeMasterCourse.objects.filter(master_course=instance).values_list('programme_id', flat=True)
+        )
+        invalidate_programme_vle_course_ids(programme_ids)
+        invalidate_programme_snapshots(programme_ids)
+
+
+@receiver(post_save, sender=ScheduledCourse)
+@receiver(post_delete, sender=ScheduledCourse)
+def scheduled_course_changed(sender, instance, **kwargs):
+    if _is_deferred():
+        return
+    # the master course's next run may have changed
+    invalidate_programme_snapshots(
+        ProgrammeMasterCourse.objects.filter(master_course_id=instance.master_course_id).values_list('programme_id', flat=True)
+    )
+
+
+@receiver(next_runs_updated)
+def next_runs_changed(sender, updated, programme_ids, **kwargs):
+    # next_start_date and next_run are in the catalogue, e.g. list/master/
+    if _is_deferred():
+        return
+    if updated:
+        bump_catalogue_version()
+    invalidate_programme_snapshots(programme_ids)
+
+
+@receiver(post_save, sender=MasterCourse)
+@receiver(post_delete, sender=MasterCourse)
+@receiver(post_save, sender=ScheduledCourse)
+@receiver(post_delete, sender=ScheduledCourse)
+@receiver(post_save, sender=ScheduledCourseGroup)
+@receiver(post_delete, sender=ScheduledCourseGroup)
+def catalogue_changed(sender, instance, **kwargs):
+    if not _is_deferred():
+        bump_catalogue_version()
@@ -0,0 +1,107 @@
+from datetime import date
+
+from django.conf import settings
+from django.db import transaction
+
+from . import codec
+from .domain import get_programme_structure, programme_cache
+from .models import Programme
+
+# bump when the blob's layout changes
+SNAPSHOT_FORMAT = 1
+programme_snapshot_cache_key = 'programme_snapshot:{}'.format(SNAPSHOT_FORMAT)
+
+
+def get_programme_snapshot(programme_id):
+    """
+    see get_programme_snapshots
+    """
+    return get_programme_snapshots([programme_id]).get(programme_id)
+
+
+def get_programme_snapshots(programme_ids):
+    """
+    the structure of the given programmes, as plain dicts keyed by programme id, like
+    {"id": ..., "display_name": ..., "stages": [{"display_name": ..., "stage_order": ...}],
+     "courses": [{"vle_course_id": ..., "display_name": ..., "display_order": ..., "compulsory": ..., "credits": ...,
+                  "next_start_date": date or None}]}
+    read from cached snapshots, so without any queries once they're built, with three queries to build any missing
+    """
+    keys = {_get_snapshot_cache_key(programme_id): programme_id for programme_id in programme_ids}
+    blobs = programme_cache.get_many(list(keys))
+    missing = [programme_id for key, programme_id in keys.items() if key not in blobs]
+    if missing:
+        built = _build_snapshots(missing)
+        programme_cache.set_many(built, _get_snapshot_timeout())
+        blobs.update(built)
+    return {keys[key]: _unpack(blob) for key, blob in blobs.items()}
+
+
+def invalidate_programme_snapshots(programme_ids):
+    """
+    forget the snapshots of the given programmes, in every process, once the current transaction (if any) commits, so
+    no one can rebuild them from what the transaction is changing in the meantime
+    """
+    keys = [_get_snapshot_cache_key(programme_id) for programme_id in programme_ids]
+
+    def invalidate():
+        programme_cache.delete_many(keys)
+        programme_cache.invalidate()
+    transaction.on_commit(invalidate)
+
+
+def rebuild_programme_snapshots():
+    """
+    rebuild every programme's snapshot, e.g. after a full sync
+    """
+    programme_cache.set_many(_build_snapshots(list(Programme.objects.values_list('id', flat=True))), _get_snapshot_timeout())
+    programme_cache.invalidate()
+
+
+def _build_snapshots(programme_ids):
+    """
+    {cache key: blob} for the given programmes that exist
+    blobs are lists rather than dicts, to keep them small
+    """
+    return {
+        _get_snapshot_cache_key(programme.id): codec.dumps([
+            programme.id,
+            programme.display_name,
+            [[stage.display_name, stage.stage_order] for stage in programme.stages],
+            [[
+                pmc.master_course.vle_course_id,
+                pmc.master_course.display_name,
+                pmc.display_order,
+                pmc.master_course.compulsory,
+                pmc.master_course.credits,
+                pmc.master_course.next_start_date and pmc.master_course.next_start_date.isoformat(),
+            ] for pmc in programme.available_courses],
+        ])
+        for programme in get_programme_structure(programme_ids)
+    }
+
+
+def _unpack(blob):
+    programme_id, display_name, stages, courses = codec.loads(blob)
+    return {
+        'id': programme_id,
+        'display_name': display_name,
+        'stages': [{'display_name': name, 'stage_order': order} for name, order in stages],
+        'courses': [{
+            'vle_course_id': vle_course_id,
+            'display_name': name,
+            'display_order': display_order,
+            'compulsory': compulsory,
+            'credits': credits,
+            'next_start_date': date.fromisoformat(next_start_date) if next_start_date else None,
+        } for vle_course_id, name, display_order, compulsory, credits, next_start_date in courses],
+    }
+
+
+def _get_snapshot_cache_key(programme_id):
+    return '{}:{}'.format(programme_snapshot_cache_key, programme_id)
+
+
+def _get_snapshot_timeout():
+    # a backstop, as signals invalidate snapshots when anything in them changes
+    return getattr(settings, 'PROGRAMME_SNAPSHOT_TIMEOUT', 86400)
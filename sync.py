@@ -3,23 +3,34 @@ from datetime import datetime
 from django.conf import settings
 from django.utils.translation import gettext as _
 
-import requests
+from requests import RequestException
 
+from . import codec, vle
 from .models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+from .signals import deferred_programme_invalidation
+from .snapshots import rebuild_programme_snapshots
 
 
 def full_sync():
     # request all courses requiring synchronization from Moodle
-    response = requests.get(
-        ''.join([settings.VLEROOT, settings.SYNC_URL])
-    )
+    try:
+        response = vle.get(
+            ''.join([settings.VLEROOT, settings.SYNC_URL]),
+            endpoint='sync'
+        )
+    except RequestException as e:
+        return _('Could not connect to the VLE: {}').format(e)
 
     # return error message
     if response.status_code != 200:
-        e = response.json()
+        e = codec.loads(response.content)
         return e['errorMessage']
 
-    _sync_all_courses(response.json())
+    # invalidate programmes' cached data once, rather than for every course saved
+    with deferred_programme_invalidation():
+        _sync_all_courses(codec.loads(response.content))
+        MasterCourse.objects.update_next_runs()
+    rebuild_programme_snapshots()
     return _('Full course synchronization completed successfully')
 
 
@@ -0,0 +1,19 @@
+from django.core.cache import caches
+
+import pytest
+
+from programmes.domain import _user_ids, hot_cache, programme_cache
+
+
+@pytest.fixture
+def cache():
+    cache = caches['default']
+    cache.clear()
+    hot_cache.clear_l1()
+    programme_cache.clear_l1()
+    _user_ids.clear()
+    yield cache
+    cache.clear()
+    hot_cache.clear_l1()
+    programme_cache.clear_l1()
+    _user_ids.clear()
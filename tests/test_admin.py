@@ -0,0 +1,128 @@
+from django.contrib.auth import get_user_model
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import pytest
+
+from programmes.ingest import enqueue
+from programmes.models import Programme, UserProgramme, Stage, MasterCourse, ScheduledCourse, ProgrammeMasterCourse
+
+
+def create_programmes(number):
+    start = Programme.objects.count()
+    for i in range(start, start + number):
+        programme = Programme.objects.create(display_name='Programme {}'.format(i))
+        for order in range(1, 3):
+            Stage.objects.create(programme=programme, display_name='Stage {}'.format(order), stage_order=order)
+        master_course = MasterCourse.objects.create(vle_course_id=str(i), display_name='Master {}'.format(i))
+        ProgrammeMasterCourse.objects.create(programme=programme, master_course=master_course)
+
+
+def count_queries(client, url):
+    # leave out queries only the first request makes, such as filling the content types cache
+    client.get(url)
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url)
+    assert response.status_code == 200
+    return len(queries), response
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('url_name, column', [
+    ('admin:programmes_programmestage_changelist', 'stage_count'),
+    ('admin:programmes_programmecourse_changelist', 'master_course_count'),
+])
+def test_programme_changelist_counts(admin_client, url_name, column):
+    create_programmes(2)
+    few, response = count_queries(admin_client, reverse(url_name))
+    create_programmes(20)
+    many, response = count_queries(admin_client, reverse(url_name))
+
+    # check the number of queries doesn't grow with the number of programmes
+    assert few == many
+    assert response.context['cl'].result_list[0].__dict__['annotated_' + column] == (2 if column == 'stage_count' else 1)
+
+
+def create_user_programmes(number):
+    programme = Programme.objects.create(display_name='Programme')
+    start = UserProgramme.objects.count()
+    for i in range(start, start + number):
+        user = get_user_model().objects.create(username='user.{}'.format(i))
+        UserProgramme.objects.create(user=user, programme=programme)
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('url_name, create', [
+    ('admin:programmes_programme_changelist', create_programmes),
+    ('admin:programmes_mastercourse_changelist', create_programmes),
+    ('admin:programmes_userprogramme_changelist', create_user_programmes),
+    ('admin:programmes_queuedoperation_changelist', lambda number: enqueue([('delete_master_course', {})] * number)),
+])
+def test_changelist_queries(admin_client, url_name, create):
+    create(2)
+    few, response = count_queries(admin_client, reverse(url_name))
+    create(20)
+    many, response = count_queries(admin_client, reverse(url_name))
+
+    # check the number of queries doesn't grow with the number of rows
+    assert few == many
+
+
+@pytest.mark.django_db
+def test_programme_master_courses_change_queries(admin_client):
+    programme = Programme.objects.create(display_name='Programme')
+
+    def add_master_courses(number):
+        start = MasterCourse.objects.count()
+        for i in range(start, start + number):
+            master_course = MasterCourse.objects.create(vle_course_id=str(i), display_name='Master {}'.format(i))
+            ProgrammeMasterCourse.objects.create(programme=programme, master_course=master_course, display_order=i)
+
+    url = reverse('admin:programmes_programmecourse_change', args=[programme.pk])
+    add_master_courses(2)
+    few, response = count_queries(admin_client, url)
+    add_master_courses(20)
+    many, response = count_queries(admin_client, url)
+
+    # check the number of queries doesn't grow with the number of inline forms and their choices
+    assert few == many
+    assert len(response.context['inline_admin_formsets'][0].formset.forms) > 20
+
+
+@pytest.mark.django_db
+def test_programme_stages_change_queries(admin_client):
+    programme = Programme.objects.create(display_name='Programme')
+
+    def add_stages(number):
+        start = Stage.objects.count()
+        for i in range(start, start + number):
+            Stage.objects.create(programme=programme, display_name='Stage {}'.format(i), stage_order=i + 1)
+
+    url = reverse('admin:programmes_programmestage_change', args=[programme.pk])
+    add_stages(2)
+    few, response = count_queries(admin_client, url)
+    add_stages(20)
+    many, response = count_queries(admin_client, url)
+
+    # check the number of queries doesn't grow with the number of inline forms
+    assert few == many
+
+
+@pytest.mark.django_db
+def test_master_course_change_queries(admin_client):
+    master_course = MasterCourse.objects.create(vle_course_id='001', display_name='Master')
+
+    def add_scheduled_courses(number):
+        start = ScheduledCourse.objects.count()
+        for i in range(start, start + number):
+            ScheduledCourse.objects.create(master_course=master_course, vle_course_id='001/{}'.format(i), display_name=str(i))
+
+    url = reverse('admin:programmes_mastercourse_change', args=[master_course.pk])
+    add_scheduled_courses(2)
+    few, response = count_queries(admin_client, url)
+    add_scheduled_courses(20)
+    many, response = count_queries(admin_client, url)
+
+    # check the number of queries doesn't grow with the number of inline forms
+    assert few == many
@@ -0,0 +1,242 @@
+import json
+import time
+
+from django.core.cache import caches
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.translation import gettext as _
+from django.utils.encoding import force_str
+
+import pytest
+
+from programmes.batch import Batch, apply_operations
+from programmes.domain import _cache_memberships, get_scheduled_course_and_group_memberships_from_cache, hot_cache
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+
+
+@pytest.fixture
+def master_course():
+    return MasterCourse.objects.create(vle_course_id='001', display_name='Zero Zero One')
+
+
+@pytest.fixture
+def scheduled_course(master_course):
+    return ScheduledCourse.objects.create(
+        master_course=master_course,
+        vle_course_id='001/01',
+        display_name='Zero Zero One / Zero One'
+    )
+
+
+@pytest.fixture
+def scheduled_course_group(scheduled_course):
+    return ScheduledCourseGroup.objects.create(
+        scheduled_course=scheduled_course,
+        vle_group_id='001/01/A',
+        display_name='Group A'
+    )
+
+
+@pytest.mark.django_db
+def test_batch_not_a_list(client):
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps({}))
+
+    # check it wasn't successful
+    assert response.status_code == 400
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Must specify a list of operations')
+
+
+@pytest.mark.django_db
+def test_batch_successfully(client):
+    operations = [
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'Zero Zero One', 'credits': 15}},
+        {'operation': 'create_scheduled_course', 'data': {
+            'master_vle_course_id': '001', 'vle_course_id': '001/01', 'name': 'Zero One', 'startdate': '2020-01-01',
+        }},
+        {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/A', 'name': 'A'}},
+        {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/A', 'name': 'A'}},
+        {'operation': 'update_group', 'data': {
+            'vle_course_id': '001/01', 'old_vle_group_id': '001/01/A', 'vle_group_id': '001/01/B', 'name': 'B',
+        }},
+        {'operation': 'create_scheduled_course', 'data': {'master_vle_course_id': '002', 'vle_course_id': '002/01', 'name': 'x'}},
+        {'operation': 'wibble', 'data': {}},
+    ]
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps(operations))
+
+    # check it was successful
+    assert response.status_code == 200
+
+    # check the results are in order, and match the single endpoints'
+    data = json.loads(force_str(response.content))
+    assert data['results'] == [
+        {'successMessage': _('Course created successfully!')},
+        {'successMessage': _('Course created successfully!')},
+        {'successMessage': _('Group created successfully!')},
+        {'errorMessage': _('Group with given vle_course_id and vle_group_id already exists')},
+        {'successMessage': _('Group updated successfully!')},
+        {'errorMessage': _('Course with given master_vle_course_id does not exist')},
+        {'errorMessage': _('Must specify a valid operation and its data')},
+    ]
+
+    # check the database
+    master = MasterCourse.objects.get(vle_course_id='001')
+    assert master.credits == 15
+    scheduled = ScheduledCourse.objects.get(vle_course_id='001/01')
+    assert scheduled.master_course == master
+    assert scheduled.start_date.isoformat() == '2020-01-01'
+    assert list(scheduled.scheduledcoursegroup_set.values_list('vle_group_id', 'display_name')) == [('001/01/B', 'B')]
+
+
+@pytest.mark.django_db
+def test_batch_updates_and_deletes(scheduled_course_group):
+    results = apply_operations([
+        {'operation': 'update_master_course', 'data': {'old_vle_course_id': '001', 'vle_course_id': '002', 'name': 'Two'}},
+        {'operation': 'update_scheduled_course', 'data': {
+            'master_vle_course_id': '002', 'old_vle_course_id': '001/01', 'vle_course_id': '002/01', 'name': 'Two One',
+        }},
+        {'operation': 'delete_group', 'data': {'vle_course_id': '002/01', 'vle_group_id': '001/01/A'}},
+        {'operation': 'delete_scheduled_course', 'data': {'master_vle_course_id': '002', 'vle_course_id': '002/01'}},
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One again'}},
+    ])
+
+    # check they all succeeded
+    assert [list(result) for result in results] == [['successMessage']] * 5
+
+    # check the database
+    assert list(MasterCourse.objects.order_by('vle_course_id').values_list('vle_course_id', 'display_name')) == [
+        ('001', 'One again'),
+        ('002', 'Two'),
+    ]
+    assert not ScheduledCourse.objects.exists()
+    assert not ScheduledCourseGroup.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batch_delete_master_course_with_pending_children(master_course):
+    results = apply_operations([
+        {'operation': 'create_scheduled_course', 'data': {'master_vle_course_id': '001', 'vle_course_id': '001/01', 'name': 'x'}},
+        {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/A', 'name': 'A'}},
+        {'operation': 'delete_master_course', 'data': {'vle_course_id': '001'}},
+        {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/B', 'name': 'B'}},
+    ])
+
+    # check the last group couldn't be created, as its course went with its master course
+    assert results[3] == {'errorMessage': _('Course with given vle_course_id does not exist')}
+    assert not MasterCourse.objects.exists()
+    assert not ScheduledCourse.objects.exists()
+    assert not ScheduledCourseGroup.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batch_protected_rolls_back(client, scheduled_course_group):
+    operations = [
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '002', 'name': 'Two'}},
+        {'operation': 'delete_master_course', 'data': {'vle_course_id': '001'}},
+    ]
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps(operations))
+
+    # check it wasn't successful, and nothing was written
+    assert response.status_code == 400
+    assert list(MasterCourse.objects.values_list('vle_course_id', flat=True)) == ['001']
+
+
+@pytest.mark.django_db
+def test_batch_queries_dont_grow_with_operations(master_course):
+    operations = [
+        {'operation': 'create_scheduled_course', 'data': {'master_vle_course_id': '001', 'vle_course_id': '001/%02d' % i, 'name': 'x'}}
+        for i in range(50)
+    ] + [
+        {'operation': 'create_group', 'data': {'vle_course_id': '001/%02d' % i, 'vle_group_id': 'A', 'name': 'A'}}
+        for i in range(50)
+    ]
+
+    with CaptureQueriesContext(connection) as queries:
+        apply_operations(operations)
+
+    # check everything was created with a handful of queries
+    assert ScheduledCourseGroup.objects.count() == 50
+    assert len(queries) <= 10
+
+
+@pytest.mark.django_db
+def test_batch_patches_cached_memberships(scheduled_course, django_capture_on_commit_callbacks):
+    cache = caches['default']
+    cache.clear()
+    hot_cache.clear_l1()
+    _cache_memberships({'001/01': {'members': ['student.1'], 'groups': {}}}, time.time() + 3600)
+
+    with django_capture_on_commit_callbacks(execute=True):
+        apply_operations([
+            {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/A', 'name': 'A'}},
+            {'operation': 'create_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/B', 'name': 'B'}},
+            {'operation': 'delete_group', 'data': {'vle_course_id': '001/01', 'vle_group_id': '001/01/A'}},
+        ])
+
+        # check the cached memberships aren't patched until the transaction commits, as it may yet roll back
+        assert get_scheduled_course_and_group_memberships_from_cache()['001/01']['groups'] == {}
+
+    # check the cached memberships
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01'] == {
+        'members': ['student.1'],
+        'groups': {'001/01/B': []},
+    }
+    cache.clear()
+    hot_cache.clear_l1()
+
+
+@pytest.mark.django_db
+def test_batch_updates_next_runs():
+    apply_operations([
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One'}},
+        {'operation': 'create_scheduled_course', 'data': {
+            'master_vle_course_id': '001', 'vle_course_id': '001/01', 'name': 'x', 'startdate': '2999-01-01',
+        }},
+        {'operation': 'create_scheduled_course', 'data': {
+            'master_vle_course_id': '001', 'vle_course_id': '001/02', 'name': 'x', 'startdate': '2998-01-01',
+        }},
+    ])
+
+    # check the master course's next run
+    master = MasterCourse.objects.get()
+    assert str(master.next_start_date) == '2998-01-01'
+    assert master.next_run.vle_course_id == '001/02'
+
+
+@pytest.mark.django_db
+def test_batch_swaps_vle_course_ids(master_course, scheduled_course_group):
+    MasterCourse.objects.create(vle_course_id='002', display_name='Two')
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled_course_group.scheduled_course, vle_group_id='B', display_name='B')
+    results = apply_operations([
+        {'operation': 'update_master_course', 'data': {'old_vle_course_id': '001', 'vle_course_id': 'tmp', 'name': 'One'}},
+        {'operation': 'update_master_course', 'data': {'old_vle_course_id': '002', 'vle_course_id': '001', 'name': 'Two'}},
+        {'operation': 'update_master_course', 'data': {'old_vle_course_id': 'tmp', 'vle_course_id': '002', 'name': 'One'}},
+        {'operation': 'update_group', 'data': {'vle_course_id': '001/01', 'old_vle_group_id': '001/01/A', 'vle_group_id': 'tmp', 'name': 'A'}},
+        {'operation': 'update_group', 'data': {'vle_course_id': '001/01', 'old_vle_group_id': 'B', 'vle_group_id': '001/01/A', 'name': 'B'}},
+        {'operation': 'update_group', 'data': {'vle_course_id': '001/01', 'old_vle_group_id': 'tmp', 'vle_group_id': 'B', 'name': 'A'}},
+    ])
+
+    # check they swapped, as they would have one at a time
+    assert all('successMessage' in result for result in results)
+    assert dict(MasterCourse.objects.values_list('vle_course_id', 'display_name')) == {'001': 'Two', '002': 'One'}
+    assert dict(ScheduledCourseGroup.objects.values_list('vle_group_id', 'display_name')) == {'001/01/A': 'B', 'B': 'A'}
+    assert ScheduledCourse.objects.get().master_course.vle_course_id == '002'
+
+
+@pytest.mark.django_db
+def test_batch_concurrent_conflict(client, monkeypatch):
+    flush = Batch.flush
+
+    def flush_after_concurrent_create(self):
+        MasterCourse.objects.create(vle_course_id='001', display_name='Concurrent')
+        return flush(self)
+    monkeypatch.setattr(Batch, 'flush', flush_after_concurrent_create)
+    operations = [{'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One'}}]
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps(operations))
+
+    # check it wasn't successful, and nothing was written
+    assert response.status_code == 400
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Course or group with a given id already exists')
+    assert not MasterCourse.objects.exists()
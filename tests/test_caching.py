@@ -0,0 +1,92 @@
+from django.core.cache import caches
+
+import pytest
+from mock import patch
+
+from programmes.caching import LRUCache, TwoTierCache
+
+
+def test_lru_cache_get_and_set():
+    cache = LRUCache(2)
+    assert cache.get('a') is None
+    assert cache.get('a', 0) == 0
+    cache.set('a', 1)
+    assert cache.get('a') == 1
+
+
+def test_lru_cache_evicts_least_recently_used():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert len(cache) == 2
+    assert cache.get('a') == 1
+    assert cache.get('b') is None
+    assert cache.get('c') == 3
+
+
+@patch('programmes.caching.time')
+def test_lru_cache_expires_entries(mock_time):
+    cache = LRUCache(2, ttl=10)
+    mock_time.time.return_value = 100
+    cache.set('a', 1)
+    mock_time.time.return_value = 109
+    assert cache.get('a') == 1
+    mock_time.time.return_value = 110
+    assert cache.get('a') is None
+    assert len(cache) == 0
+
+
+def test_lru_cache_delete_and_clear():
+    cache = LRUCache(2)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.delete('a')
+    cache.delete('z')
+    assert cache.get('a') is None
+    cache.clear()
+    assert len(cache) == 0
+
+
+@pytest.fixture
+def two_tier_cache():
+    cache = caches['default']
+    cache.clear()
+    yield TwoTierCache(check_interval=0)
+    cache.clear()
+
+
+def test_two_tier_cache_reads_through_to_l2(two_tier_cache):
+    caches['default'].set('a', 1)
+    assert two_tier_cache.get('a') == 1
+    assert two_tier_cache.get('a') == 1
+    assert two_tier_cache.get('b') is None
+    assert two_tier_cache.stats == {'l1_hits': 1, 'l1_misses': 2, 'l2_hits': 1, 'l2_misses': 1}
+
+
+def test_two_tier_cache_writes_both_tiers(two_tier_cache):
+    two_tier_cache.set_many({'a': 1, 'b': 2}, 60)
+    assert caches['default'].get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    assert two_tier_cache.get_many(['a', 'b']) == {'a': 1, 'b': 2}
+    assert two_tier_cache.stats['l1_hits'] == 2
+
+
+def test_two_tier_cache_delete(two_tier_cache):
+    two_tier_cache.set('a', 1, 60)
+    two_tier_cache.delete('a')
+    assert caches['default'].get('a') is None
+    assert two_tier_cache.get('a') is None
+
+
+def test_two_tier_cache_invalidate_drops_other_processes_l1(two_tier_cache):
+    other = TwoTierCache(check_interval=0)
+    two_tier_cache.set('a', 1, 60)
+    assert other.get('a') == 1
+
+    # l2 changes aren't seen while other's l1 holds the value
+    caches['default'].set('a', 2)
+    assert other.get('a') == 1
+
+    two_tier_cache.invalidate()
+    assert other.get('a') == 2
@@ -0,0 +1,30 @@
+import pytest
+from mock import patch
+
+from programmes import codec
+
+
+def test_loads_bytes_and_str():
+    assert codec.loads(b'{"name": "caf\\u00e9", "ids": [1, 2]}') == {'name': 'café', 'ids': [1, 2]}
+    assert codec.loads('{"name": "café"}') == {'name': 'café'}
+    assert codec.loads('{"name": "café"}'.encode('utf-8')) == {'name': 'café'}
+
+
+def test_loads_invalid_json():
+    with pytest.raises(ValueError):
+        codec.loads(b'{"name": ')
+
+
+def test_dumps():
+    data = codec.dumps({'name': 'café', 'ids': [1, 2]})
+    assert isinstance(data, bytes)
+    assert codec.loads(data) == {'name': 'café', 'ids': [1, 2]}
+
+
+@patch.object(codec, 'ujson', None)
+@patch.object(codec, 'orjson', None)
+def test_stdlib_fallback():
+    assert codec.loads(b'{"name": "caf\\u00e9"}') == {'name': 'café'}
+    assert codec.dumps({'name': 'café'}) == '{"name":"café"}'.encode('utf-8')
+    with pytest.raises(ValueError):
+        codec.loads(b'{"name": ')
@@ -1,17 +1,45 @@
+import json
+import pickle
+import time
+from datetime import date, timedelta
+from functools import partial
+from types import SimpleNamespace
+
 from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.test import override_settings
 
 import pytest
-from mock import patch
+from mock import MagicMock, patch
 
-from programmes.models import MasterCourse
-from programmes.domain import get_user_programmes, get_programme_master_courses
+from programmes.models import MasterCourse, ProgrammeMasterCourse, Programme, Stage
+from programmes.batch import apply_operations
+from programmes.domain import get_user_programmes, get_programme_master_courses, get_programme_vle_course_ids
 from programmes.domain import get_user_enrolled_scheduled_courses_by_programme
+from programmes.domain import get_users_enrolled_scheduled_courses_by_programme
+from programmes.domain import get_scheduled_course_and_group_memberships_from_cache, get_memberships
+from programmes.domain import course_and_group_memberships_cache_key, course_and_group_memberships_lock_key
+from programmes.domain import course_and_group_memberships_patch_lock_key
+from programmes.domain import _cache_memberships, patch_memberships, refresh_memberships_from_changes
+from programmes.domain import _get_memberships_shard_key
+from programmes.domain import get_user_ids, _user_ids, hot_cache, set_module_courses, get_programme_structure
+from programmes.domain import invalidate_programme_vle_course_ids, programme_cache
+from programmes.memberships import add_member
+from programmes.vle import VLEUnavailable
 
 from .fixtures import *
 
 slug = 'some-module-overview-page'
 
 
+def encode(data):
+    return json.dumps(data).encode('utf-8')
+
+
+def cache_memberships(data, expires_in):
+    return _cache_memberships(data, time.time() + expires_in)
+
+
 @pytest.fixture
 def master_course():
     vle_course_id = 'foobar'
@@ -96,36 +124,64 @@ def test_get_programme_master_courses_for_maths(programmes):
     ]
 
 
-@patch('programmes.domain.requests')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_requests_lms_service(mock_requests, three_programmes_student_user):
-    mock_requests.get.return_value.status_code = 200
+def test_programme_vle_course_ids_invalidated_by_batch(cache, programmes, django_capture_on_commit_callbacks):
+    gmba = programmes[1]
+    assert get_programme_vle_course_ids([gmba.id]) == {gmba.id: {'it001'}}
+
+    # check a batch's bulk update, which sends no signals, is seen once it's committed
+    with django_capture_on_commit_callbacks(execute=True):
+        apply_operations([
+            {'operation': 'update_master_course', 'data': {'old_vle_course_id': 'it001', 'vle_course_id': 'it002', 'name': 'x'}},
+        ])
+        assert get_programme_vle_course_ids([gmba.id]) == {gmba.id: {'it001'}}
+    assert get_programme_vle_course_ids([gmba.id]) == {gmba.id: {'it002'}}
+
+
+@pytest.mark.django_db
+def test_programme_vle_course_ids_invalidation_leaves_hot_cache(cache, programmes, django_capture_on_commit_callbacks):
+    get_programme_vle_course_ids([programmes[1].id])
+
+    # check invalidating a programme doesn't drop every process's memberships and enrolments
+    with django_capture_on_commit_callbacks(execute=True):
+        invalidate_programme_vle_course_ids([programmes[1].id])
+    assert cache.get(hot_cache.generation_key) is None
+    assert cache.get(programme_cache.generation_key) == 1
+
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_requests_lms_service(mock_vle, three_programmes_student_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({})
     get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
-    assert mock_requests.get.call_count == 1
-    assert mock_requests.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.ENROLMENTS_URL)
-    assert mock_requests.get.call_args[1]['params'] == {
+    assert mock_vle.get.call_count == 1
+    assert mock_vle.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.ENROLMENTS_URL)
+    assert mock_vle.get.call_args[1]['params'] == {
         'username': three_programmes_student_user.username,
         'role': 'student',
     }
 
 
-@patch('programmes.domain.requests')
+@patch('programmes.domain.vle')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_requests_lms_service_for_tutors(mock_requests, three_programmes_tutor_user):
-    mock_requests.get.return_value.status_code = 200
+def test_get_user_enrolled_scheduled_courses_by_programme_requests_lms_service_for_tutors(mock_vle, three_programmes_tutor_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({})
     get_user_enrolled_scheduled_courses_by_programme(three_programmes_tutor_user, 'tutor')
-    assert mock_requests.get.call_count == 1
-    assert mock_requests.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.ENROLMENTS_URL)
-    assert mock_requests.get.call_args[1]['params'] == {
+    assert mock_vle.get.call_count == 1
+    assert mock_vle.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.ENROLMENTS_URL)
+    assert mock_vle.get.call_args[1]['params'] == {
         'username': three_programmes_tutor_user.username,
         'role': 'tutor',
     }
 
 
-@patch('programmes.domain.requests')
+@patch('programmes.domain.vle')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_returns_programmes_as_list_of_dicts(mock_requests, two_programmes_student_user, programmes):
-    mock_requests.get.return_value.status_code = 200
+def test_get_user_enrolled_scheduled_courses_by_programme_returns_programmes_as_list_of_dicts(mock_vle, two_programmes_student_user, programmes):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({})
     l, d = get_user_enrolled_scheduled_courses_by_programme(two_programmes_student_user)
     assert type(l).__name__ == 'list'
     assert len(l) == 2
@@ -133,17 +189,17 @@ def test_get_user_enrolled_scheduled_courses_by_programme_returns_programmes_as_
     assert l[1]['id'] == programmes[1].id
 
 
-@patch('programmes.domain.requests')
+@patch('programmes.domain.vle')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_returns_courses(mock_requests, three_programmes_student_user, programmes):
-    mock_requests.get.return_value.status_code = 200
-    mock_requests.get.return_value.json.return_value = {
+def test_get_user_enrolled_scheduled_courses_by_programme_returns_courses(mock_vle, three_programmes_student_user, programmes):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
         'courses': [
             {'masteridnumber': 'maths001'},  # from the 'Maths' programme
             {'masteridnumber': 'maths002'},  # from the 'Maths' programme
             {'masteridnumber': 'it001'},  # from the 'Global MBA' programme
         ]
-    }
+    })
     d, m = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
     assert d == [
         {
@@ -169,26 +225,26 @@ def test_get_user_enrolled_scheduled_courses_by_programme_returns_courses(mock_r
     ]
 
 
-@patch('programmes.domain.requests')
+@patch('programmes.domain.vle')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_returns_completions(mock_requests, three_programmes_tutor_user):
-    mock_requests.get.return_value.status_code = 200
-    mock_requests.get.return_value.json.return_value = {
+def test_get_user_enrolled_scheduled_courses_by_programme_returns_completions(mock_vle, three_programmes_tutor_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
         'courses': [],
         'module_completions': {
             'foo': 'bar',
             'students': []
         }
-    }
+    })
     d, m = get_user_enrolled_scheduled_courses_by_programme(three_programmes_tutor_user)
     assert m == {'foo': 'bar', 'students': []}
 
 
-@patch('programmes.domain.requests')
+@patch('programmes.domain.vle')
 @pytest.mark.django_db
-def test_get_user_enrolled_scheduled_courses_by_programme_retrieves_user_ids(mock_requests, three_programmes_tutor_user):
-    mock_requests.get.return_value.status_code = 200
-    mock_requests.get.return_value.json.return_value = {
+def test_get_user_enrolled_scheduled_courses_by_programme_retrieves_user_ids(mock_vle, three_programmes_tutor_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
         'courses': [],
         'module_completions': {
             'students': [
@@ -196,7 +252,7 @@ def test_get_user_enrolled_scheduled_courses_by_programme_retrieves_user_ids(moc
                 {'username': 'robologo'}
             ]
         }
-    }
+    })
     d, m = get_user_enrolled_scheduled_courses_by_programme(three_programmes_tutor_user, 'tutor')
     assert m == {
         'students': [
@@ -211,3 +267,579 @@ def test_get_user_enrolled_scheduled_courses_by_programme_retrieves_user_ids(moc
         ]
     }
 
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_users_enrolled_scheduled_courses_by_programme_requests_lms_service_per_user(mock_vle, two_programmes_student_user, one_programme_student_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({})
+    get_users_enrolled_scheduled_courses_by_programme([two_programmes_student_user, one_programme_student_user])
+    assert mock_vle.get.call_count == 2
+    assert sorted(c[1]['params']['username'] for c in mock_vle.get.call_args_list) == [
+        two_programmes_student_user.username,
+        one_programme_student_user.username,
+    ]
+
+
+@override_settings(BATCH_ENROLMENTS_URL='http://vle/batch_enrolments', BATCH_ENROLMENTS_SIZE=1)
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_users_enrolled_scheduled_courses_by_programme_requests_lms_service_in_batches(mock_vle, two_programmes_student_user, one_programme_student_user):
+    mock_vle.post.return_value.status_code = 200
+    mock_vle.post.return_value.content = encode({})
+    get_users_enrolled_scheduled_courses_by_programme([two_programmes_student_user, one_programme_student_user])
+    assert mock_vle.get.call_count == 0
+    assert mock_vle.post.call_count == 2
+    assert mock_vle.post.call_args[0][0] == 'http://vle/batch_enrolments'
+    assert mock_vle.post.call_args[1]['json'] == {
+        'usernames': [one_programme_student_user.username],
+        'role': 'student',
+    }
+
+
+@override_settings(BATCH_ENROLMENTS_URL='http://vle/batch_enrolments')
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_users_enrolled_scheduled_courses_by_programme_returns_programmes_per_user(mock_vle, three_programmes_student_user, one_programme_student_user, programmes, django_assert_num_queries, cache):
+    mock_vle.post.return_value.status_code = 200
+    mock_vle.post.return_value.content = encode({
+        three_programmes_student_user.username: {
+            'courses': [
+                {'masteridnumber': 'maths001'},
+                {'masteridnumber': 'it001'},
+            ],
+        },
+    })
+    with django_assert_num_queries(2):
+        results = get_users_enrolled_scheduled_courses_by_programme([three_programmes_student_user, one_programme_student_user])
+    assert results[three_programmes_student_user.id] == ([
+        {'id': programmes[0].id, 'display_name': 'CATS', 'courses': []},
+        {'id': programmes[1].id, 'display_name': 'Global MBA', 'courses': [{'masteridnumber': 'it001'}]},
+        {'id': programmes[2].id, 'display_name': 'Maths', 'courses': [{'masteridnumber': 'maths001'}]},
+    ], {})
+    assert results[one_programme_student_user.id] == ([
+        {'id': programmes[0].id, 'display_name': 'CATS', 'courses': []},
+    ], {})
+
+
+@override_settings(BATCH_ENROLMENTS_URL='http://vle/batch_enrolments')
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_users_enrolled_scheduled_courses_by_programme_retrieves_user_ids(mock_vle, three_programmes_tutor_user, one_programme_student_user):
+    mock_vle.post.return_value.status_code = 200
+    mock_vle.post.return_value.content = encode({
+        three_programmes_tutor_user.username: {
+            'module_completions': {
+                'students': [
+                    {'username': one_programme_student_user.username},
+                    {'username': 'robologo'},
+                ]
+            }
+        },
+    })
+    results = get_users_enrolled_scheduled_courses_by_programme([three_programmes_tutor_user], 'tutor')
+    assert results[three_programmes_tutor_user.id][1] == {
+        'students': [
+            {'id': one_programme_student_user.id, 'username': one_programme_student_user.username},
+            {'id': None, 'username': 'robologo'},
+        ]
+    }
+
+
+@patch('programmes.domain.vle')
+def test_get_memberships_downloads_when_nothing_is_cached(mock_vle, cache):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'001/01': {'members': ['student.1']}})
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+    assert mock_vle.get.call_count == 1
+    assert mock_vle.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL)
+    assert cache.get(course_and_group_memberships_lock_key) is None
+
+
+@patch('programmes.domain.vle')
+def test_get_memberships_does_not_download_while_another_worker_holds_the_lock(mock_vle, cache):
+    cache.set(course_and_group_memberships_lock_key, True)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {}
+    assert mock_vle.get.call_count == 0
+
+
+@patch('programmes.domain.threading')
+@patch('programmes.domain.vle')
+def test_get_memberships_serves_fresh_memberships_without_refreshing(mock_vle, mock_threading, cache):
+    cache_memberships({'001/01': {'members': ['student.1']}}, 3600)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+    assert mock_vle.get.call_count == 0
+    assert mock_threading.Thread.call_count == 0
+
+
+@patch('programmes.domain.threading')
+@patch('programmes.domain.vle')
+def test_get_memberships_serves_stale_memberships_and_refreshes_in_background(mock_vle, mock_threading, cache):
+    cache_memberships({'001/01': {'members': ['student.1']}}, -1)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+    assert mock_vle.get.call_count == 0
+    assert mock_threading.Thread.call_count == 1
+    assert mock_threading.Thread.return_value.start.call_count == 1
+
+    # a second request doesn't start another refresh while the first holds the lock
+    get_scheduled_course_and_group_memberships_from_cache()
+    assert mock_threading.Thread.call_count == 1
+
+
+@patch('programmes.domain.vle')
+def test_get_memberships_background_refresh_replaces_stale_memberships(mock_vle, cache):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'001/01': {'members': ['student.2']}})
+    cache_memberships({'001/01': {'members': ['student.1']}}, -1)
+    with patch('programmes.domain.threading.Thread') as mock_thread:
+        get_scheduled_course_and_group_memberships_from_cache()
+        target, args = mock_thread.call_args[1]['target'], mock_thread.call_args[1]['args']
+    target(*args)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.2']}}
+    assert cache.get(course_and_group_memberships_lock_key) is None
+
+
+@patch('programmes.domain.vle')
+def test_get_memberships_keeps_last_good_memberships_when_download_fails(mock_vle, cache):
+    mock_vle.get.return_value.status_code = 500
+    cache_memberships({'001/01': {'members': ['student.1']}}, -1)
+    with patch('programmes.domain.threading.Thread') as mock_thread:
+        get_scheduled_course_and_group_memberships_from_cache()
+        target, args = mock_thread.call_args[1]['target'], mock_thread.call_args[1]['args']
+    target(*args)
+    assert cache.get(course_and_group_memberships_cache_key)['expires'] > time.time()
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+
+
+@patch('programmes.domain.threading')
+def test_get_memberships_reads_only_the_requested_shards(mock_threading, cache):
+    cache_memberships({
+        '001/01': {'members': ['student.1']},
+        '002/01': {'members': ['student.2']},
+    }, 3600)
+    hot_cache.clear_l1()
+    with patch.object(cache, 'get_many', wraps=cache.get_many) as get_many:
+        data = get_scheduled_course_and_group_memberships_from_cache(['002/01', '003/01'])
+    assert data == {'002/01': {'members': ['student.2']}}
+
+    # check only their shards were read, and then which scheduled courses are cached, as one had no shard
+    assert [len(call[0][0]) for call in get_many.call_args_list] == [2, 1]
+    assert mock_threading.Thread.call_count == 0
+
+
+def test_get_memberships_manifest_doesnt_list_the_shards(cache):
+    cache_memberships({'{:03}/01'.format(i): {'members': ['student.1']} for i in range(100)}, 3600)
+    manifest = cache.get(course_and_group_memberships_cache_key)
+    assert manifest['patched'] == {}
+    assert len(pickle.dumps(manifest)) < 300
+    assert len(get_scheduled_course_and_group_memberships_from_cache()) == 100
+
+
+@patch('programmes.domain.threading')
+def test_get_memberships_refreshes_when_shards_are_evicted(mock_threading, cache):
+    manifest = cache_memberships({
+        '001/01': {'members': ['student.1']},
+        '002/01': {'members': ['student.2']},
+    }, 3600)
+    cache.delete(_get_memberships_shard_key(manifest, '001/01'))
+    hot_cache.clear_l1()
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'002/01': {'members': ['student.2']}}
+    assert mock_threading.Thread.call_count == 1
+
+
+def test_get_memberships_flips_to_new_shards_atomically(cache):
+    previous = cache_memberships({'001/01': {'members': ['student.1']}}, 3600)
+    manifest = _cache_memberships({'001/01': {'members': ['student.2']}}, time.time() + 3600)
+    assert manifest['version'] > previous['version']
+    assert _get_memberships_shard_key(manifest, '001/01') != _get_memberships_shard_key(previous, '001/01')
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.2']}}
+
+
+def test_get_memberships_indexes_cached_memberships_once_per_version(cache):
+    cache_memberships({'001/01': {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}}, 3600)
+    memberships = get_memberships()
+    assert memberships.members_of('001/01') == ['student.1']
+    assert get_memberships() is memberships
+
+    _cache_memberships({}, time.time() + 3600)
+    assert get_memberships() is not memberships
+    assert get_memberships().members_of('001/01') == []
+
+
+def test_get_memberships_for_some_scheduled_courses(cache):
+    cache_memberships({
+        '001/01': {'members': ['student.1']},
+        '002/01': {'members': ['student.2']},
+    }, 3600)
+    memberships = get_memberships(['001/01'])
+    assert len(memberships) == 1
+    assert memberships.members_of('001/01') == ['student.1']
+
+
+@patch('programmes.domain.vle')
+def test_get_memberships_is_empty_when_nothing_is_cached(mock_vle, cache):
+    mock_vle.get.return_value.status_code = 500
+    assert len(get_memberships()) == 0
+
+
+def test_patch_memberships_patches_one_shard_under_a_new_version(cache):
+    previous = cache_memberships({
+        '001/01': {'members': ['student.1']},
+        '002/01': {'members': ['student.2']},
+    }, 3600)
+    patch_memberships('001/01', lambda course: course['members'].append('student.3'))
+    manifest = cache.get(course_and_group_memberships_cache_key)
+    assert manifest['version'] == previous['version'] + 1
+    assert _get_memberships_shard_key(manifest, '001/01') != _get_memberships_shard_key(previous, '001/01')
+    assert _get_memberships_shard_key(manifest, '002/01') == _get_memberships_shard_key(previous, '002/01')
+    assert manifest['patched'] == {'001/01': manifest['version']}
+    assert get_scheduled_course_and_group_memberships_from_cache() == {
+        '001/01': {'members': ['student.1', 'student.3']},
+        '002/01': {'members': ['student.2']},
+    }
+
+
+def test_patch_memberships_adds_new_scheduled_courses(cache):
+    cache_memberships({}, 3600)
+    patch_memberships('001/01', partial(add_member, username='student.1'))
+    assert get_scheduled_course_and_group_memberships_from_cache() == {
+        '001/01': {'members': ['student.1'], 'groups': {}},
+    }
+
+
+@patch('programmes.domain.vle')
+def test_patch_memberships_does_nothing_when_nothing_is_cached(mock_vle, cache):
+    patch_memberships('001/01', partial(add_member, username='student.1'))
+    assert cache.get(course_and_group_memberships_cache_key) is None
+
+
+@override_settings(COURSE_AND_GROUP_MEMBERSHIPS_PATCH_LOCK_WAIT=0)
+@patch('programmes.domain.threading')
+def test_patch_memberships_expires_memberships_when_it_cannot_patch_them(mock_threading, cache):
+    cache_memberships({'001/01': {'members': ['student.1']}}, 3600)
+    cache.set(course_and_group_memberships_patch_lock_key, True)
+    patch_memberships('001/01', partial(add_member, username='student.2'))
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+    assert mock_threading.Thread.call_count == 1
+
+
+@override_settings(COURSE_AND_GROUP_MEMBERSHIPS_LOCK_TIMEOUT=300, VLE_TIMEOUTS={'memberships': (3, 120)}, VLE_RETRIES=2)
+@patch('programmes.domain.threading')
+def test_get_memberships_lock_outlasts_the_download_and_its_retries(mock_threading, cache):
+    cache_memberships({'001/01': {'members': ['student.1']}}, -1)
+    with patch.object(cache, 'add', wraps=cache.add) as add:
+        get_scheduled_course_and_group_memberships_from_cache()
+    assert add.call_args[0][0] == course_and_group_memberships_lock_key
+    assert add.call_args[0][2] > (3 + 120) * 3
+
+
+@override_settings(COURSE_AND_GROUP_MEMBERSHIPS_PATCH_LOCK_WAIT=0)
+def test_cache_memberships_doesnt_write_while_memberships_are_being_patched(cache):
+    previous = cache_memberships({'001/01': {'members': ['student.1']}}, 3600)
+    cache.set(course_and_group_memberships_patch_lock_key, True)
+    assert cache_memberships({'001/01': {'members': ['student.2']}}, 3600) == previous
+    assert cache.get(course_and_group_memberships_cache_key) == previous
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_applies_changes_since_last_refresh(mock_vle, cache):
+    previous = _cache_memberships({
+        '001/01': {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}},
+        '002/01': {'members': ['student.2']},
+    }, time.time() - 1, sequence=41)
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
+        'sequence': 43,
+        'changes': [
+            {'type': 'group_added', 'vle_course_id': '001/01', 'vle_group_id': '001/01/B'},
+            {'type': 'member_added', 'vle_course_id': '001/01', 'username': 'student.3', 'vle_group_id': '001/01/B'},
+            {'type': 'member_removed', 'vle_course_id': '002/01', 'username': 'student.2'},
+        ],
+    })
+    refresh_memberships_from_changes()
+    assert mock_vle.get.call_count == 1
+    assert mock_vle.get.call_args[0][0] == 'http://vle/membership_changes'
+    assert mock_vle.get.call_args[1]['params'] == {'since': 41}
+
+    manifest = cache.get(course_and_group_memberships_cache_key)
+    assert manifest['version'] == previous['version'] + 1
+    assert manifest['sequence'] == 43
+    assert manifest['expires'] > time.time()
+    assert get_scheduled_course_and_group_memberships_from_cache() == {
+        '001/01': {'members': ['student.1', 'student.3'], 'groups': {'001/01/A': ['student.1'], '001/01/B': ['student.3']}},
+        '002/01': {'members': []},
+    }
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_downloads_everything_when_nothing_is_cached(mock_vle, cache):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'001/01': {'members': ['student.1']}})
+    refresh_memberships_from_changes()
+    assert mock_vle.get.call_count == 1
+    assert mock_vle.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes', COURSE_AND_GROUP_MEMBERSHIPS_RECONCILE_INTERVAL=0)
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_reconciles_periodically(mock_vle, cache):
+    cache_memberships({'001/01': {'members': ['student.1']}}, 3600)
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'001/01': {'members': ['student.2']}})
+    refresh_memberships_from_changes()
+    assert mock_vle.get.call_args[0][0] == '{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL)
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.2']}}
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_downloads_everything_when_changes_are_not_understood(mock_vle, cache):
+    _cache_memberships({'001/01': {'members': ['student.1']}}, time.time() + 3600, sequence=1)
+    changes = MagicMock(status_code=200)
+    changes.content = encode({'sequence': 2, 'changes': [{'type': 'wibble', 'vle_course_id': '001/01'}]})
+    memberships = MagicMock(status_code=200)
+    memberships.content = encode({'001/01': {'members': ['student.2']}})
+    mock_vle.get.side_effect = [changes, memberships]
+    refresh_memberships_from_changes()
+    assert mock_vle.get.call_count == 2
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.2']}}
+
+
+@pytest.mark.parametrize('feed', [[], 'wibble', None, {'sequence': 2, 'changes': 'wibble'}, {'sequence': 2, 'changes': ['wibble']}])
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_downloads_everything_when_changes_are_malformed(mock_vle, feed, cache):
+    _cache_memberships({'001/01': {'members': ['student.1']}}, time.time() + 3600, sequence=1)
+    changes = MagicMock(status_code=200)
+    changes.content = encode(feed)
+    memberships = MagicMock(status_code=200)
+    memberships.content = encode({'001/01': {'members': ['student.2']}})
+    mock_vle.get.side_effect = [changes, memberships]
+    refresh_memberships_from_changes()
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.2']}}
+
+
+@pytest.mark.parametrize('data', [[], 'wibble', None])
+@patch('programmes.domain.vle')
+def test_refresh_memberships_keeps_last_good_memberships_when_download_is_malformed(mock_vle, data, cache):
+    previous = _cache_memberships({'001/01': {'members': ['student.1']}}, time.time() - 1)
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode(data)
+    refresh_memberships_from_changes()
+    assert cache.get(course_and_group_memberships_cache_key)['version'] == previous['version']
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1']}}
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_reads_changes_since_full_download(mock_vle, cache):
+    memberships = MagicMock(status_code=200, headers={'X-Membership-Sequence': '41'})
+    memberships.content = encode({'001/01': {'members': ['student.1']}})
+    changes = MagicMock(status_code=200)
+    changes.content = encode({
+        'sequence': 42,
+        'changes': [{'type': 'member_added', 'vle_course_id': '001/01', 'username': 'student.2'}],
+    })
+    mock_vle.get.side_effect = [memberships, changes]
+
+    # check the full download's cursor is the VLE's sequence number, not a timestamp
+    refresh_memberships_from_changes()
+    assert cache.get(course_and_group_memberships_cache_key)['sequence'] == 41
+    refresh_memberships_from_changes()
+    assert mock_vle.get.call_args[0][0] == 'http://vle/membership_changes'
+    assert mock_vle.get.call_args[1]['params'] == {'since': 41}
+    assert cache.get(course_and_group_memberships_cache_key)['sequence'] == 42
+    assert get_scheduled_course_and_group_memberships_from_cache() == {'001/01': {'members': ['student.1', 'student.2']}}
+
+
+@override_settings(MEMBERSHIP_CHANGES_URL='http://vle/membership_changes')
+@patch('programmes.domain.vle')
+def test_refresh_memberships_from_changes_downloads_everything_without_a_sequence(mock_vle, cache):
+    memberships = MagicMock(status_code=200, headers={})
+    memberships.content = encode({'001/01': {'members': ['student.1']}})
+    mock_vle.get.return_value = memberships
+
+    # check a full download the VLE didn't give a sequence number for is followed by another, not the changes feed
+    refresh_memberships_from_changes()
+    assert cache.get(course_and_group_memberships_cache_key)['sequence'] is None
+    refresh_memberships_from_changes()
+    assert [call[0][0] for call in mock_vle.get.call_args_list] == ['{}{}'.format(settings.VLEROOT, settings.MEMBERSHIPS_URL)] * 2
+
+
+@pytest.mark.django_db
+def test_get_user_ids(one_programme_student_user, no_programmes_student_user, cache):
+    assert get_user_ids([one_programme_student_user.username, no_programmes_student_user.username, 'robologo']) == {
+        one_programme_student_user.username: one_programme_student_user.id,
+        no_programmes_student_user.username: no_programmes_student_user.id,
+        'robologo': None,
+    }
+
+
+@pytest.mark.django_db
+def test_get_user_ids_are_cached(one_programme_student_user, cache, django_assert_num_queries):
+    with django_assert_num_queries(1):
+        get_user_ids([one_programme_student_user.username, 'robologo'])
+    with django_assert_num_queries(0):
+        ids = get_user_ids([one_programme_student_user.username, 'robologo'])
+    assert ids == {one_programme_student_user.username: one_programme_student_user.id, 'robologo': None}
+
+    # other processes only have the shared cache
+    _user_ids.clear()
+    with django_assert_num_queries(0):
+        assert get_user_ids([one_programme_student_user.username, 'robologo']) == ids
+
+
+@pytest.mark.django_db
+def test_get_user_ids_process_local_cache_expires(one_programme_student_user, cache):
+    username = one_programme_student_user.username
+    assert get_user_ids([username]) == {username: one_programme_student_user.id}
+
+    # another process deletes the user, which only invalidates the shared cache and its own process-local cache
+    with patch('programmes.signals.invalidate_user_id'):
+        get_user_model().objects.filter(username=username).delete()
+    cache.clear()
+    assert get_user_ids([username]) == {username: one_programme_student_user.id}
+
+    # check this process sees it once its process-local entry expires
+    with patch('programmes.caching.time.time', return_value=time.time() + _user_ids.ttl + 1):
+        assert get_user_ids([username]) == {username: None}
+
+
+@override_settings(USER_IDS_QUERY_CHUNK_SIZE=1)
+@pytest.mark.django_db
+def test_get_user_ids_queries_in_chunks(one_programme_student_user, no_programmes_student_user, cache, django_assert_num_queries):
+    with django_assert_num_queries(3):
+        get_user_ids([one_programme_student_user.username, no_programmes_student_user.username, 'robologo'])
+
+
+@pytest.mark.django_db
+def test_get_user_ids_forgets_unknown_usernames_when_users_are_created(cache):
+    assert get_user_ids(['robologo']) == {'robologo': None}
+    user = get_user_model().objects.create_user(username='robologo')
+    assert get_user_ids(['robologo']) == {'robologo': user.id}
+
+
+@pytest.mark.django_db
+def test_get_user_ids_forgets_both_usernames_when_users_are_renamed(one_programme_student_user, cache):
+    username = one_programme_student_user.username
+    assert get_user_ids([username, 'robologo']) == {username: one_programme_student_user.id, 'robologo': None}
+    user = get_user_model().objects.get(username=username)
+    user.username = 'robologo'
+    user.save()
+    assert get_user_ids([username, 'robologo']) == {username: None, 'robologo': user.id}
+
+
+@override_settings(ENROLMENTS_CACHE_TIMEOUT=60)
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_caches_enrolments(mock_vle, three_programmes_student_user, cache):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'courses': [{'masteridnumber': 'it001'}]})
+    first = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
+    assert get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user) == first
+    assert mock_vle.get.call_count == 1
+    assert hot_cache.stats['l1_hits'] > 0
+
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_caches_programme_master_courses(mock_vle, three_programmes_student_user, cache, django_assert_num_queries):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'courses': [{'masteridnumber': 'it001'}]})
+    with django_assert_num_queries(2):
+        first = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
+    with django_assert_num_queries(1):
+        assert get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user) == first
+
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_sees_programme_changes(mock_vle, three_programmes_student_user, programmes, master_courses, cache, django_capture_on_commit_callbacks):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({'courses': [{'masteridnumber': 'maths001'}]})
+    programmes_, _ = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
+    assert programmes_[1]['courses'] == []
+    with django_capture_on_commit_callbacks(execute=True):
+        ProgrammeMasterCourse.objects.create(programme=programmes[1], master_course=master_courses[0])
+    programmes_, _ = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
+    assert programmes_[1]['courses'] == [{'masteridnumber': 'maths001'}]
+
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_when_vle_is_unavailable(mock_vle, two_programmes_student_user, programmes):
+    mock_vle.get.side_effect = VLEUnavailable('VLE endpoint enrolments is unavailable')
+    l, d = get_user_enrolled_scheduled_courses_by_programme(two_programmes_student_user)
+    assert [p['courses'] for p in l] == [[], []]
+    assert d == {}
+
+
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_keeps_only_used_fields(mock_vle, three_programmes_tutor_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
+        'courses': [
+            {'masteridnumber': 'it001', 'fullname': 'Introduction to IT', 'summary': 'A very long summary'},
+        ],
+        'module_completions': {'students': []},
+        'something_else': ['unused'],
+    })
+    d, m = get_user_enrolled_scheduled_courses_by_programme(three_programmes_tutor_user, 'tutor')
+    assert d[1]['courses'] == [{'masteridnumber': 'it001', 'fullname': 'Introduction to IT'}]
+    assert m == {'students': []}
+
+
+@override_settings(ENROLMENT_COURSE_FIELDS=('masteridnumber', 'summary'))
+@patch('programmes.domain.vle')
+@pytest.mark.django_db
+def test_get_user_enrolled_scheduled_courses_by_programme_keeps_configured_fields(mock_vle, three_programmes_student_user):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = encode({
+        'courses': [
+            {'masteridnumber': 'it001', 'fullname': 'Introduction to IT', 'summary': 'A very long summary'},
+        ],
+    })
+    d, m = get_user_enrolled_scheduled_courses_by_programme(three_programmes_student_user)
+    assert d[1]['courses'] == [{'masteridnumber': 'it001', 'summary': 'A very long summary'}]
+
+
+@pytest.mark.django_db
+def test_set_module_courses(django_assert_num_queries):
+    courses = [MasterCourse.objects.create(vle_course_id=str(i), display_name=str(i)) for i in range(3)]
+    courses[1].scheduledcourse_set.create(vle_course_id='1/01', display_name='1/01', start_date=date.today() + timedelta(days=7))
+    MasterCourse.objects.update_next_runs()
+    modules = [SimpleNamespace(course_id=c.id) for c in courses]
+
+    # check the courses are set with one query
+    with django_assert_num_queries(1):
+        modules = set_module_courses(modules)
+        next_start_dates = [m.course.next_start_date for m in modules]
+    assert next_start_dates == [None, date.today() + timedelta(days=7), None]
+
+
+@pytest.mark.django_db
+def test_get_programme_structure(django_assert_num_queries):
+    programmes = [Programme.objects.create(display_name='Programme {}'.format(i)) for i in range(3)]
+    for programme in programmes:
+        for order in [2, 1]:
+            Stage.objects.create(programme=programme, display_name='Stage {}'.format(order), stage_order=order)
+        for i, available in enumerate([True, False, True]):
+            master_course = MasterCourse.objects.create(vle_course_id='{}/{}'.format(programme.id, i), display_name=str(i))
+            ProgrammeMasterCourse.objects.create(programme=programme, master_course=master_course, available=available, display_order=3 - i)
+
+    # check it takes three queries however many programmes, stages and courses there are
+    with django_assert_num_queries(3):
+        structure = [
+            (p.display_name, [(s.display_name, [c.master_course.display_name for c in s.courses_available]) for s in p.stages])
+            for p in get_programme_structure([p.id for p in programmes])
+        ]
+    assert structure[0] == ('Programme 0', [('Stage 1', ['2', '0']), ('Stage 2', ['2', '0'])])
+    assert len(structure) == 3
+
+    # check courses_available still works without it
+    stage = Stage.objects.get(programme=programmes[0], stage_order=1)
+    assert [c.master_course.display_name for c in stage.courses_available] == ['2', '0']
@@ -0,0 +1,84 @@
+import csv
+import datetime
+import io
+import json
+
+from django.core.management import call_command
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+
+import pytest
+
+from programmes.export import COLUMNS, iter_catalogue
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+
+
+@pytest.fixture
+def catalogue():
+    one = MasterCourse.objects.create(vle_course_id='001', display_name='One')
+    two = MasterCourse.objects.create(vle_course_id='002', display_name='Two')
+    MasterCourse.objects.create(vle_course_id='003', display_name='Three')
+    one_one = ScheduledCourse.objects.create(master_course=one, vle_course_id='001/01', display_name='One One',
+                                             start_date=datetime.date(2020, 9, 7))
+    ScheduledCourse.objects.create(master_course=one, vle_course_id='001/02', display_name='One Two')
+    two_one = ScheduledCourse.objects.create(master_course=two, vle_course_id='002/01', display_name='Two One')
+    ScheduledCourseGroup.objects.create(scheduled_course=two_one, vle_group_id='B', display_name='B')
+    ScheduledCourseGroup.objects.create(scheduled_course=one_one, vle_group_id='A', display_name='A')
+    ScheduledCourseGroup.objects.create(scheduled_course=one_one, vle_group_id='C', display_name='C')
+
+
+def summarise(rows):
+    index = [COLUMNS.index(c) for c in ['master_vle_course_id', 'scheduled_vle_course_id', 'group_vle_group_id']]
+    return [tuple(row[i] for i in index) for row in rows]
+
+
+@pytest.mark.django_db
+def test_iter_catalogue(catalogue):
+    with CaptureQueriesContext(connection) as queries:
+        rows = list(iter_catalogue(chunk_size=2))
+
+    # check it's like a left join of the three levels
+    assert summarise(rows) == [
+        ('001', '001/01', 'A'),
+        ('001', '001/01', 'C'),
+        ('001', '001/02', None),
+        ('002', '002/01', 'B'),
+        ('003', None, None),
+    ]
+    assert rows[0][COLUMNS.index('scheduled_start_date')] == datetime.date(2020, 9, 7)
+    assert len(queries) == 3
+
+
+@pytest.mark.django_db
+def test_export_ndjson(catalogue, client):
+    response = client.get(reverse('programmes_api:export_catalogue'))
+
+    # check it's streamed as json lines
+    assert response.streaming
+    assert response['Content-Type'] == 'application/x-ndjson'
+    lines = b''.join(response.streaming_content).decode('utf-8').splitlines()
+    assert len(lines) == 5
+    assert json.loads(lines[0])['scheduled_start_date'] == '2020-09-07'
+
+
+@pytest.mark.django_db
+def test_export_csv(catalogue, client):
+    response = client.get(reverse('programmes_api:export_catalogue'), {'format': 'csv'})
+
+    # check it's streamed as csv, with a header
+    rows = list(csv.reader(io.StringIO(b''.join(response.streaming_content).decode('utf-8'))))
+    assert rows[0] == COLUMNS
+    assert len(rows) == 6
+
+    # check an unknown format
+    assert client.get(reverse('programmes_api:export_catalogue'), {'format': 'xml'}).status_code == 400
+
+
+@pytest.mark.django_db
+def test_export_command(catalogue):
+    out = io.StringIO()
+    call_command('export_catalogue', '--format', 'csv', stdout=out)
+
+    rows = list(csv.reader(io.StringIO(out.getvalue())))
+    assert summarise(rows[1:])[-1] == ('003', '', '')
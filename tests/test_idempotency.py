@@ -0,0 +1,88 @@
+import hashlib
+import json
+
+from django.db import IntegrityError, connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.translation import gettext as _
+from django.utils.encoding import force_str
+
+import pytest
+
+from programmes.idempotency import _get_cache_key, _in_flight
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+
+
+def post(client, data, key):
+    return client.post(
+        reverse('programmes_api:create_master_course'),
+        content_type='application/json',
+        data=json.dumps(data),
+        HTTP_IDEMPOTENCY_KEY=key,
+    )
+
+
+@pytest.mark.django_db
+def test_retry_replays_response(cache, client):
+    post_data = {
+        'vle_course_id': '001',
+        'name': 'Zero Zero One',
+    }
+    response = post(client, post_data, 'abc')
+    assert response.status_code == 200
+
+    # retry, checking the catalogue isn't touched
+    with CaptureQueriesContext(connection) as queries:
+        retry = post(client, post_data, 'abc')
+    assert len(queries) == 0
+
+    # check it got the first response, rather than a 400 for the course existing
+    assert retry.status_code == 200
+    assert retry.content == response.content
+    assert MasterCourse.objects.count() == 1
+
+    # check a different key is a different request
+    response = post(client, post_data, 'def')
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_retry_while_in_flight(cache, client):
+    post_data = {
+        'vle_course_id': '001',
+        'name': 'Zero Zero One',
+    }
+    body = json.dumps(post_data).encode('utf-8')
+    cache.add(
+        _get_cache_key(reverse('programmes_api:create_master_course'), 'abc'),
+        (_in_flight, hashlib.md5(body).hexdigest()),
+    )
+
+    response = post(client, post_data, 'abc')
+
+    # check it was refused
+    assert response.status_code == 409
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('A request with this Idempotency-Key is already in progress')
+    assert not MasterCourse.objects.exists()
+
+
+@pytest.mark.django_db
+def test_key_reused_for_different_request(cache, client):
+    post(client, {'vle_course_id': '001', 'name': 'One'}, 'abc')
+
+    response = post(client, {'vle_course_id': '002', 'name': 'Two'}, 'abc')
+
+    # check it was refused
+    assert response.status_code == 422
+    assert list(MasterCourse.objects.values_list('vle_course_id', flat=True)) == ['001']
+
+
+@pytest.mark.django_db
+def test_duplicate_groups_not_allowed():
+    master = MasterCourse.objects.create(vle_course_id='001', display_name='One')
+    scheduled = ScheduledCourse.objects.create(master_course=master, vle_course_id='001/01', display_name='One One')
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='A', display_name='A')
+
+    with pytest.raises(IntegrityError):
+        ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='A', display_name='A again')
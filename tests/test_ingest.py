@@ -0,0 +1,129 @@
+import json
+
+from django.db import connection
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.translation import gettext as _
+from django.utils.encoding import force_str
+
+import pytest
+
+from programmes.ingest import drain, enqueue
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup, QueuedOperation
+
+
+@pytest.mark.django_db
+@override_settings(PROGRAMMES_API_ASYNC_INGEST=True)
+def test_view_queues_request(client):
+    post_data = {
+        'vle_course_id': '001',
+        'name': 'Zero Zero One',
+    }
+    response = client.post(reverse('programmes_api:create_master_course'), content_type='application/json', data=json.dumps(post_data))
+
+    # check it was accepted, but not applied yet
+    assert response.status_code == 202
+    data = json.loads(force_str(response.content))
+    assert data.get('successMessage') == _('Request accepted')
+    assert not MasterCourse.objects.exists()
+
+    # check it was queued
+    queued = QueuedOperation.objects.get()
+    assert queued.operation == 'create_master_course'
+    assert json.loads(queued.payload) == post_data
+
+
+@pytest.mark.django_db
+@override_settings(PROGRAMMES_API_ASYNC_INGEST=True)
+def test_view_validates_before_queueing(client):
+    response = client.post(reverse('programmes_api:create_master_course'), content_type='application/json', data=json.dumps({'name': 'x'}))
+
+    # check it wasn't accepted
+    assert response.status_code == 400
+    assert not QueuedOperation.objects.exists()
+
+
+@pytest.mark.django_db
+@override_settings(PROGRAMMES_API_ASYNC_INGEST=True)
+def test_batch_view_queues_requests(client):
+    operations = [
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One'}},
+        {'operation': 'delete_master_course', 'data': {'vle_course_id': '001'}},
+    ]
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps(operations))
+
+    # check they were queued in order
+    assert response.status_code == 202
+    assert list(QueuedOperation.objects.order_by('pk').values_list('operation', flat=True)) == [
+        'create_master_course',
+        'delete_master_course',
+    ]
+
+    # check an unknown operation isn't accepted
+    response = client.post(reverse('programmes_api:batch'), content_type='application/json', data=json.dumps([{'operation': 'wibble', 'data': {}}]))
+    assert response.status_code == 400
+
+
+@pytest.mark.django_db
+def test_drain_coalesces_updates():
+    master = MasterCourse.objects.create(vle_course_id='001', display_name='One')
+    ScheduledCourse.objects.create(master_course=master, vle_course_id='001/01', display_name='One One')
+    enqueue([
+        ('update_scheduled_course', {
+            'master_vle_course_id': '001', 'old_vle_course_id': '001/01', 'vle_course_id': '001/01', 'name': 'Edit {}'.format(i),
+        })
+        for i in range(20)
+    ])
+
+    with CaptureQueriesContext(connection) as queries:
+        assert drain() == (20, 0)
+
+    # check the last update won, in one write
+    assert ScheduledCourse.objects.get().display_name == 'Edit 19'
+    assert len([q for q in queries if q['sql'].startswith('UPDATE "programmes_scheduledcourse"')]) == 1
+    assert not QueuedOperation.objects.exists()
+
+
+@pytest.mark.django_db
+def test_drain_keeps_failures():
+    master = MasterCourse.objects.create(vle_course_id='001', display_name='One')
+    scheduled = ScheduledCourse.objects.create(master_course=master, vle_course_id='001/01', display_name='One One')
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='A', display_name='A')
+    enqueue([
+        ('create_master_course', {'vle_course_id': '002', 'name': 'Two'}),
+        ('create_master_course', {'vle_course_id': '002', 'name': 'Two again'}),
+        ('delete_master_course', {'vle_course_id': '001'}),
+        ('create_master_course', {'vle_course_id': '003', 'name': 'Three'}),
+    ])
+
+    assert drain(batch_size=2) == (2, 2)
+
+    # check the others were applied
+    assert list(MasterCourse.objects.order_by('vle_course_id').values_list('vle_course_id', flat=True)) == ['001', '002', '003']
+
+    # check the failures were kept, and aren't drained again
+    assert list(QueuedOperation.objects.order_by('pk').values_list('operation', flat=True)) == [
+        'create_master_course',
+        'delete_master_course',
+    ]
+    assert QueuedOperation.objects.first().error == _('Course with given vle_course_id already exists')
+    assert drain() == (0, 0)
+
+
+@pytest.mark.django_db
+def test_drain_keeps_poison_operations():
+    enqueue([
+        ('create_master_course', {'vle_course_id': '001', 'name': 'One', 'credits': 'abc'}),
+        ('create_master_course', {'vle_course_id': '002', 'name': 'Two'}),
+    ])
+
+    # check the bad operation doesn't stop the one after it
+    assert drain() == (1, 1)
+    assert list(MasterCourse.objects.values_list('vle_course_id', flat=True)) == ['002']
+
+    # check it was kept with its error, and isn't drained again
+    queued = QueuedOperation.objects.get()
+    assert queued.operation == 'create_master_course'
+    assert 'abc' in queued.error
+    assert drain() == (0, 0)
@@ -0,0 +1,138 @@
+import pytest
+
+from programmes.memberships import Memberships, get_shard_key, pack_shard, unpack_shard
+from programmes.memberships import add_group, rename_group, remove_group, add_member, remove_member, get_membership_change
+
+
+@pytest.fixture
+def memberships():
+    return Memberships({
+        '001/01': {
+            'members': ['student.1', 'student.2', 'tutor.1'],
+            'groups': {
+                '001/01/A': ['student.1', 'tutor.1'],
+                '001/01/B': ['student.2', 'tutor.1'],
+            },
+        },
+        '002/01': {
+            'members': ['student.1'],
+            'groups': {
+                '002/01/A': ['student.1'],
+            },
+        },
+        '003/01': {
+            'members': [],
+        },
+    })
+
+
+def test_members_of(memberships):
+    assert memberships.members_of('001/01') == ['student.1', 'student.2', 'tutor.1']
+    assert memberships.members_of('002/01') == ['student.1']
+    assert memberships.members_of('003/01') == []
+    assert memberships.members_of('004/01') == []
+
+
+def test_group_members_of(memberships):
+    assert memberships.group_members_of('001/01', '001/01/B') == ['student.2', 'tutor.1']
+    assert memberships.group_members_of('001/01', '001/01/C') == []
+    assert memberships.group_members_of('002/01', '001/01/B') == []
+
+
+def test_groups_of(memberships):
+    assert memberships.groups_of('student.1') == {('001/01', '001/01/A'), ('002/01', '002/01/A')}
+    assert memberships.groups_of('tutor.1') == {('001/01', '001/01/A'), ('001/01', '001/01/B')}
+    assert memberships.groups_of('robologo') == frozenset()
+
+
+def test_is_member(memberships):
+    assert memberships.is_member('student.2', '001/01', '001/01/B')
+    assert not memberships.is_member('student.2', '001/01', '001/01/A')
+    assert not memberships.is_member('student.2', '002/01', '001/01/B')
+    assert not memberships.is_member('robologo', '001/01', '001/01/A')
+
+
+def test_same_group_ids_in_different_courses():
+    memberships = Memberships({
+        '001/01': {'members': ['student.1'], 'groups': {'A': ['student.1']}},
+        '002/01': {'members': ['student.2'], 'groups': {'A': ['student.2']}},
+    })
+
+    # check groups only unique within their course aren't merged
+    assert memberships.group_members_of('001/01', 'A') == ['student.1']
+    assert memberships.group_members_of('002/01', 'A') == ['student.2']
+    assert memberships.is_member('student.1', '001/01', 'A')
+    assert not memberships.is_member('student.1', '002/01', 'A')
+
+
+def test_len(memberships):
+    assert len(memberships) == 3
+    assert len(Memberships({})) == 0
+
+
+def test_pack_and_unpack_shard():
+    course = {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}
+    assert unpack_shard(pack_shard(course, 'zlib'), 'zlib') == course
+
+
+def test_shard_keys_are_versioned_and_safe_for_memcached():
+    key = get_shard_key('shard', '001/01 (2020)', 1)
+    assert key != get_shard_key('shard', '001/01 (2020)', 2)
+    assert ' ' not in key
+
+
+def test_add_group():
+    course = {'members': []}
+    add_group(course, '001/01/A')
+    add_group(course, '001/01/A')
+    assert course == {'members': [], 'groups': {'001/01/A': []}}
+
+
+def test_rename_group():
+    course = {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}
+    rename_group(course, '001/01/A', '001/01/B')
+    assert course == {'members': ['student.1'], 'groups': {'001/01/B': ['student.1']}}
+
+
+def test_remove_group():
+    course = {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}
+    remove_group(course, '001/01/A')
+    remove_group(course, '001/01/Z')
+    assert course == {'members': ['student.1'], 'groups': {}}
+
+
+def test_add_member():
+    course = {}
+    add_member(course, 'student.1')
+    add_member(course, 'student.1', '001/01/A')
+    assert course == {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}
+
+
+def test_remove_member_from_group():
+    course = {'members': ['student.1'], 'groups': {'001/01/A': ['student.1'], '001/01/B': ['student.1']}}
+    remove_member(course, 'student.1', '001/01/A')
+    assert course == {'members': ['student.1'], 'groups': {'001/01/A': [], '001/01/B': ['student.1']}}
+
+
+def test_remove_member_from_course():
+    course = {'members': ['student.1', 'student.2'], 'groups': {'001/01/A': ['student.1', 'student.2']}}
+    remove_member(course, 'student.1')
+    assert course == {'members': ['student.2'], 'groups': {'001/01/A': ['student.2']}}
+
+
+def test_get_membership_change():
+    course = {'members': ['student.1'], 'groups': {'001/01/A': ['student.1']}}
+    for change in [
+        {'type': 'group_added', 'vle_group_id': '001/01/B'},
+        {'type': 'member_added', 'username': 'student.2', 'vle_group_id': '001/01/B'},
+        {'type': 'group_renamed', 'old_vle_group_id': '001/01/A', 'vle_group_id': '001/01/C'},
+        {'type': 'member_removed', 'username': 'student.1'},
+        {'type': 'group_removed', 'vle_group_id': '001/01/C'},
+    ]:
+        get_membership_change(change)(course)
+    assert course == {'members': ['student.2'], 'groups': {'001/01/B': ['student.2']}}
+
+
+def test_get_membership_change_unknown_type():
+    with pytest.raises(KeyError):
+        get_membership_change({'type': 'wibble'})
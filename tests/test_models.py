@@ -1,9 +1,12 @@
 from datetime import datetime
 
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
 import pytest
 from mock import patch
 
-from programmes.models import MasterCourse
+from programmes.models import MasterCourse, ScheduledCourse
 
 
 @patch('programmes.models.datetime')
@@ -35,4 +38,75 @@ def test_next_start_date(mock_datetime):
     )
     today = datetime.strptime('2015-01-02', '%Y-%m-%d').date()
     mock_datetime.today.return_value.date.return_value = today
+    MasterCourse.objects.filter(pk=course.pk).update_next_runs()
+    course.refresh_from_db()
     assert str(course.next_start_date) == '2015-01-02'
+    assert course.next_run.vle_course_id == '123/02'
+
+
+@pytest.mark.django_db
+def test_update_next_runs_rolls_forward():
+    for i in range(3):
+        course = MasterCourse.objects.create(vle_course_id=str(i), display_name='Master Course {}'.format(i))
+        course.scheduledcourse_set.create(
+            vle_course_id='{}/01'.format(i),
+            display_name='Scheduled Course 001',
+            start_date=datetime.strptime('2015-01-0{}'.format(i + 1), '%Y-%m-%d'),
+        )
+        course.scheduledcourse_set.create(
+            vle_course_id='{}/02'.format(i),
+            display_name='Scheduled Course 002',
+            start_date=datetime.strptime('2015-02-01', '%Y-%m-%d'),
+        )
+
+    # check every course is recomputed with one update
+    with CaptureQueriesContext(connection) as queries:
+        MasterCourse.objects.update_next_runs(datetime.strptime('2015-01-01', '%Y-%m-%d').date())
+    assert [query['sql'].split()[0] for query in queries].count('UPDATE') == 1
+    assert list(MasterCourse.objects.order_by('pk').values_list('next_run__vle_course_id', flat=True)) == ['0/01', '1/01', '2/01']
+
+    # check the next runs move on as they start
+    MasterCourse.objects.update_next_runs(datetime.strptime('2015-01-02', '%Y-%m-%d').date())
+    assert list(MasterCourse.objects.order_by('pk').values_list('next_run__vle_course_id', flat=True)) == ['0/02', '1/01', '2/01']
+    MasterCourse.objects.update_next_runs(datetime.strptime('2015-02-02', '%Y-%m-%d').date())
+    assert list(MasterCourse.objects.order_by('pk').values_list('next_start_date', 'next_run')) == [(None, None)] * 3
+
+
+@pytest.mark.django_db
+def test_calendar_queries(django_assert_num_queries):
+    course = MasterCourse.objects.create(vle_course_id='001', display_name='Master Course 001')
+    for i, (open_date, start_date, close_date) in enumerate([
+        ('2014-12-01', '2015-01-05', '2015-03-01'),  # open
+        ('2015-01-05', '2015-01-19', None),  # opening this week, and open
+        ('2014-01-01', '2014-02-01', '2014-06-01'),  # closed
+        (None, None, None),
+    ]):
+        ScheduledCourse.objects.create(
+            master_course=course,
+            vle_course_id='001/0{}'.format(i),
+            display_name=str(i),
+            open_date=open_date,
+            start_date=start_date,
+            close_date=close_date,
+        )
+    today = datetime.strptime('2015-01-07', '%Y-%m-%d').date()
+
+    def vle_course_ids(queryset):
+        return sorted(queryset.values_list('vle_course_id', flat=True))
+
+    # check the weeks start on monday
+    assert vle_course_ids(ScheduledCourse.objects.opening(1, today)) == ['001/01']
+    assert vle_course_ids(ScheduledCourse.objects.starting(1, today)) == ['001/00']
+    assert vle_course_ids(ScheduledCourse.objects.starting(3, today)) == ['001/00', '001/01']
+    assert vle_course_ids(ScheduledCourse.objects.closing(8, today)) == ['001/00']
+    assert vle_course_ids(ScheduledCourse.objects.ending(8, today)) == []
+    assert vle_course_ids(ScheduledCourse.objects.currently_open(today)) == ['001/00', '001/01']
+
+    # check the calendar is built with one query
+    with django_assert_num_queries(1):
+        calendar = ScheduledCourse.objects.calendar(3, today)
+    assert [str(monday) for monday, events in calendar] == ['2015-01-05', '2015-01-12', '2015-01-19']
+    assert [c['vle_course_id'] for c in calendar[0][1]['opening']] == ['001/01']
+    assert [c['vle_course_id'] for c in calendar[0][1]['starting']] == ['001/00']
+    assert calendar[1][1] == {'opening': [], 'starting': [], 'ending': [], 'closing': []}
+    assert calendar[2][1]['starting'][0]['master_vle_course_id'] == '001'
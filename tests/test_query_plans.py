@@ -0,0 +1,85 @@
+import datetime
+import re
+
+from django.db import connection
+
+import pytest
+
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup, UserProgramme, ProgrammeMasterCourse
+
+TODAY = datetime.date(2020, 1, 1)
+
+# the app's key queries, none of which should need to read a whole table
+QUERIES = {
+    'next run': lambda: ScheduledCourse.objects
+        .filter(master_course_id=1, start_date__gte=TODAY)
+        .order_by('start_date', 'pk')[:1],
+    'next runs to roll forward': lambda: MasterCourse.objects.filter(next_start_date__lt=TODAY),
+    'master course by vle_course_id': lambda: MasterCourse.objects.filter(vle_course_id='001'),
+    'scheduled course by vle_course_id': lambda: ScheduledCourse.objects.filter(vle_course_id='001/01'),
+    'scheduled courses by master vle_course_id': lambda: ScheduledCourse.objects.filter(master_course__vle_course_id='001'),
+    'group': lambda: ScheduledCourseGroup.objects.filter(scheduled_course_id=1, vle_group_id='001/01/A'),
+    'groups page': lambda: ScheduledCourseGroup.objects
+        .filter(scheduled_course__vle_course_id='001/01', vle_group_id__gt='A')
+        .order_by('vle_group_id')[:100],
+    'master courses page': lambda: MasterCourse.objects.filter(vle_course_id__gt='001').order_by('vle_course_id')[:100],
+    'available courses': lambda: ProgrammeMasterCourse.objects
+        .filter(programme_id=1, available=True)
+        .select_related('master_course')
+        .order_by('display_order', 'master_course__display_name'),
+    'programme vle_course_ids': lambda: ProgrammeMasterCourse.objects
+        .filter(programme_id__in=[1, 2])
+        .values_list('programme_id', 'master_course__vle_course_id'),
+    'programmes of a master course': lambda: ProgrammeMasterCourse.objects
+        .filter(master_course_id=1)
+        .values_list('programme_id', flat=True),
+    'programme members': lambda: UserProgramme.objects.filter(programme_id=1).select_related('user'),
+    'user programmes': lambda: UserProgramme.objects.filter(user_id=1).select_related('programme'),
+    'opening': lambda: ScheduledCourse.objects.opening(4, TODAY),
+    'starting': lambda: ScheduledCourse.objects.starting(4, TODAY),
+    'ending': lambda: ScheduledCourse.objects.ending(4, TODAY),
+    'closing': lambda: ScheduledCourse.objects.closing(4, TODAY),
+    'currently open': lambda: ScheduledCourse.objects.currently_open(TODAY),
+    'calendar': lambda: ScheduledCourse.objects
+        .in_calendar(4, TODAY)
+        .order_by('vle_course_id')
+        .values('vle_course_id', 'master_course__vle_course_id'),
+}
+
+
+def full_scans(queryset):
+    """
+    the tables the query's plan reads in full
+    """
+    if connection.vendor == 'sqlite':
+        # e.g. "SCAN programmes_scheduledcourse", or "SCAN TABLE programmes_scheduledcourse" before sqlite 3.36
+        return re.findall(r'\bSCAN (?:TABLE )?(\w+)', queryset.explain())
+    if connection.vendor == 'postgresql':
+        # the tables are too small for postgres to prefer an index without being pushed
+        with connection.cursor() as cursor:
+            cursor.execute('SET LOCAL enable_seqscan = off')
+        return re.findall(r'Seq Scan on (\w+)', queryset.explain())
+    pytest.skip('no plan parser for {}'.format(connection.vendor))
+
+
+@pytest.mark.django_db
+@pytest.mark.parametrize('name', sorted(QUERIES))
+def test_query_plan(name):
+    assert full_scans(QUERIES[name]()) == []
+
+
+@pytest.mark.django_db
+def test_full_scans_detected():
+    # check the test would notice a query without a usable index
+    assert full_scans(ScheduledCourse.objects.filter(display_name='x')) == ['programmes_scheduledcourse']
+
+
+@pytest.mark.django_db
+def test_currently_open_plan():
+    if connection.vendor != 'sqlite':
+        pytest.skip('only checked on sqlite')
+
+    # check it searches by close_date rather than open_date, which nearly every past course matches
+    plan = ScheduledCourse.objects.currently_open(TODAY).explain()
+    assert 'close_date' in plan
+    assert 'open_date' not in plan
@@ -0,0 +1,178 @@
+import datetime
+import gzip
+import json
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils.encoding import force_str
+
+import pytest
+from mock import patch
+
+from programmes.batch import apply_operations
+from programmes.cron import NextRunsRollForward
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup, Programme, Stage, ProgrammeMasterCourse
+
+
+@pytest.fixture
+def catalogue():
+    masters = [MasterCourse.objects.create(vle_course_id='{:03d}'.format(i), display_name='Master {}'.format(i)) for i in range(5)]
+    scheduled = ScheduledCourse.objects.create(
+        master_course=masters[0],
+        vle_course_id='000/01',
+        display_name='Scheduled',
+        start_date=datetime.date(2020, 9, 7),
+    )
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='A', display_name='A')
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='B', display_name='B')
+    return masters
+
+
+@pytest.mark.django_db
+def test_list_master_courses_pages(cache, catalogue, client):
+    url = reverse('programmes_api:list_master_courses')
+
+    # get the first page
+    response = client.get(url, {'limit': 2, 'fields': 'vle_course_id'})
+    assert response.status_code == 200
+    data = json.loads(force_str(response.content))
+    assert data == {'results': [{'vle_course_id': '000'}, {'vle_course_id': '001'}], 'next': '001'}
+
+    # get the rest
+    data = json.loads(force_str(client.get(url, {'limit': 2, 'after': data['next'], 'fields': 'vle_course_id'}).content))
+    assert data['results'] == [{'vle_course_id': '002'}, {'vle_course_id': '003'}]
+    data = json.loads(force_str(client.get(url, {'limit': 2, 'after': data['next'], 'fields': 'vle_course_id'}).content))
+    assert data == {'results': [{'vle_course_id': '004'}], 'next': None}
+
+
+@pytest.mark.django_db
+def test_list_scheduled_courses_and_groups(cache, catalogue, client):
+    data = json.loads(force_str(client.get(reverse('programmes_api:list_scheduled_courses'), {'master_vle_course_id': '000'}).content))
+    assert data['results'] == [{
+        'vle_course_id': '000/01',
+        'master_vle_course_id': '000',
+        'display_name': 'Scheduled',
+        'open_date': None,
+        'start_date': '2020-09-07',
+        'end_date': None,
+        'close_date': None,
+    }]
+
+    data = json.loads(force_str(client.get(reverse('programmes_api:list_groups'), {'vle_course_id': '000/01', 'fields': 'vle_group_id'}).content))
+    assert data['results'] == [{'vle_group_id': 'A'}, {'vle_group_id': 'B'}]
+
+
+@pytest.mark.django_db
+def test_list_bad_parameters(cache, client):
+    assert client.get(reverse('programmes_api:list_master_courses'), {'fields': 'wibble'}).status_code == 400
+    assert client.get(reverse('programmes_api:list_master_courses'), {'limit': 'x'}).status_code == 400
+    assert client.get(reverse('programmes_api:list_groups'), {'after': 'x'}).status_code == 400
+    assert client.post(reverse('programmes_api:list_groups')).status_code == 405
+
+
+@pytest.mark.django_db
+def test_list_not_modified(cache, catalogue, client, django_capture_on_commit_callbacks):
+    url = reverse('programmes_api:list_master_courses')
+    response = client.get(url)
+    etag = response['ETag']
+
+    # check an unchanged poll doesn't touch the database
+    with CaptureQueriesContext(connection) as queries:
+        response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 304
+    assert len(queries) == 0
+
+    # check a change, through a signal or a batch, is seen once it's committed, and not before
+    with django_capture_on_commit_callbacks(execute=True):
+        catalogue[0].save()
+        assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 304
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    etag = response['ETag']
+    with django_capture_on_commit_callbacks(execute=True):
+        apply_operations([{'operation': 'create_master_course', 'data': {'vle_course_id': '100', 'name': 'x'}}])
+    assert client.get(url, HTTP_IF_NONE_MATCH=etag).status_code == 200
+
+
+@pytest.mark.django_db
+def test_list_not_modified_after_roll_forward(cache, catalogue, client, django_capture_on_commit_callbacks):
+    ScheduledCourse.objects.create(
+        master_course=catalogue[0],
+        vle_course_id='000/02',
+        display_name='Later',
+        start_date=datetime.date(2020, 10, 7),
+    )
+    MasterCourse.objects.update_next_runs(datetime.date(2020, 9, 1))
+    url = reverse('programmes_api:list_master_courses')
+    etag = client.get(url)['ETag']
+
+    # roll the next runs forward, once the first has started
+    with patch('programmes.cron.datetime') as cron_datetime, patch('programmes.models.datetime') as models_datetime:
+        cron_datetime.today.return_value.date.return_value = datetime.date(2020, 9, 8)
+        models_datetime.today.return_value.date.return_value = datetime.date(2020, 9, 8)
+        with django_capture_on_commit_callbacks(execute=True):
+            NextRunsRollForward().do()
+
+    # check the old etag no longer matches, as next_start_date changed
+    response = client.get(url, HTTP_IF_NONE_MATCH=etag)
+    assert response.status_code == 200
+    assert json.loads(force_str(response.content))['results'][0]['next_start_date'] == '2020-10-07'
+
+
+@pytest.mark.django_db
+def test_list_gzipped(cache, catalogue, client):
+    response = client.get(reverse('programmes_api:list_master_courses'), HTTP_ACCEPT_ENCODING='gzip')
+
+    assert response['Content-Encoding'] == 'gzip'
+    assert len(json.loads(gzip.decompress(response.content))['results']) == 5
+
+
+@pytest.mark.django_db
+def test_programme_structure(cache, catalogue, client):
+    programme = Programme.objects.create(display_name='Programme')
+    Stage.objects.create(programme=programme, display_name='Stage 1', stage_order=1)
+    ProgrammeMasterCourse.objects.create(programme=programme, master_course=catalogue[1], display_order=2)
+    ProgrammeMasterCourse.objects.create(programme=programme, master_course=catalogue[0], display_order=1)
+    MasterCourse.objects.update_next_runs(datetime.date(2020, 1, 1))
+
+    data = json.loads(force_str(client.get(reverse('programmes_api:programme_structure', args=[programme.id])).content))
+    assert data['stages'] == [{'display_name': 'Stage 1', 'stage_order': 1}]
+    assert [(c['vle_course_id'], c['next_start_date']) for c in data['courses']] == [('000', '2020-09-07'), ('001', None)]
+
+    # check an unknown programme
+    assert client.get(reverse('programmes_api:programme_structure', args=[programme.id + 1])).status_code == 404
+
+
+@pytest.mark.django_db
+def test_course_calendar(catalogue, client):
+    ScheduledCourse.objects.create(
+        master_course=catalogue[1],
+        vle_course_id='001/01',
+        display_name='Later',
+        open_date=datetime.date(2020, 8, 31),
+        start_date=datetime.date(2020, 9, 14),
+        close_date=datetime.date(2021, 1, 1),
+    )
+    url = reverse('programmes_api:course_calendar')
+
+    # check the runs are grouped by the week of each of their dates
+    data = json.loads(force_str(client.get(url, {'weeks': 3, 'today': '2020-09-02'}).content))
+    assert [week['week'] for week in data['weeks']] == ['2020-08-31', '2020-09-07', '2020-09-14']
+    assert [[c['vle_course_id'] for c in week['opening']] for week in data['weeks']] == [['001/01'], [], []]
+    assert [[c['vle_course_id'] for c in week['starting']] for week in data['weeks']] == [[], ['000/01'], ['001/01']]
+    assert data['weeks'][2]['starting'][0] == {
+        'vle_course_id': '001/01',
+        'master_vle_course_id': '001',
+        'display_name': 'Later',
+        'open_date': '2020-08-31',
+        'start_date': '2020-09-14',
+        'end_date': None,
+        'close_date': '2021-01-01',
+    }
+    assert not any(week['ending'] or week['closing'] for week in data['weeks'])
+
+    # check bad parameters
+    assert client.get(url, {'weeks': 'x'}).status_code == 400
+    assert client.get(url, {'weeks': 0}).status_code == 400
+    assert client.get(url, {'today': 'wibble'}).status_code == 400
@@ -0,0 +1,148 @@
+import datetime
+
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+
+import pytest
+
+from programmes.batch import apply_operations
+from programmes.domain import hot_cache, programme_cache
+from programmes.models import MasterCourse, ScheduledCourse, Programme, Stage, ProgrammeMasterCourse
+from programmes.snapshots import get_programme_snapshot, get_programme_snapshots, rebuild_programme_snapshots
+
+
+@pytest.fixture
+def programme():
+    programme = Programme.objects.create(display_name='Programme')
+    Stage.objects.create(programme=programme, display_name='Stage 1', stage_order=1)
+    for i in range(2):
+        master_course = MasterCourse.objects.create(vle_course_id='00{}'.format(i), display_name='Master {}'.format(i))
+        ProgrammeMasterCourse.objects.create(programme=programme, master_course=master_course, display_order=i)
+    return programme
+
+
+def assert_rebuilt(programme_id):
+    with CaptureQueriesContext(connection) as queries:
+        snapshot = get_programme_snapshot(programme_id)
+    assert len(queries) > 0
+    return snapshot
+
+
+@pytest.mark.django_db
+def test_snapshot(cache, programme):
+    snapshot = assert_rebuilt(programme.id)
+
+    assert snapshot == {
+        'id': programme.id,
+        'display_name': 'Programme',
+        'stages': [{'display_name': 'Stage 1', 'stage_order': 1}],
+        'courses': [{
+            'vle_course_id': '00{}'.format(i),
+            'display_name': 'Master {}'.format(i),
+            'display_order': i,
+            'compulsory': False,
+            'credits': None,
+            'next_start_date': None,
+        } for i in range(2)],
+    }
+
+    # check it's then read without any queries, from either tier
+    with CaptureQueriesContext(connection) as queries:
+        assert get_programme_snapshot(programme.id) == snapshot
+        programme_cache.clear_l1()
+        assert get_programme_snapshot(programme.id) == snapshot
+    assert len(queries) == 0
+
+    # check an unknown programme
+    assert get_programme_snapshots([programme.id, programme.id + 1]) == {programme.id: snapshot}
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidated(cache, programme, django_capture_on_commit_callbacks):
+    other = Programme.objects.create(display_name='Other')
+    get_programme_snapshots([programme.id, other.id])
+
+    # check each change rebuilds the programmes it's in, and only those, once it's committed
+    with django_capture_on_commit_callbacks(execute=True):
+        Stage.objects.create(programme=programme, display_name='Stage 2', stage_order=2)
+    assert len(assert_rebuilt(programme.id)['stages']) == 2
+    with CaptureQueriesContext(connection) as queries:
+        get_programme_snapshot(other.id)
+    assert len(queries) == 0
+
+    master_course = MasterCourse.objects.get(vle_course_id='000')
+    master_course.display_name = 'Renamed'
+    with django_capture_on_commit_callbacks(execute=True):
+        master_course.save()
+    assert assert_rebuilt(programme.id)['courses'][0]['display_name'] == 'Renamed'
+
+    with django_capture_on_commit_callbacks(execute=True):
+        ProgrammeMasterCourse.objects.filter(master_course=master_course).get().delete()
+    assert len(assert_rebuilt(programme.id)['courses']) == 1
+
+    programme.display_name = 'Renamed'
+    with django_capture_on_commit_callbacks(execute=True):
+        programme.save()
+    assert assert_rebuilt(programme.id)['display_name'] == 'Renamed'
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidated_on_commit(cache, programme, django_capture_on_commit_callbacks):
+    snapshot = get_programme_snapshot(programme.id)
+
+    # check the snapshot isn't dropped, so can't be rebuilt from uncommitted data, until the change is committed
+    with django_capture_on_commit_callbacks() as callbacks:
+        programme.display_name = 'Renamed'
+        programme.save()
+        with CaptureQueriesContext(connection) as queries:
+            assert get_programme_snapshot(programme.id) == snapshot
+        assert len(queries) == 0
+    for callback in callbacks:
+        callback()
+    assert assert_rebuilt(programme.id)['display_name'] == 'Renamed'
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidated_by_next_runs(cache, programme, django_capture_on_commit_callbacks):
+    get_programme_snapshot(programme.id)
+    master_course = MasterCourse.objects.get(vle_course_id='001')
+    with django_capture_on_commit_callbacks(execute=True):
+        ScheduledCourse.objects.create(master_course=master_course, vle_course_id='001/01', display_name='x',
+                                       start_date=datetime.date(2999, 1, 1))
+    get_programme_snapshot(programme.id)
+
+    # check recomputing the next runs, which saves no instances, is seen
+    with django_capture_on_commit_callbacks(execute=True):
+        MasterCourse.objects.update_next_runs()
+    assert assert_rebuilt(programme.id)['courses'][1]['next_start_date'] == datetime.date(2999, 1, 1)
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidated_by_batch(cache, programme, django_capture_on_commit_callbacks):
+    get_programme_snapshot(programme.id)
+
+    # check a batch's bulk update, which sends no signals, is seen
+    with django_capture_on_commit_callbacks(execute=True):
+        apply_operations([
+            {'operation': 'update_master_course', 'data': {'old_vle_course_id': '000', 'vle_course_id': '100', 'name': 'New'}},
+        ])
+    assert assert_rebuilt(programme.id)['courses'][0]['vle_course_id'] == '100'
+    assert get_programme_snapshot(programme.id)['courses'][0]['display_name'] == 'New'
+
+
+@pytest.mark.django_db
+def test_rebuild_snapshots(cache, programme):
+    rebuild_programme_snapshots()
+
+    with CaptureQueriesContext(connection) as queries:
+        assert get_programme_snapshot(programme.id)['display_name'] == 'Programme'
+    assert len(queries) == 0
+
+
+@pytest.mark.django_db
+def test_snapshot_invalidation_leaves_hot_cache(cache, programme, django_capture_on_commit_callbacks):
+    # check invalidating a snapshot doesn't drop every process's memberships and enrolments
+    with django_capture_on_commit_callbacks(execute=True):
+        programme.save()
+    assert cache.get(hot_cache.generation_key) is None
+    assert cache.get(programme_cache.generation_key)
@@ -1,9 +1,13 @@
+import json
+
 from django.core.exceptions import ObjectDoesNotExist
 
 import pytest
+from mock import patch
 
-from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
-from programmes.sync import _sync_all_courses
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup, Programme, ProgrammeMasterCourse
+from programmes.sync import full_sync, _sync_all_courses
+from programmes.vle import VLEUnavailable
 
 
 @pytest.mark.django_db
@@ -436,3 +440,71 @@ def test_sync_master_vle_course_id_changed():
     master = MasterCourse.objects.get(vle_course_id='NEW_VLE_COURSE_ID')
     assert ScheduledCourse.objects.filter(master_course=master, vle_course_id='001/01').exists()
     assert not MasterCourse.objects.filter(vle_course_id='001').exists()
+
+
+@patch('programmes.sync.vle')
+@pytest.mark.django_db
+def test_full_sync_when_vle_is_unavailable(mock_vle):
+    mock_vle.get.side_effect = VLEUnavailable('VLE endpoint sync is unavailable')
+    assert full_sync() == 'Could not connect to the VLE: VLE endpoint sync is unavailable'
+    assert MasterCourse.objects.count() == 0
+
+
+@patch('programmes.sync.vle')
+@pytest.mark.django_db
+def test_full_sync(mock_vle):
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = json.dumps([
+        {
+            'vle_course_id': '001',
+            'fullname': 'How to make a lantern',
+            'weeks_duration': 30,
+            'compulsory': True,
+            'commitment': '4 days per year',
+            'credits': 20,
+            'scheduled': [{
+                'vle_course_id': '001/01',
+                'fullname': 'How to make a lantern (2999)',
+                'opendate': None,
+                'startdate': '2999-01-01',
+                'enddate': None,
+                'closedate': None,
+            }],
+        },
+    ]).encode('utf-8')
+    assert full_sync() == 'Full course synchronization completed successfully'
+    assert MasterCourse.objects.get(vle_course_id='001').display_name == 'How to make a lantern'
+    assert MasterCourse.objects.get(vle_course_id='001').next_run.vle_course_id == '001/01'
+
+
+@patch('programmes.signals.bump_catalogue_version')
+@patch('programmes.signals.invalidate_programme_snapshots')
+@patch('programmes.signals.invalidate_programme_vle_course_ids')
+@patch('programmes.sync.vle')
+@pytest.mark.django_db
+def test_full_sync_invalidates_programmes_once(mock_vle, mock_invalidate, mock_invalidate_snapshots, mock_bump):
+    programme = Programme.objects.create(display_name='Programme')
+    for i in range(3):
+        master = MasterCourse.objects.create(vle_course_id='00{}'.format(i), display_name=str(i))
+        ProgrammeMasterCourse.objects.create(programme=programme, master_course=master)
+    mock_invalidate.reset_mock()
+    mock_invalidate_snapshots.reset_mock()
+    mock_bump.reset_mock()
+    mock_vle.get.return_value.status_code = 200
+    mock_vle.get.return_value.content = json.dumps([{
+        'vle_course_id': '00{}'.format(i),
+        'fullname': 'Renamed {}'.format(i),
+        'weeks_duration': None,
+        'compulsory': False,
+        'commitment': None,
+        'credits': None,
+        'scheduled': [],
+    } for i in range(3)]).encode('utf-8')
+    full_sync()
+
+    # check the programmes were invalidated, and the catalogue version bumped, once at the end rather than for each
+    # course saved
+    assert mock_invalidate.call_count == 1
+    assert list(mock_invalidate.call_args[0][0]) == [programme.id]
+    assert not mock_invalidate_snapshots.called
+    assert mock_bump.call_count == 1
@@ -1,13 +1,18 @@
 import base64
 import json
+import time
 
 from django.conf import settings
+from django.core.cache import caches
+from django.db import IntegrityError
 from django.urls import reverse
 from django.utils.translation import gettext as _
 from django.utils.encoding import force_str
 
 import pytest
+from mock import patch
 
+from programmes.domain import _cache_memberships, get_scheduled_course_and_group_memberships_from_cache, hot_cache
 from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
 
 
@@ -16,6 +21,23 @@ def auth_headers():
     return {}
 
 
+@pytest.fixture
+def cached_memberships():
+    cache = caches['default']
+    cache.clear()
+    hot_cache.clear_l1()
+    yield _cache_memberships({
+        '001/01': {
+            'members': ['student.1', 'student.2'],
+            'groups': {
+                '001/01/A': ['student.1'],
+            },
+        },
+    }, time.time() + 3600)
+    cache.clear()
+    hot_cache.clear_l1()
+
+
 @pytest.fixture
 def master_course():
     return MasterCourse.objects.create(
@@ -842,6 +864,55 @@ def test_update_group_successfully(auth_headers, client, scheduled_course_group)
     assert ScheduledCourseGroup.objects.count() == 1
 
 
+@pytest.mark.django_db
+def test_update_group_to_existing_vle_group_id(auth_headers, client, scheduled_course_group):
+    ScheduledCourseGroup.objects.create(
+        scheduled_course=scheduled_course_group.scheduled_course,
+        vle_group_id='001/01/B',
+        display_name='Group B',
+    )
+
+    # make a request
+    post_data = {
+        'vle_course_id': '001/01',
+        'old_vle_group_id': '001/01/A',
+        'vle_group_id': '001/01/B',
+        'name': 'Group B again',
+    }
+    response = client.post(reverse('programmes_api:update_group'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it wasn't successful
+    assert response.status_code == 400
+
+    # check the JSON
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Group with given vle_course_id and vle_group_id already exists')
+
+    # check neither group changed
+    assert sorted(ScheduledCourseGroup.objects.values_list('vle_group_id', 'display_name')) == [
+        ('001/01/A', scheduled_course_group.display_name),
+        ('001/01/B', 'Group B'),
+    ]
+
+
+@pytest.mark.django_db
+def test_update_group_to_concurrently_created_vle_group_id(auth_headers, client, scheduled_course_group):
+    # make a request, as another request takes the new vle_group_id after it's checked
+    post_data = {
+        'vle_course_id': '001/01',
+        'old_vle_group_id': '001/01/A',
+        'vle_group_id': '001/01/B',
+        'name': 'Group B',
+    }
+    with patch.object(ScheduledCourseGroup, 'save', side_effect=IntegrityError):
+        response = client.post(reverse('programmes_api:update_group'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it wasn't successful
+    assert response.status_code == 400
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Group with given vle_course_id and vle_group_id already exists')
+
+
 @pytest.mark.django_db
 def test_delete_group_missing_field(auth_headers, client):
     # make a request
@@ -895,3 +966,154 @@ def test_delete_group_successfully(auth_headers, client, scheduled_course, sched
 
     # check the other ScheduledCourseGroup hasn't been deleted
     assert ScheduledCourseGroup.objects.filter(scheduled_course=scheduled_course, vle_group_id='001/01/B').count() == 1
+
+
+@pytest.mark.django_db
+def test_create_group_patches_cached_memberships(auth_headers, scheduled_course, cached_memberships, client):
+    post_data = {
+        'vle_course_id': '001/01',
+        'vle_group_id': '001/01/B',
+        'name': 'Group B',
+    }
+    response = client.post(reverse('programmes_api:create_group'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+    assert response.status_code == 200
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01']['groups'] == {
+        '001/01/A': ['student.1'],
+        '001/01/B': [],
+    }
+
+
+@pytest.mark.django_db
+def test_update_group_patches_cached_memberships(auth_headers, scheduled_course_group, cached_memberships, client):
+    post_data = {
+        'vle_course_id': '001/01',
+        'old_vle_group_id': '001/01/A',
+        'vle_group_id': '001/01/C',
+        'name': 'Group C',
+    }
+    response = client.post(reverse('programmes_api:update_group'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+    assert response.status_code == 200
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01']['groups'] == {
+        '001/01/C': ['student.1'],
+    }
+
+
+@pytest.mark.django_db
+def test_delete_group_patches_cached_memberships(auth_headers, scheduled_course_group, cached_memberships, client):
+    post_data = {
+        'vle_course_id': '001/01',
+        'vle_group_id': '001/01/A',
+    }
+    response = client.post(reverse('programmes_api:delete_group'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+    assert response.status_code == 200
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01']['groups'] == {}
+
+
+@pytest.mark.django_db
+def test_create_membership_missing_fields(auth_headers, client):
+    # make a request
+    post_data = {
+        'vle_course_id': '001/01',
+    }
+    response = client.post(reverse('programmes_api:create_membership'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it wasn't successful
+    assert response.status_code == 400
+
+    # check the JSON
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Must specify vle_course_id and username')
+
+
+@pytest.mark.django_db
+def test_create_membership_successfully(auth_headers, cached_memberships, client):
+    # make a request
+    post_data = {
+        'vle_course_id': '001/01',
+        'vle_group_id': '001/01/A',
+        'username': 'student.2',
+    }
+    response = client.post(reverse('programmes_api:create_membership'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it was successful
+    assert response.status_code == 200
+
+    # check the JSON
+    data = json.loads(force_str(response.content))
+    assert data.get('successMessage') == _('Membership created successfully!')
+
+    # check the cached memberships
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01'] == {
+        'members': ['student.1', 'student.2'],
+        'groups': {
+            '001/01/A': ['student.1', 'student.2'],
+        },
+    }
+
+
+@pytest.mark.django_db
+def test_delete_membership_missing_fields(auth_headers, client):
+    # make a request
+    post_data = {
+        'username': 'student.1',
+    }
+    response = client.post(reverse('programmes_api:delete_membership'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it wasn't successful
+    assert response.status_code == 400
+
+    # check the JSON
+    data = json.loads(force_str(response.content))
+    assert data.get('errorMessage') == _('Must specify vle_course_id and username')
+
+
+@pytest.mark.django_db
+def test_delete_membership_successfully(auth_headers, cached_memberships, client):
+    # make a request
+    post_data = {
+        'vle_course_id': '001/01',
+        'username': 'student.1',
+    }
+    response = client.post(reverse('programmes_api:delete_membership'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it was successful
+    assert response.status_code == 200
+
+    # check the JSON
+    data = json.loads(force_str(response.content))
+    assert data.get('successMessage') == _('Membership deleted successfully!')
+
+    # check the cached memberships
+    assert get_scheduled_course_and_group_memberships_from_cache()['001/01'] == {
+        'members': ['student.2'],
+        'groups': {
+            '001/01/A': [],
+        },
+    }
+
+
+@pytest.mark.django_db
+def test_scheduled_course_endpoints_update_next_run(auth_headers, master_course, client):
+    # create a scheduled course starting in the future
+    post_data = {
+        'master_vle_course_id': '001',
+        'vle_course_id': '001/01',
+        'name': 'Zero Zero One / Zero One',
+        'startdate': '2999-01-01',
+    }
+    client.post(reverse('programmes_api:create_scheduled_course'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+
+    # check it's the master course's next run
+    master_course.refresh_from_db()
+    assert str(master_course.next_start_date) == '2999-01-01'
+    assert master_course.next_run.vle_course_id == '001/01'
+
+    # delete it, and check the master course has no next run
+    post_data = {
+        'master_vle_course_id': '001',
+        'vle_course_id': '001/01',
+    }
+    client.post(reverse('programmes_api:delete_scheduled_course'), content_type='application/json', data=json.dumps(post_data), **auth_headers)
+    master_course.refresh_from_db()
+    assert master_course.next_start_date is None
+    assert master_course.next_run is None
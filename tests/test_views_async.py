@@ -0,0 +1,91 @@
+import json
+
+from asgiref.sync import async_to_sync
+from django.core.cache import caches
+from django.test import RequestFactory
+from django.utils.translation import gettext as _
+from django.utils.encoding import force_str
+
+import pytest
+
+from programmes import views_async
+from programmes.models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+
+
+def post(view, data, **extra):
+    request = RequestFactory().post('/', content_type='application/json', data=json.dumps(data), **extra)
+    return async_to_sync(view)(request)
+
+
+@pytest.mark.django_db
+def test_create_master_course_successfully():
+    response = post(views_async.create_master_course, {'vle_course_id': '001', 'name': 'Zero Zero One', 'credits': 15})
+
+    # check it was successful
+    assert response.status_code == 200
+    data = json.loads(force_str(response.content))
+    assert data.get('successMessage') == _('Course created successfully!')
+    assert MasterCourse.objects.get(vle_course_id='001').credits == 15
+
+
+@pytest.mark.django_db
+def test_create_master_course_errors():
+    MasterCourse.objects.create(vle_course_id='001', display_name='foobar')
+
+    # check missing fields
+    response = post(views_async.create_master_course, {'name': 'Zero Zero One'})
+    assert response.status_code == 400
+    assert json.loads(force_str(response.content)).get('errorMessage') == _('Must specify vle_course_id and name')
+
+    # check the course already existing
+    response = post(views_async.create_master_course, {'vle_course_id': '001', 'name': 'wibble'})
+    assert response.status_code == 400
+    assert json.loads(force_str(response.content)).get('errorMessage') == _('Course with given vle_course_id already exists')
+
+
+def test_only_post():
+    response = async_to_sync(views_async.update_group)(RequestFactory().get('/'))
+
+    assert response.status_code == 405
+    assert views_async.update_group.csrf_exempt
+
+
+@pytest.mark.django_db
+def test_delete_scheduled_course_with_groups():
+    master = MasterCourse.objects.create(vle_course_id='001', display_name='One')
+    scheduled = ScheduledCourse.objects.create(master_course=master, vle_course_id='001/01', display_name='One One')
+    ScheduledCourseGroup.objects.create(scheduled_course=scheduled, vle_group_id='A', display_name='A')
+
+    response = post(views_async.delete_scheduled_course, {'master_vle_course_id': '001', 'vle_course_id': '001/01'})
+
+    # check it was refused
+    assert response.status_code == 400
+    assert ScheduledCourse.objects.exists()
+
+
+@pytest.mark.django_db
+def test_batch():
+    response = post(views_async.batch, [
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One'}},
+        {'operation': 'create_master_course', 'data': {'vle_course_id': '001', 'name': 'One'}},
+    ])
+
+    # check the results
+    assert response.status_code == 200
+    assert json.loads(force_str(response.content))['results'] == [
+        {'successMessage': _('Course created successfully!')},
+        {'errorMessage': _('Course with given vle_course_id already exists')},
+    ]
+
+
+@pytest.mark.django_db
+def test_idempotent_retry():
+    caches['default'].clear()
+    post_data = {'vle_course_id': '001', 'name': 'One'}
+
+    response = post(views_async.create_master_course, post_data, HTTP_IDEMPOTENCY_KEY='abc')
+    retry = post(views_async.create_master_course, post_data, HTTP_IDEMPOTENCY_KEY='abc')
+
+    # check the retry got the first response
+    assert retry.status_code == response.status_code == 200
+    caches['default'].clear()
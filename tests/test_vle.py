@@ -0,0 +1,115 @@
+from django.test import override_settings
+
+import pytest
+import requests
+from mock import MagicMock, patch
+
+from programmes.vle import CircuitBreaker, VLEClient, VLEUnavailable, get_max_duration
+
+
+@pytest.fixture
+def client():
+    client = VLEClient()
+    client.session = MagicMock()
+    return client
+
+
+def response(status_code):
+    return MagicMock(status_code=status_code)
+
+
+def test_circuit_breaker_opens_when_calls_fail():
+    breaker = CircuitBreaker(window=4, minimum_calls=4, failure_rate=0.5)
+    for failed in [False, False, True]:
+        breaker.record(0.1, failed)
+    assert breaker.state == CircuitBreaker.CLOSED
+    breaker.record(0.1, True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+def test_circuit_breaker_opens_when_calls_are_slow():
+    breaker = CircuitBreaker(window=2, minimum_calls=2, failure_rate=1, slow_call_duration=1.0)
+    breaker.record(1.5, False)
+    breaker.record(2.0, False)
+    assert breaker.state == CircuitBreaker.OPEN
+
+
+@patch('programmes.vle.time')
+def test_circuit_breaker_lets_one_trial_call_through_after_reset_timeout(mock_time):
+    mock_time.monotonic.return_value = 100
+    breaker = CircuitBreaker(window=1, minimum_calls=1, reset_timeout=30)
+    breaker.record(0.1, True)
+    mock_time.monotonic.return_value = 129
+    assert not breaker.allow()
+    mock_time.monotonic.return_value = 130
+    assert breaker.allow()
+    assert breaker.state == CircuitBreaker.HALF_OPEN
+    assert not breaker.allow()
+
+    # a successful trial call closes it
+    breaker.record(0.1, False)
+    assert breaker.state == CircuitBreaker.CLOSED
+    assert breaker.allow()
+
+
+@patch('programmes.vle.time')
+def test_circuit_breaker_reopens_when_trial_call_fails(mock_time):
+    mock_time.monotonic.return_value = 100
+    breaker = CircuitBreaker(window=1, minimum_calls=1, reset_timeout=30)
+    breaker.record(0.1, True)
+    mock_time.monotonic.return_value = 130
+    assert breaker.allow()
+    breaker.record(0.1, True)
+    assert breaker.state == CircuitBreaker.OPEN
+    assert not breaker.allow()
+
+
+@override_settings(VLE_TIMEOUTS={'enrolments': (1, 2)})
+def test_client_uses_endpoint_timeouts(client):
+    client.session.request.return_value = response(200)
+    client.get('http://vle/enrolments', params={'username': 'bob'}, endpoint='enrolments')
+    assert client.session.request.call_args[0] == ('GET', 'http://vle/enrolments')
+    assert client.session.request.call_args[1] == {'timeout': (1, 2), 'params': {'username': 'bob'}}
+
+
+@override_settings(VLE_RETRIES=2, VLE_RETRY_BACKOFF=0)
+def test_client_retries_gets(client):
+    client.session.request.side_effect = [requests.ConnectionError(), response(503), response(200)]
+    assert client.get('http://vle/enrolments').status_code == 200
+    assert client.session.request.call_count == 3
+
+
+@override_settings(VLE_RETRIES=1, VLE_RETRY_BACKOFF=0)
+def test_client_gives_up_after_retries(client):
+    client.session.request.side_effect = [response(503), response(502)]
+    assert client.get('http://vle/enrolments').status_code == 502
+    client.session.request.side_effect = [requests.ConnectionError(), requests.ConnectionError()]
+    with pytest.raises(requests.ConnectionError):
+        client.get('http://vle/enrolments')
+
+
+@override_settings(VLE_RETRIES=2, VLE_RETRY_BACKOFF=0)
+def test_client_does_not_retry_posts(client):
+    client.session.request.return_value = response(503)
+    assert client.post('http://vle/batch_enrolments', json={}).status_code == 503
+    assert client.session.request.call_count == 1
+
+
+@override_settings(VLE_RETRIES=0, VLE_CIRCUIT_BREAKER={'window': 2, 'minimum_calls': 2})
+def test_client_fails_fast_when_circuit_breaker_is_open(client):
+    client.session.request.return_value = response(500)
+    client.get('http://vle/enrolments', endpoint='enrolments')
+    client.get('http://vle/enrolments', endpoint='enrolments')
+    with pytest.raises(VLEUnavailable):
+        client.get('http://vle/enrolments', endpoint='enrolments')
+    assert client.session.request.call_count == 2
+
+    # other endpoints have their own circuit breakers
+    client.get('http://vle/memberships', endpoint='memberships')
+    assert client.session.request.call_count == 3
+
+
+@override_settings(VLE_TIMEOUTS={'memberships': (3, 120)}, VLE_RETRIES=2, VLE_RETRY_BACKOFF=0.5)
+def test_max_duration_covers_every_attempt_and_backoff():
+    assert get_max_duration('memberships') == 123 * 3 + 0.5 + 1
@@ -1,18 +1,29 @@
+from django.conf import settings
 from django.conf.urls import url
 
-from .views import create_master_course, update_master_course, delete_master_course
-from .views import create_scheduled_course, update_scheduled_course, delete_scheduled_course
-from .views import create_group, update_group, delete_group
+from . import views, views_async
+
+# the course and group endpoints can be served by native async views instead, for ASGI deployments
+api_views = views_async if getattr(settings, 'PROGRAMMES_API_ASYNC', False) else views
 
 app_name = 'Programmes'
 urlpatterns = [
-    url(r'^create/master/$', create_master_course, name='create_master_course'),
-    url(r'^update/master/$', update_master_course, name='update_master_course'),
-    url(r'^delete/master/$', delete_master_course, name='delete_master_course'),
-    url(r'^create/scheduled/$', create_scheduled_course, name='create_scheduled_course'),
-    url(r'^update/scheduled/$', update_scheduled_course, name='update_scheduled_course'),
-    url(r'^delete/scheduled/$', delete_scheduled_course, name='delete_scheduled_course'),
-    url(r'^create/group/$', create_group, name='create_group'),
-    url(r'^update/group/$', update_group, name='update_group'),
-    url(r'^delete/group/$', delete_group, name='delete_group'),
+    url(r'^create/master/$', api_views.create_master_course, name='create_master_course'),
+    url(r'^update/master/$', api_views.update_master_course, name='update_master_course'),
+    url(r'^delete/master/$', api_views.delete_master_course, name='delete_master_course'),
+    url(r'^create/scheduled/$', api_views.create_scheduled_course, name='create_scheduled_course'),
+    url(r'^update/scheduled/$', api_views.update_scheduled_course, name='update_scheduled_course'),
+    url(r'^delete/scheduled/$', api_views.delete_scheduled_course, name='delete_scheduled_course'),
+    url(r'^create/group/$', api_views.create_group, name='create_group'),
+    url(r'^update/group/$', api_views.update_group, name='update_group'),
+    url(r'^delete/group/$', api_views.delete_group, name='delete_group'),
+    url(r'^create/membership/$', views.create_membership, name='create_membership'),
+    url(r'^delete/membership/$', views.delete_membership, name='delete_membership'),
+    url(r'^batch/$', api_views.batch, name='batch'),
+    url(r'^list/master/$', views.list_master_courses, name='list_master_courses'),
+    url(r'^list/scheduled/$', views.list_scheduled_courses, name='list_scheduled_courses'),
+    url(r'^list/group/$', views.list_groups, name='list_groups'),
+    url(r'^calendar/$', views.course_calendar, name='course_calendar'),
+    url(r'^export/$', views.export_catalogue, name='export_catalogue'),
+    url(r'^programme/(?P<programme_id>\d+)/structure/$', views.programme_structure, name='programme_structure'),
 ]
@@ -1,16 +1,26 @@
-import json
+from functools import partial
 
 from django.conf import settings
 from django.contrib import messages
 from django.contrib.admin.views.decorators import staff_member_required
+from django.db import IntegrityError, transaction
+from django.db.models import ProtectedError
 from django.urls import reverse
-from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseNotFound
+from django.http.response import HttpResponse, HttpResponseRedirect, HttpResponseNotFound, StreamingHttpResponse
 from django.utils.translation import gettext as _
-from django.utils.encoding import force_str
 from django.views.decorators.csrf import csrf_exempt
-from django.views.decorators.http import require_http_methods
-
-from .models import MasterCourse, ScheduledCourse, ScheduledCourseGroup
+from django.views.decorators.gzip import gzip_page
+from django.views.decorators.http import condition, require_GET, require_http_methods
+
+from . import codec
+from .batch import OPERATIONS, apply_operations
+from .domain import get_catalogue_version, patch_memberships
+from .export import CONTENT_TYPES, FORMATS, iter_catalogue
+from .idempotency import idempotent
+from .ingest import enqueue, is_async
+from .memberships import add_group, rename_group, remove_group, add_member, remove_member
+from .models import CALENDAR_EVENTS, MasterCourse, ScheduledCourse, ScheduledCourseGroup
+from .snapshots import get_programme_snapshot
 from .sync import full_sync, get_datetime_or_none
 
 
@@ -22,13 +32,14 @@ def full_sync_view(request):
 
 @csrf_exempt  # has to be the first decorator, apparently, or it doesn't work
 @require_http_methods(['POST'])
+@idempotent
 def create_master_course(request):
     """
     create a new master course
     """
 
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     vle_course_id = data.get('vle_course_id', '')
     name = data.get('name', '')
 
@@ -36,6 +47,10 @@ def create_master_course(request):
     if not vle_course_id or not name:
         return _error400(_('Must specify vle_course_id and name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('create_master_course', data)])
+
     # check MasterCourse doesn't already exist
     if MasterCourse.objects.filter(vle_course_id=vle_course_id).exists():
         return _error400(_('Course with given vle_course_id already exists'))
@@ -56,6 +71,7 @@ def create_master_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def update_master_course(request):
     """
     update a MasterCourse (matching its vle_course_id)
@@ -63,7 +79,7 @@ def update_master_course(request):
     """
 
     # get the required data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     old_vle_course_id = data.get('old_vle_course_id', '')
     vle_course_id = data.get('vle_course_id', '')
     name = data.get('name', '')
@@ -72,6 +88,10 @@ def update_master_course(request):
     if not old_vle_course_id or not vle_course_id or not name:
         return _error400(_('Must specify old_vle_course_id, vle_course_id, name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('update_master_course', data)])
+
     # check MasterCourse given by old_vle_course_id actually exists
     if not MasterCourse.objects.filter(vle_course_id=old_vle_course_id).exists():
         return _error400(_('Course with given old_vle_course_id does not exist'))
@@ -92,19 +112,24 @@ def update_master_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def delete_master_course(request):
     """
     delete an existing MasterCourse (matching its vle_course_id)
     """
 
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     vle_course_id = data.get('vle_course_id', '')
 
     # make sure vle_course_id was given
     if not vle_course_id:
         return _error400(_('Must specify vle_course_id'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('delete_master_course', data)])
+
     # check MasterCourse given by vle_course_id actually exists
     if not MasterCourse.objects.filter(vle_course_id=vle_course_id).exists():
         return _error400(_('Course with given vle_course_id does not exist'))
@@ -119,13 +144,14 @@ def delete_master_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def create_scheduled_course(request):
     """
     create a new scheduled course
     """
 
     # get the required data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     master_vle_course_id = data.get('master_vle_course_id', '')
     vle_course_id = data.get('vle_course_id', '')
     name = data.get('name', '')
@@ -134,6 +160,10 @@ def create_scheduled_course(request):
     if not all([master_vle_course_id, vle_course_id, name]):
         return _error400(_('Must specify master_vle_course_id, vle_course_id and name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('create_scheduled_course', data)])
+
     # check ScheduledCourse doesn't already exist
     if ScheduledCourse.objects.filter(vle_course_id=vle_course_id).exists():
         return _error400(_('Course with given vle_course_id already exists'))
@@ -160,6 +190,7 @@ def create_scheduled_course(request):
         end_date=get_datetime_or_none(end_date, '%Y-%m-%d'),
         close_date=get_datetime_or_none(close_date, '%Y-%m-%d'),
     )
+    MasterCourse.objects.filter(pk=master.pk).update_next_runs()
 
     # return JSON response
     return _success200(_('Course created successfully!'))
@@ -167,6 +198,7 @@ def create_scheduled_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def update_scheduled_course(request):
     """
     update a ScheduledCourse (matching its vle_course_id and the master course's vle_course_id)
@@ -174,7 +206,7 @@ def update_scheduled_course(request):
     """
 
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     master_vle_course_id = data.get('master_vle_course_id', '')
     old_vle_course_id = data.get('old_vle_course_id', '')
     vle_course_id = data.get('vle_course_id', '')
@@ -184,6 +216,10 @@ def update_scheduled_course(request):
     if not all([master_vle_course_id, old_vle_course_id, vle_course_id, name]):
         return _error400(_('Must specify master_vle_course_id, old_vle_course_id, vle_course_id and name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('update_scheduled_course', data)])
+
     # check ScheduledCourse given by old_vle_course_id and master_vle_course_id actually exists
     if not ScheduledCourse.objects.filter(
             vle_course_id=old_vle_course_id, master_course__vle_course_id=master_vle_course_id).exists():
@@ -204,6 +240,7 @@ def update_scheduled_course(request):
     course.end_date = get_datetime_or_none(end_date, '%Y-%m-%d')
     course.close_date = get_datetime_or_none(close_date, '%Y-%m-%d')
     course.save()
+    MasterCourse.objects.filter(pk=course.master_course_id).update_next_runs()
 
     # return JSON response
     return _success200(_('Course updated successfully!'))
@@ -211,13 +248,14 @@ def update_scheduled_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def delete_scheduled_course(request):
     """
     delete an existing ScheduledCourse (matching its vle_course_id)
     """
 
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     master_vle_course_id = data.get('master_vle_course_id', '')
     vle_course_id = data.get('vle_course_id', '')
 
@@ -225,13 +263,19 @@ def delete_scheduled_course(request):
     if not vle_course_id or not master_vle_course_id:
         return _error400(_('Must specify master_vle_course_id and vle_course_id'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('delete_scheduled_course', data)])
+
     # check ScheduledCourse given by old_vle_course_id and master_vle_course_id actually exists
     if not ScheduledCourse.objects.filter(
             vle_course_id=vle_course_id, master_course__vle_course_id=master_vle_course_id).exists():
         return _error400(_('Course with given old_vle_course_id and master_vle_course_id does not exist'))
 
     # delete course
-    ScheduledCourse.objects.get(vle_course_id=vle_course_id).delete()
+    course = ScheduledCourse.objects.get(vle_course_id=vle_course_id)
+    course.delete()
+    MasterCourse.objects.filter(pk=course.master_course_id).update_next_runs()
 
     # return JSON response
     return _success200(_('Course deleted successfully!'))
@@ -239,9 +283,10 @@ def delete_scheduled_course(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def create_group(request):
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     vle_course_id = data.get('vle_course_id', '')
     vle_group_id = data.get('vle_group_id', '')
     name = data.get('name', '')
@@ -250,6 +295,10 @@ def create_group(request):
     if not vle_course_id or not vle_group_id or not name:
         return _error400(_('Must specify vle_course_id, vle_group_id, name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('create_group', data)])
+
     # check ScheduledCourse exists
     try:
         scheduled_course = ScheduledCourse.objects.get(vle_course_id=vle_course_id)
@@ -260,8 +309,13 @@ def create_group(request):
     if ScheduledCourseGroup.objects.filter(scheduled_course=scheduled_course, vle_group_id=vle_group_id).exists():
         return _error400(_('Group with given vle_course_id and vle_group_id already exists'))
 
-    # create ScheduledCourseGroup
-    ScheduledCourseGroup.objects.create(scheduled_course=scheduled_course, vle_group_id=vle_group_id, display_name=name)
+    # create ScheduledCourseGroup, unless a concurrent request just has
+    try:
+        with transaction.atomic():
+            ScheduledCourseGroup.objects.create(scheduled_course=scheduled_course, vle_group_id=vle_group_id, display_name=name)
+    except IntegrityError:
+        return _error400(_('Group with given vle_course_id and vle_group_id already exists'))
+    patch_memberships(vle_course_id, partial(add_group, vle_group_id=vle_group_id))
 
     # return JSON response
     return _success200(_('Group created successfully!'))
@@ -269,9 +323,10 @@ def create_group(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def update_group(request):
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     vle_course_id = data.get('vle_course_id', '')
     old_vle_group_id = data.get('old_vle_group_id', '')
     vle_group_id = data.get('vle_group_id', '')
@@ -281,6 +336,10 @@ def update_group(request):
     if not vle_course_id or not old_vle_group_id or not vle_group_id or not name:
         return _error400(_('Must specify vle_course_id, old_vle_group_id, vle_group_id, name'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('update_group', data)])
+
     # check ScheduledCourse exists
     try:
         scheduled_course = ScheduledCourse.objects.get(vle_course_id=vle_course_id)
@@ -291,11 +350,22 @@ def update_group(request):
     if not ScheduledCourseGroup.objects.filter(scheduled_course=scheduled_course, vle_group_id=old_vle_group_id).exists():
         return _error400(_('Group with given vle_course_id and old_vle_group_id does not exist'))
 
-    # update group
+    # check it isn't being renamed to another ScheduledCourseGroup's vle_group_id
+    if vle_group_id != old_vle_group_id and \
+            ScheduledCourseGroup.objects.filter(scheduled_course=scheduled_course, vle_group_id=vle_group_id).exists():
+        return _error400(_('Group with given vle_course_id and vle_group_id already exists'))
+
+    # update group, unless a concurrent request has just taken its new vle_group_id
     group = ScheduledCourseGroup.objects.get(scheduled_course=scheduled_course, vle_group_id=old_vle_group_id)
     group.vle_group_id = vle_group_id
     group.display_name = name
-    group.save()
+    try:
+        with transaction.atomic():
+            group.save()
+    except IntegrityError:
+        return _error400(_('Group with given vle_course_id and vle_group_id already exists'))
+    if vle_group_id != old_vle_group_id:
+        patch_memberships(vle_course_id, partial(rename_group, old_vle_group_id=old_vle_group_id, vle_group_id=vle_group_id))
 
     # return JSON response
     return _success200(_('Group updated successfully!'))
@@ -303,9 +373,10 @@ def update_group(request):
 
 @csrf_exempt
 @require_http_methods(['POST'])
+@idempotent
 def delete_group(request):
     # get the data from the request
-    data = json.loads(force_str(request.body))
+    data = codec.loads(request.body)
     vle_course_id = data.get('vle_course_id', '')
     vle_group_id = data.get('vle_group_id', '')
 
@@ -313,6 +384,10 @@ def delete_group(request):
     if not vle_course_id or not vle_group_id:
         return _error400(_('Must specify vle_course_id and vle_group_id'))
 
+    # queue it to be applied later if ingesting asynchronously
+    if is_async():
+        return _accepted202([('delete_group', data)])
+
     # check ScheduledCourse exists
     try:
         scheduled_course = ScheduledCourse.objects.get(vle_course_id=vle_course_id)
@@ -325,25 +400,301 @@ def delete_group(request):
 
     # delete group
     ScheduledCourseGroup.objects.filter(scheduled_course=scheduled_course, vle_group_id=vle_group_id).delete()
+    patch_memberships(vle_course_id, partial(remove_group, vle_group_id=vle_group_id))
 
     # return JSON response
     return _success200(_('Group deleted successfully!'))
 
 
+@csrf_exempt
+@require_http_methods(['POST'])
+@idempotent
+def create_membership(request):
+    """
+    add a user to a ScheduledCourse, and optionally to one of its groups, in the cached memberships
+    """
+
+    # get the data from the request
+    data = codec.loads(request.body)
+    vle_course_id = data.get('vle_course_id', '')
+    vle_group_id = data.get('vle_group_id', '')
+    username = data.get('username', '')
+
+    # make sure vle_course_id and username were given
+    if not vle_course_id or not username:
+        return _error400(_('Must specify vle_course_id and username'))
+
+    # update the cached memberships
+    patch_memberships(vle_course_id, partial(add_member, username=username, vle_group_id=vle_group_id))
+
+    # return JSON response
+    return _success200(_('Membership created successfully!'))
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+@idempotent
+def delete_membership(request):
+    """
+    remove a user from one group of a ScheduledCourse if vle_group_id is given, otherwise from the course and all
+    its groups, in the cached memberships
+    """
+
+    # get the data from the request
+    data = codec.loads(request.body)
+    vle_course_id = data.get('vle_course_id', '')
+    vle_group_id = data.get('vle_group_id', '')
+    username = data.get('username', '')
+
+    # make sure vle_course_id and username were given
+    if not vle_course_id or not username:
+        return _error400(_('Must specify vle_course_id and username'))
+
+    # update the cached memberships
+    patch_memberships(vle_course_id, partial(remove_member, username=username, vle_group_id=vle_group_id))
+
+    # return JSON response
+    return _success200(_('Membership deleted successfully!'))
+
+
+@csrf_exempt
+@require_http_methods(['POST'])
+@idempotent
+def batch(request):
+    """
+    apply an ordered list of operations, each naming one of the endpoints above and giving the data it takes, e.g.
+    [{"operation": "create_group", "data": {"vle_course_id": ..., "vle_group_id": ..., "name": ...}}, ...]
+    all in one transaction, returning each operation's result in order
+    """
+
+    # get the operations from the request
+    operations = codec.loads(request.body)
+    if not isinstance(operations, list):
+        return _error400(_('Must specify a list of operations'))
+
+    # queue them to be applied later if ingesting asynchronously
+    if is_async():
+        try:
+            queued = [(operation['operation'], operation['data']) for operation in operations]
+        except (KeyError, TypeError):
+            queued = None
+        if queued is None or any(name not in OPERATIONS or not isinstance(data, dict) for name, data in queued):
+            return _error400(_('Must specify a valid operation and its data'))
+        return _accepted202(queued)
+
+    # apply them, which is all or nothing if the database refuses any
+    try:
+        results = apply_operations(operations)
+    except ProtectedError:
+        return _error400(_('Cannot delete a course that still has groups'))
+    except IntegrityError:
+        # a concurrent request has just taken one of the ids
+        return _error400(_('Course or group with a given id already exists'))
+
+    # return JSON response
+    return HttpResponse(codec.dumps({'results': results}), content_type='application/json', status=200)
+
+
+# the fields each read endpoint can return, and what they're looked up as
+MASTER_COURSE_FIELDS = {
+    'vle_course_id': 'vle_course_id',
+    'display_name': 'display_name',
+    'compulsory': 'compulsory',
+    'credits': 'credits',
+    'commitment': 'commitment',
+    'weeks_duration': 'weeks_duration',
+    'next_start_date': 'next_start_date',
+    'next_run_vle_course_id': 'next_run__vle_course_id',
+}
+SCHEDULED_COURSE_FIELDS = {
+    'vle_course_id': 'vle_course_id',
+    'master_vle_course_id': 'master_course__vle_course_id',
+    'display_name': 'display_name',
+    'open_date': 'open_date',
+    'start_date': 'start_date',
+    'end_date': 'end_date',
+    'close_date': 'close_date',
+}
+GROUP_FIELDS = {
+    'id': 'id',
+    'vle_course_id': 'scheduled_course__vle_course_id',
+    'vle_group_id': 'vle_group_id',
+    'display_name': 'display_name',
+}
+
+
+def _catalogue_etag(request, *args, **kwargs):
+    """
+    changes whenever the catalogue does, and differs between pages, without touching the database
+    """
+    return '{}-{}'.format(get_catalogue_version(), request.GET.urlencode())
+
+
+@gzip_page
+@condition(etag_func=_catalogue_etag)
+@require_GET
+def list_master_courses(request):
+    """
+    list master courses in vle_course_id order
+    takes limit, after (the next cursor of the previous page) and fields (comma separated) query parameters
+    """
+    return _list(request, MasterCourse.objects.all(), MASTER_COURSE_FIELDS, 'vle_course_id')
+
+
+@gzip_page
+@condition(etag_func=_catalogue_etag)
+@require_GET
+def list_scheduled_courses(request):
+    """
+    list scheduled courses in vle_course_id order, optionally only those of master_vle_course_id
+    takes limit, after and fields query parameters, like list_master_courses
+    """
+    queryset = ScheduledCourse.objects.all()
+    if request.GET.get('master_vle_course_id'):
+        queryset = queryset.filter(master_course__vle_course_id=request.GET['master_vle_course_id'])
+    return _list(request, queryset, SCHEDULED_COURSE_FIELDS, 'vle_course_id')
+
+
+@gzip_page
+@condition(etag_func=_catalogue_etag)
+@require_GET
+def list_groups(request):
+    """
+    list groups in id order, optionally only those of the scheduled course vle_course_id
+    takes limit, after and fields query parameters, like list_master_courses
+    """
+    queryset = ScheduledCourseGroup.objects.all()
+    if request.GET.get('vle_course_id'):
+        queryset = queryset.filter(scheduled_course__vle_course_id=request.GET['vle_course_id'])
+    return _list(request, queryset, GROUP_FIELDS, 'id')
+
+
+@gzip_page
+@require_GET
+def programme_structure(request, programme_id):
+    """
+    a programme's stages and available master courses, in order, from its snapshot
+    """
+    snapshot = get_programme_snapshot(int(programme_id))
+    if snapshot is None:
+        return HttpResponseNotFound()
+
+    return HttpResponse(codec.dumps(dict(snapshot, courses=[
+        dict(course, next_start_date=course['next_start_date'] and course['next_start_date'].isoformat())
+        for course in snapshot['courses']
+    ])), content_type='application/json', status=200)
+
+
+@gzip_page
+@require_GET
+def course_calendar(request):
+    """
+    the scheduled courses opening, starting, ending and closing in each of the next weeks (from monday)
+    takes weeks (default 4) and today (YYYY-MM-DD, default today) query parameters
+    """
+
+    # get the weeks and today from the request
+    try:
+        weeks = int(request.GET.get('weeks', 4))
+    except ValueError:
+        return _error400(_('weeks must be a number'))
+    max_weeks = getattr(settings, 'PROGRAMMES_API_MAX_CALENDAR_WEEKS', 52)
+    if not 1 <= weeks <= max_weeks:
+        return _error400(_('weeks must be between 1 and {}').format(max_weeks))
+    today = get_datetime_or_none(request.GET.get('today'), '%Y-%m-%d')
+    if request.GET.get('today') and today is None:
+        return _error400(_('today must be a date (YYYY-MM-DD)'))
+
+    # return JSON response
+    return HttpResponse(codec.dumps({
+        'weeks': [dict({'week': monday.isoformat()}, **{
+            event: [
+                {f: v.isoformat() if hasattr(v, 'isoformat') else v for f, v in course.items()}
+                for course in events[event]
+            ] for event, field in CALENDAR_EVENTS
+        }) for monday, events in ScheduledCourse.objects.calendar(weeks, today and today.date())],
+    }), content_type='application/json', status=200)
+
+
+@require_GET
+def export_catalogue(request):
+    """
+    stream every master course, scheduled course and group, one row per group, as ndjson (the default) or csv, as
+    given by the format query parameter
+    """
+    fmt = request.GET.get('format', 'ndjson')
+    if fmt not in FORMATS:
+        return _error400(_('format must be one of: {}').format(', '.join(FORMATS)))
+
+    response = StreamingHttpResponse(FORMATS[fmt](iter_catalogue()), content_type=CONTENT_TYPES[fmt])
+    response['Content-Disposition'] = 'attachment; filename="catalogue.{}"'.format(fmt)
+    return response
+
+
+def _list(request, queryset, available_fields, cursor_field):
+    """
+    return a page of queryset, ordered by (the unique, indexed) cursor_field and starting after the after parameter
+    so each page is an index range scan, however deep it is
+    """
+
+    # get the page size and fields from the request
+    try:
+        limit = min(int(request.GET.get('limit', 100)), getattr(settings, 'PROGRAMMES_API_MAX_PAGE_SIZE', 1000))
+    except ValueError:
+        return _error400(_('limit must be a number'))
+    if limit < 1:
+        return _error400(_('limit must be a number'))
+    fields = [f for f in request.GET.get('fields', '').split(',') if f] or list(available_fields)
+    if any(f not in available_fields for f in fields):
+        return _error400(_('fields must be some of: {}').format(', '.join(available_fields)))
+
+    # get the page, and one more row to know if there's another page
+    queryset = queryset.order_by(cursor_field)
+    after = request.GET.get('after')
+    if after:
+        try:
+            queryset = queryset.filter(**{cursor_field + '__gt': after})
+        except ValueError:
+            return _error400(_('after must be the next cursor of a previous page'))
+    lookups = [available_fields[f] for f in fields]
+    rows = list(queryset.values_list(cursor_field, *lookups)[:limit + 1])
+    next_cursor = str(rows[limit - 1][0]) if len(rows) > limit else None
+
+    # return JSON response
+    results = [
+        {f: v.isoformat() if hasattr(v, 'isoformat') else v for f, v in zip(fields, row[1:])}
+        for row in rows[:limit]
+    ]
+    return HttpResponse(codec.dumps({
+        'results': results,
+        'next': next_cursor,
+    }), content_type='application/json', status=200)
+
+
 def _error400(msg):
     """
     return an http 400 with a given message
     """
-    return HttpResponse(json.dumps({
+    return HttpResponse(codec.dumps({
         'errorMessage': msg
     }), content_type='application/json', status=400)
 
 
+def _accepted202(operations):
+    """
+    queue (operation, data) pairs and return an http 202
+    """
+    enqueue(operations)
+    return HttpResponse(codec.dumps({
+        'successMessage': _('Request accepted')
+    }), content_type='application/json', status=202)
+
+
 def _success200(msg):
     """
     return an http 200 with a given message
     """
-    return HttpResponse(json.dumps({
+    return HttpResponse(codec.dumps({
         'successMessage': msg
     }), content_type='application/json', status=200)
 
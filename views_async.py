@@ -0,0 +1,122 @@
+"""
+native async versions of the course and group endpoints in views.py, for ASGI deployments (see urls_json_api.py)
+requests are parsed, validated and answered on the event loop, with only the database work (through the batch
+applier, so the results match the sync views) handed to a thread
+"""
+from functools import wraps
+
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError
+from django.db.models import ProtectedError
+from django.http.response import HttpResponse, HttpResponseNotAllowed
+from django.utils.translation import gettext as _
+
+from . import codec
+from .batch import OPERATIONS, apply_operations, validate_operation
+from .idempotency import idempotent
+from .ingest import enqueue, is_async
+from .views import _error400, _success200
+
+
+def _post(view):
+    """
+    require_http_methods(['POST']) and csrf_exempt for async views, as those decorators wrap them in sync functions
+    """
+    @wraps(view)
+    async def wrapper(request, *args, **kwargs):
+        if request.method != 'POST':
+            return HttpResponseNotAllowed(['POST'])
+        return await view(request, *args, **kwargs)
+
+    wrapper.csrf_exempt = True
+    return wrapper
+
+
+def _operation_view(operation):
+    """
+    an async view for one operation
+    """
+    @_post
+    @idempotent
+    async def view(request):
+        # get the data from the request, and make sure the required fields were given
+        data = codec.loads(request.body)
+        if not isinstance(data, dict):
+            return _error400(_('Must specify a valid operation and its data'))
+        error = validate_operation(operation, data)
+        if error:
+            return _error400(error)
+
+        # queue it to be applied later if ingesting asynchronously
+        if is_async():
+            await sync_to_async(enqueue)([(operation, data)])
+            return _accepted202()
+
+        # apply it
+        try:
+            result, = await sync_to_async(apply_operations)([{'operation': operation, 'data': data}])
+        except ProtectedError:
+            return _error400(_('Cannot delete a course that still has groups'))
+        except IntegrityError:
+            # a concurrent request has just taken one of the ids
+            return _error400(_('Course or group with a given id already exists'))
+
+        # return JSON response
+        if 'errorMessage' in result:
+            return _error400(result['errorMessage'])
+        return _success200(result['successMessage'])
+
+    view.__name__ = view.__qualname__ = operation
+    return view
+
+
+create_master_course = _operation_view('create_master_course')
+update_master_course = _operation_view('update_master_course')
+delete_master_course = _operation_view('delete_master_course')
+create_scheduled_course = _operation_view('create_scheduled_course')
+update_scheduled_course = _operation_view('update_scheduled_course')
+delete_scheduled_course = _operation_view('delete_scheduled_course')
+create_group = _operation_view('create_group')
+update_group = _operation_view('update_group')
+delete_group = _operation_view('delete_group')
+
+
+@_post
+@idempotent
+async def batch(request):
+    """
+    see views.batch
+    """
+
+    # get the operations from the request
+    operations = codec.loads(request.body)
+    if not isinstance(operations, list):
+        return _error400(_('Must specify a list of operations'))
+
+    # queue them to be applied later if ingesting asynchronously
+    if is_async():
+        try:
+            queued = [(operation['operation'], operation['data']) for operation in operations]
+        except (KeyError, TypeError):
+            queued = None
+        if queued is None or any(name not in OPERATIONS or not isinstance(data, dict) for name, data in queued):
+            return _error400(_('Must specify a valid operation and its data'))
+        await sync_to_async(enqueue)(queued)
+        return _accepted202()
+
+    # apply them, which is all or nothing if the database refuses any
+    try:
+        results = await sync_to_async(apply_operations)(operations)
+    except ProtectedError:
+        return _error400(_('Cannot delete a course that still has groups'))
+    except IntegrityError:
+        # a concurrent request has just taken one of the ids
+        return _error400(_('Course or group with a given id already exists'))
+
+    # return JSON response
+    return HttpResponse(codec.dumps({'results': results}), content_type='application/json', status=200)
+
+
+def _accepted202():
+    # unlike views._accepted202, as the operations have to be queued off the event loop
+    return HttpResponse(codec.dumps({'successMessage': _('Request accepted')}), content_type='application/json', status=202)
@@ -0,0 +1,163 @@
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+
+import requests
+from requests.adapters import HTTPAdapter
+
+# (connect, read) timeouts in seconds for each endpoint, which VLE_TIMEOUTS can override
+DEFAULT_TIMEOUTS = {
+    'default': (3.05, 30),
+    'enrolments': (3.05, 10),
+    'batch_enrolments': (3.05, 60),
+    'memberships': (3.05, 120),
+    'membership_changes': (3.05, 30),
+    'sync': (3.05, 300),
+}
+
+
+class VLEUnavailable(requests.RequestException):
+    """
+    raised instead of making a request while an endpoint's circuit breaker is open
+    """
+
+
+class CircuitBreaker(object):
+    """
+    a latency-aware circuit breaker
+    it opens when, of the last window calls (and at least minimum_calls), the proportion that failed or took longer
+    than slow_call_duration seconds reaches failure_rate; after reset_timeout seconds one trial call is let through,
+    which closes it again if it's fast and successful, or reopens it otherwise
+    """
+    CLOSED = 'closed'
+    OPEN = 'open'
+    HALF_OPEN = 'half_open'
+
+    def __init__(self, window=20, minimum_calls=10, failure_rate=0.5, slow_call_duration=5.0, reset_timeout=30):
+        self.minimum_calls = minimum_calls
+        self.failure_rate = failure_rate
+        self.slow_call_duration = slow_call_duration
+        self.reset_timeout = reset_timeout
+        self.state = self.CLOSED
+        self._calls = deque(maxlen=window)
+        self._opened = 0
+        self._lock = threading.Lock()
+
+    def allow(self):
+        with self._lock:
+            if self.state == self.CLOSED:
+                return True
+            if self.state == self.OPEN and time.monotonic() - self._opened >= self.reset_timeout:
+                self.state = self.HALF_OPEN
+                return True
+            return False
+
+    def record(self, duration, failed):
+        bad = failed or duration > self.slow_call_duration
+        with self._lock:
+            if self.state == self.HALF_OPEN:
+                if bad:
+                    self._open()
+                else:
+                    self.state = self.CLOSED
+                    self._calls.clear()
+                return
+
+            self._calls.append(bad)
+            if len(self._calls) >= self.minimum_calls and sum(self._calls) >= self.failure_rate * len(self._calls):
+                self._open()
+
+    def _open(self):
+        self.state = self.OPEN
+        self._opened = time.monotonic()
+        self._calls.clear()
+
+
+class VLEClient(object):
+    """
+    a pooled, keep-alive http client for the VLE, with per-endpoint timeouts and circuit breakers
+    GETs are retried (VLE_RETRIES times) on connection errors and 5xx responses, with exponential backoff and jitter
+    """
+
+    def __init__(self):
+        pool_size = getattr(settings, 'VLE_POOL_SIZE', 10)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self._breakers = {}
+        self._lock = threading.Lock()
+
+    def get(self, url, params=None, endpoint='default'):
+        return self._request('GET', url, endpoint, getattr(settings, 'VLE_RETRIES', 2), params=params)
+
+    def post(self, url, json=None, endpoint='default'):
+        return self._request('POST', url, endpoint, 0, json=json)
+
+    def breaker(self, endpoint):
+        with self._lock:
+            if endpoint not in self._breakers:
+                self._breakers[endpoint] = CircuitBreaker(**getattr(settings, 'VLE_CIRCUIT_BREAKER', {}))
+            return self._breakers[endpoint]
+
+    def _request(self, method, url, endpoint, retries, **kwargs):
+        breaker = self.breaker(endpoint)
+        timeout = _get_timeout(endpoint)
+        for attempt in range(retries + 1):
+            if not breaker.allow():
+                raise VLEUnavailable('VLE endpoint {} is unavailable'.format(endpoint))
+
+            start = time.monotonic()
+            try:
+                response = self.session.request(method, url, timeout=timeout, **kwargs)
+            except requests.RequestException:
+                breaker.record(time.monotonic() - start, True)
+                if attempt == retries:
+                    raise
+            else:
+                failed = response.status_code >= 500
+                breaker.record(time.monotonic() - start, failed)
+                if not failed or attempt == retries:
+                    return response
+
+            # full jitter
+            time.sleep(random.uniform(0, getattr(settings, 'VLE_RETRY_BACKOFF', 0.5) * 2 ** attempt))
+
+
+def get_max_duration(endpoint):
+    """
+    the longest, in seconds, a GET to an endpoint takes to give up: every attempt timing out, with the longest backoff
+    between them (though a response that keeps trickling in never times out, as the read timeout is between bytes)
+    """
+    timeout = _get_timeout(endpoint)
+    attempt_timeout = sum(timeout) if isinstance(timeout, (list, tuple)) else timeout
+    retries = getattr(settings, 'VLE_RETRIES', 2)
+    backoff = sum(getattr(settings, 'VLE_RETRY_BACKOFF', 0.5) * 2 ** attempt for attempt in range(retries))
+    return attempt_timeout * (retries + 1) + backoff
+
+
+def _get_timeout(endpoint):
+    return getattr(settings, 'VLE_TIMEOUTS', {}).get(endpoint) or DEFAULT_TIMEOUTS.get(endpoint, DEFAULT_TIMEOUTS['default'])
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    global _client
+    with _client_lock:
+        if _client is None:
+            _client = VLEClient()
+        return _client
+
+
+def get(url, params=None, endpoint='default'):
+    return get_client().get(url, params=params, endpoint=endpoint)
+
+
+def post(url, json=None, endpoint='default'):
+    return get_client().post(url, json=json, endpoint=endpoint)